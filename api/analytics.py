@@ -0,0 +1,190 @@
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Max, Min, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce, Greatest, TruncDate
+from django.utils import timezone
+
+from .models import Order, OrderItem, Product, SellerDailySales, Store
+
+ZERO = Decimal('0.00')
+VOID_STATUSES = ('CANCELED', 'RETURNED')
+
+# Products and order lines belong to a seller, not to a store: Store.total_sales
+# is the units sold by the store's seller, the same on each of their stores.
+
+# Lines that count as sold: of paid orders or unpaid cash on delivery ones,
+# with neither the line nor its order canceled or returned.
+SOLD_LINES = (
+    (Q(order__payment_status='PAID') | Q(order__payment_method='COD', order__payment_status='UNPAID'))
+    & ~Q(order__status__in=VOID_STATUSES)
+    & ~Q(status__in=VOID_STATUSES)
+)
+
+
+def _day_start(day):
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def _sold(lines):
+    # {(seller id, product id, day): (units, revenue)}, days in the current time zone like _day_start
+    rows = (
+        lines.filter(SOLD_LINES).annotate(day=TruncDate('order__created_at'))
+        .values('seller_id', 'product_id', 'day').annotate(units=Sum('quantity'), revenue=Sum('total_price'))
+        .order_by()
+    )
+    return {(row['seller_id'], row['product_id'], row['day']): (row['units'], row['revenue']) for row in rows}
+
+
+def _write(totals, rows, keys):
+    """
+    Make the rollup `rows` of `keys` match `totals`. Returns the number of
+    rows written and the unit differences per product and per seller.
+    """
+    created, updated, deleted = [], [], []
+    products, sellers = defaultdict(int), defaultdict(int)
+    for key in keys:
+        units, revenue = totals.get(key, (0, ZERO))
+        row = rows.get(key)
+        before = row.units if row else 0
+        if row is None:
+            if units:
+                created.append(SellerDailySales(
+                    seller_id=key[0], product_id=key[1], day=key[2], units=units, revenue=revenue
+                ))
+        elif not units:
+            deleted.append(row.id)
+        elif (row.units, row.revenue) != (units, revenue):
+            row.units, row.revenue = units, revenue
+            updated.append(row)
+        products[key[1]] += units - before
+        sellers[key[0]] += units - before
+    SellerDailySales.objects.bulk_create(created)
+    SellerDailySales.objects.bulk_update(updated, ['units', 'revenue', 'updated_at'])
+    if deleted:
+        SellerDailySales.objects.filter(id__in=deleted).delete()
+    return len(created) + len(updated) + len(deleted), products, sellers
+
+
+def _add(queryset, key_field, field, deltas):
+    deltas = {key: delta for key, delta in deltas.items() if delta}
+    if deltas:
+        delta = Case(*[When(**{key_field: key}, then=Value(value)) for key, value in deltas.items()],
+                     output_field=IntegerField())
+        queryset.filter(**{f'{key_field}__in': deltas}).update(**{field: Greatest(F(field) + delta, 0)})
+
+
+def sales_keys(order_ids):
+    """(seller id, product id, day) of every line of the orders, sold or not."""
+    lines = OrderItem.objects.filter(order_id__in=order_ids).annotate(day=TruncDate('order__created_at'))
+    return set(lines.values_list('seller_id', 'product_id', 'day'))
+
+
+def refresh_sales(keys):
+    """
+    Recompute the SellerDailySales rows of `keys`, (seller id, product id,
+    day) tuples, from the sold lines and apply the differences to
+    Product.quantity_sold and to the Store.total_sales of every store of
+    the seller. Rows are recomputed rather than adjusted, so refreshing a
+    key twice or one that did not change writes nothing. Returns the number
+    of rows written.
+    """
+    keys = {key for key in keys if None not in key}
+    if not keys:
+        return 0
+    sellers, products, days = (set(values) for values in zip(*keys))
+    with transaction.atomic():
+        totals = _sold(OrderItem.objects.filter(
+            seller_id__in=sellers, product_id__in=products,
+            order__created_at__gte=_day_start(min(days)),
+            order__created_at__lt=_day_start(max(days) + timedelta(days=1)),
+        ))
+        rows = {
+            (row.seller_id, row.product_id, row.day): row
+            for row in SellerDailySales.objects.select_for_update().filter(
+                seller_id__in=sellers, product_id__in=products, day__in=days
+            )
+        }
+        written, product_units, seller_units = _write(totals, rows, keys)
+        _add(Product.objects, 'id', 'quantity_sold', product_units)
+        _add(Store.objects, 'user_id', 'total_sales', seller_units)
+    return written
+
+
+def refresh_order_sales(order_ids):
+    return refresh_sales(sales_keys(order_ids))
+
+
+def sync_sales_totals(batch_size=5000):
+    """Set Product.quantity_sold and Store.total_sales, per seller, to the totals of the rollups."""
+    for model, key_field, field, group in (
+        (Product, 'id', 'quantity_sold', 'product'),
+        (Store, 'user_id', 'total_sales', 'seller'),
+    ):
+        total = SellerDailySales.objects.filter(**{group: OuterRef(key_field)}).values(group).annotate(
+            total=Sum('units')
+        ).values('total')
+        last = model.objects.aggregate(last=Max('id'))['last'] or 0
+        for start in range(0, last + 1, batch_size):
+            model.objects.filter(id__gte=start, id__lt=start + batch_size).update(
+                **{field: Coalesce(Subquery(total), 0)}
+            )
+
+
+def rebuild_sales_rollups(start=None, end=None, days_per_batch=7):
+    """
+    Recompute the rollups of the days from `start` to `end`, by default of
+    every day with orders, `days_per_batch` days per transaction, then the
+    product and store totals. Returns the number of rows written.
+    """
+    bounds = Order.objects.aggregate(first=Min('created_at'), last=Max('created_at'))
+    today = timezone.localdate()
+    start = start or (timezone.localdate(bounds['first']) if bounds['first'] else today)
+    end = end or (timezone.localdate(bounds['last']) if bounds['last'] else today)
+    written = 0
+    day = start
+    while day <= end:
+        stop = min(day + timedelta(days=days_per_batch), end + timedelta(days=1))
+        with transaction.atomic():
+            totals = _sold(OrderItem.objects.filter(
+                order__created_at__gte=_day_start(day), order__created_at__lt=_day_start(stop)
+            ))
+            rows = {
+                (row.seller_id, row.product_id, row.day): row
+                for row in SellerDailySales.objects.select_for_update().filter(day__gte=day, day__lt=stop)
+            }
+            written += _write(totals, rows, set(totals) | set(rows))[0]
+        day = stop
+    sync_sales_totals()
+    return written
+
+
+def seller_sales(seller_id, start, end, top=10):
+    """Units and revenue of a seller per day from `start` to `end` and their `top` products, from the rollups."""
+    rollups = SellerDailySales.objects.filter(seller_id=seller_id, day__gte=start, day__lte=end)
+    by_day = {
+        row['day']: row for row in rollups.values('day').annotate(units=Sum('units'), revenue=Sum('revenue')).order_by()
+    }
+    days = []
+    for offset in range((end - start).days + 1):
+        day = start + timedelta(days=offset)
+        row = by_day.get(day, {'units': 0, 'revenue': ZERO})
+        days.append({'day': day, 'units': row['units'], 'revenue': row['revenue']})
+    products = rollups.values('product_id', 'product__name').annotate(
+        units=Sum('units'), revenue=Sum('revenue')
+    ).order_by('-revenue', '-units', 'product_id')[:top]
+    return {
+        'seller': seller_id,
+        'start': start,
+        'end': end,
+        'units': sum(day['units'] for day in days),
+        'revenue': sum((day['revenue'] for day in days), ZERO),
+        'days': days,
+        'top_products': [
+            {'product': row['product_id'], 'name': row['product__name'], 'units': row['units'],
+             'revenue': row['revenue']}
+            for row in products
+        ],
+    }
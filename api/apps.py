@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self):
+        # Signal receivers and task handlers register themselves on import
+        from . import images, payments, recommendations, signals, tasks  # noqa: F401
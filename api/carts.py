@@ -0,0 +1,330 @@
+import logging
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import Cart, CartItem, Product
+
+logger = logging.getLogger(__name__)
+
+# Carts live in the CART_CACHE_ALIAS cache: reading and changing them makes
+# no database writes. Changes of one cart are serialised by a lock entry in
+# the cache and bump the version of its entry. A cart changed since it was
+# last written is marked dirty and appended once to a journal of sequence
+# numbered cache entries, which flush_journal, run every CART_FLUSH_SECONDS
+# by the flush_carts command, writes to Cart and CartItem rows. Checkout
+# writes the cart right away. Cart.version is the version written, a flush
+# never overwrites a newer one. Changes since the last flush live only in
+# the cache: the carts alias must not evict entries, and its add() must be
+# atomic across workers, as with Redis or Memcached.
+
+ITEM_FIELDS = ('quantity', 'size', 'color', 'price_at_time', 'is_saved_for_later')
+JOURNAL_HEAD = 'cart-journal:head'
+JOURNAL_TAIL = 'cart-journal:tail'
+JOURNAL_GAP = 'cart-journal:gap'
+JOURNAL_LOCK = 'cart-journal:lock'
+# A cart stays marked dirty at most this long, should its journal entry be lost it is journaled again
+DIRTY_SECONDS = 60 * 60
+
+
+class CartError(Exception):
+    pass
+
+
+def _cache():
+    return caches[settings.CART_CACHE_ALIAS]
+
+
+def owner_of(request, create=False):
+    """('user', id) when signed in, else ('session', key) of the session, created on demand."""
+    if request.user.is_authenticated:
+        return ('user', request.user.pk)
+    session = request.session
+    if session.session_key is None and create:
+        session.save()
+    return ('session', session.session_key) if session.session_key else None
+
+
+def _key(owner):
+    return f'cart:{owner[0]}:{owner[1]}'
+
+
+def line_key(product_id, size=None, color=None):
+    return f'{product_id}:{size or ""}:{color or ""}'
+
+
+def _owner_filter(owner):
+    return {'user_id': owner[1]} if owner[0] == 'user' else {'user__isnull': True, 'session_key': owner[1]}
+
+
+def _owner_fields(owner):
+    return {'user_id': owner[1]} if owner[0] == 'user' else {'session_key': owner[1]}
+
+
+def _items(owner):
+    lines = {}
+    items = CartItem.objects.filter(**{f'cart__{field}': value for field, value in _owner_filter(owner).items()})
+    for item in items.order_by('added_at', 'id'):
+        lines[line_key(item.product_id, item.size, item.color)] = {
+            'product': item.product_id, 'size': item.size or None, 'color': item.color or None,
+            'quantity': item.quantity, 'price_at_time': item.price_at_time,
+            'is_saved_for_later': item.is_saved_for_later, 'added_at': item.added_at,
+        }
+    return lines
+
+
+def _from_database(owner):
+    version = Cart.objects.filter(**_owner_filter(owner)).values_list('version', flat=True).first()
+    if version is None:
+        return {'version': 0, 'lines': {}}
+    return {'version': version, 'lines': _items(owner)}
+
+
+def _load(owner):
+    entry = _cache().get(_key(owner))
+    if entry is None:
+        entry = _from_database(owner)
+        _store(owner, entry)
+    return entry
+
+
+def _store(owner, entry):
+    _cache().set(_key(owner), entry, settings.CART_CACHE_SECONDS)
+
+
+def get_cart(owner):
+    if owner is None:
+        return {'version': 0, 'lines': {}}
+    return _load(owner)
+
+
+@contextmanager
+def _locked(owner):
+    key = f'{_key(owner)}:lock'
+    deadline = time.monotonic() + settings.CART_LOCK_SECONDS
+    # Expires on its own should its holder die
+    while not _cache().add(key, True, settings.CART_LOCK_SECONDS):
+        if time.monotonic() >= deadline:
+            raise CartError('The cart is being changed, try again.')
+        time.sleep(0.001)
+    try:
+        yield
+    finally:
+        _cache().delete(key)
+
+
+def _journal(owner):
+    cache = _cache()
+    dirty = f'{_key(owner)}:dirty'
+    if cache.get(dirty):
+        return
+    cache.set(dirty, True, DIRTY_SECONDS)
+    cache.add(JOURNAL_HEAD, 0, None)
+    cache.set(f'cart-journal:{cache.incr(JOURNAL_HEAD)}', list(owner), None)
+
+
+def _change(owner, apply):
+    with _locked(owner):
+        entry = _load(owner)
+        apply(entry['lines'])
+        entry['version'] += 1
+        _store(owner, entry)
+    _journal(owner)
+    return entry
+
+
+def add_item(owner, product_id, quantity=1, size=None, color=None):
+    """Add `quantity` units, the price is snapshotted when the line is created."""
+    key = line_key(product_id, size, color)
+
+    def apply(lines):
+        line = lines.get(key)
+        if line is not None:
+            line['quantity'] += quantity
+            return
+        price = Product.objects.filter(id=product_id, status='ACTIVE').values_list('effective_price', flat=True)
+        price = price.first()
+        if price is None:
+            raise CartError(f'Product {product_id} is not available.')
+        lines[key] = {
+            'product': product_id, 'size': size or None, 'color': color or None, 'quantity': quantity,
+            'price_at_time': price, 'is_saved_for_later': False, 'added_at': timezone.now(),
+        }
+    return _change(owner, apply)
+
+
+def update_item(owner, product_id, size=None, color=None, quantity=None, is_saved_for_later=None):
+    """Set the quantity and/or saved for later flag of a line, a quantity of 0 removes it."""
+    key = line_key(product_id, size, color)
+
+    def apply(lines):
+        if key not in lines:
+            raise CartError(f'Product {product_id} is not in the cart.')
+        if quantity == 0:
+            del lines[key]
+            return
+        if quantity is not None:
+            lines[key]['quantity'] = quantity
+        if is_saved_for_later is not None:
+            lines[key]['is_saved_for_later'] = is_saved_for_later
+    return _change(owner, apply)
+
+
+def clear_cart(owner):
+    return _change(owner, lambda lines: lines.clear())
+
+
+# Writing carts to the database
+
+def _cart_row(owner):
+    while True:
+        cart = Cart.objects.filter(**_owner_filter(owner)).first()
+        if cart is not None:
+            return cart
+        try:
+            with transaction.atomic():
+                return Cart.objects.create(**_owner_fields(owner))
+        except IntegrityError:
+            # Created by a concurrent flush
+            pass
+
+
+def flush(owner):
+    """Write the cached cart of `owner` to its Cart and CartItem rows, if it changed since the last write."""
+    entry = _cache().get(_key(owner)) if owner else None
+    if entry is None:
+        return False
+    with transaction.atomic():
+        cart = _cart_row(owner)
+        # Locks the cart, a flush of the same or a newer version in the meantime wins
+        if not Cart.objects.filter(id=cart.id, version__lt=entry['version']).update(
+            version=entry['version'], updated_at=timezone.now()
+        ):
+            return False
+        lines = entry['lines']
+
+        existing = {line_key(item.product_id, item.size, item.color): item for item in cart.items.all()}
+        # Lines of products deleted since they were added are dropped
+        products = set(Product.objects.filter(
+            id__in={line['product'] for line in lines.values()}
+        ).values_list('id', flat=True))
+        created, updated = [], []
+        for key, line in lines.items():
+            if line['product'] not in products:
+                continue
+            item = existing.pop(key, None)
+            values = {field: line[field] for field in ITEM_FIELDS}
+            if item is None:
+                created.append(CartItem(cart=cart, product_id=line['product'], **values))
+            elif any(getattr(item, field) != value for field, value in values.items()):
+                for field, value in values.items():
+                    setattr(item, field, value)
+                updated.append(item)
+        CartItem.objects.bulk_create(created)
+        CartItem.objects.bulk_update(updated, ITEM_FIELDS)
+        if existing:
+            CartItem.objects.filter(id__in=[item.id for item in existing.values()]).delete()
+    return True
+
+
+def flush_journal():
+    """
+    Write every cart journaled since the last run, in journal order. Runs
+    one at a time, returns the number of carts written.
+    """
+    cache = _cache()
+    if not cache.add(JOURNAL_LOCK, True, settings.CART_FLUSH_SECONDS * 10):
+        return 0
+    written = 0
+    position = cache.get(JOURNAL_TAIL, 0)
+    try:
+        head = cache.get(JOURNAL_HEAD, 0)
+        while position < head:
+            sequence = position + 1
+            owner = cache.get(f'cart-journal:{sequence}')
+            if owner is None and cache.get(JOURNAL_GAP) != sequence:
+                # Numbered but maybe not written yet, skipped if still missing on the next run
+                cache.set(JOURNAL_GAP, sequence, None)
+                break
+            if owner is not None:
+                owner = tuple(owner)
+                # Changes from here on journal the cart again
+                cache.delete(f'{_key(owner)}:dirty')
+                try:
+                    written += flush(owner)
+                except Exception:
+                    logger.exception('Could not write the cart of %s:%s', *owner)
+                    _journal(owner)
+                cache.delete(f'cart-journal:{sequence}')
+            position = sequence
+    finally:
+        cache.set(JOURNAL_TAIL, position, None)
+        cache.delete(JOURNAL_LOCK)
+    return written
+
+
+def merge_guest_cart(session_key, user_id):
+    """
+    Move the cart of a guest session into the cart of the user who signed in
+    from it. Lines for the same product, size and color add up. Both carts
+    are locked and written first, merged in one transaction and dropped from
+    the cache afterwards. The queries do not depend on the size of the
+    carts, and the guest cart is deleted in the same transaction, so a
+    retried sign in finds nothing left to merge. Returns the number of
+    merged lines.
+    """
+    guest_owner, user_owner = ('session', session_key), ('user', user_id)
+    with _locked(guest_owner), _locked(user_owner):
+        merged = _merge(guest_owner, user_owner)
+        # Dropped once the merge is committed, loaded again from its rows
+        _cache().delete_many([_key(guest_owner), _key(user_owner)])
+    return merged
+
+
+def _merge(guest_owner, user_owner):
+    session_key, user_id = guest_owner[1], user_owner[1]
+    with transaction.atomic():
+        flush(guest_owner)
+        flush(user_owner)
+        found = {
+            cart.user_id is None: cart for cart in Cart.objects.select_for_update().filter(
+                Q(user_id=user_id) | Q(user__isnull=True, session_key=session_key)
+            )
+        }
+        guest, cart = found.get(True), found.get(False)
+        if guest is None:
+            return 0
+        if cart is None:
+            # The guest cart becomes the user's cart as it is
+            Cart.objects.filter(id=guest.id).update(
+                user_id=user_id, session_key=None, version=F('version') + 1, updated_at=timezone.now(),
+            )
+            merged = guest.items.count()
+        else:
+            items = list(CartItem.objects.filter(cart__in=(guest, cart)))
+            own = {line_key(item.product_id, item.size, item.color): item for item in items if item.cart_id == cart.id}
+            added, moved = [], []
+            for item in items:
+                if item.cart_id != guest.id:
+                    continue
+                existing = own.get(line_key(item.product_id, item.size, item.color))
+                if existing is None:
+                    item.cart_id = cart.id
+                    moved.append(item)
+                else:
+                    existing.quantity += item.quantity
+                    existing.is_saved_for_later = existing.is_saved_for_later and item.is_saved_for_later
+                    added.append(existing)
+            CartItem.objects.bulk_update(moved, ['cart'])
+            CartItem.objects.bulk_update(added, ['quantity', 'is_saved_for_later'])
+            CartItem.objects.filter(cart=guest).delete()
+            Cart.objects.filter(id=guest.id).delete()
+            # Cached entries of the old version are never written over the merge
+            Cart.objects.filter(id=cart.id).update(version=F('version') + 1, updated_at=timezone.now())
+            merged = len(moved) + len(added)
+    return merged
@@ -0,0 +1,66 @@
+from django.db.models import F, Q
+
+from .models import Coupon, CouponRedemption
+from .pricing import compiled_coupon, price_order
+from .promotions import get_rule_index, rules_changed
+
+
+def redeem_coupon(coupon, user):
+    """
+    Count one use of `coupon` by `user`, inside the transaction of the order.
+
+    Both the coupon's used_count and the user's redemption count are raised
+    by conditional UPDATEs that only match while under their limits, so
+    concurrent checkouts can never go past them. Raises ValueError when a
+    limit is reached.
+    """
+    used = Coupon.objects.filter(id=coupon.id).filter(
+        Q(usage_limit=0) | Q(used_count__lt=F('usage_limit'))
+    ).update(used_count=F('used_count') + 1)
+    if not used:
+        raise ValueError('This coupon has been fully used.')
+    # The compiled coupon of every worker reloads its used_count
+    rules_changed('coupon', [coupon.id])
+
+    CouponRedemption.objects.bulk_create([CouponRedemption(coupon=coupon, user=user)], ignore_conflicts=True)
+    redemptions = CouponRedemption.objects.filter(coupon=coupon, user=user)
+    if coupon.per_user_limit:
+        redemptions = redemptions.filter(count__lt=coupon.per_user_limit)
+    if not redemptions.update(count=F('count') + 1):
+        raise ValueError('You have already used this coupon as many times as allowed.')
+
+
+def check_coupons(codes, user, lines=None):
+    """
+    Whether each of `codes` can be used by `user`, and with `lines` the order
+    discount and total it would give, from two queries plus the pricing.
+    Coupons limited to some users are checked against the compiled coupon
+    in both cases.
+    """
+    index = get_rule_index()
+    coupons = {coupon.code: coupon for coupon in Coupon.objects.filter(code__in=codes)}
+    redeemed = dict(CouponRedemption.objects.filter(coupon__code__in=codes, user_id=user.pk).values_list(
+        'coupon_id', 'count'
+    )) if user.pk else {}
+
+    results = []
+    for code in codes:
+        result = {'code': code, 'valid': False, 'message': None, 'discount_amount': None, 'total_price': None}
+        coupon = coupons.get(code)
+        if coupon is None:
+            result['message'] = 'Unknown coupon code.'
+        elif not coupon.is_valid(user, redeemed.get(coupon.id, 0)):
+            result['message'] = 'This coupon is not valid.'
+        elif not compiled_coupon(coupon, index).allows(user.pk):
+            result['message'] = 'This coupon is not available for this account.'
+        elif lines:
+            try:
+                quote = price_order(lines, user, coupon, redeemed=redeemed.get(coupon.id, 0))
+            except ValueError as error:
+                result['message'] = str(error)
+            else:
+                result.update(valid=True, discount_amount=quote['discount_amount'], total_price=quote['total_price'])
+        else:
+            result['valid'] = True
+        results.append(result)
+    return results
@@ -0,0 +1,250 @@
+import decimal
+from collections import defaultdict
+
+from django.core.exceptions import ImproperlyConfigured
+from rest_framework import fields, relations, serializers
+from rest_framework.settings import api_settings
+
+from .images import derivative_urls, load_derivatives
+from .serializers import ImageDerivativesField, OrderItemSerializer, OrderSerializer, ProductSerializer
+
+
+# Read-only serialization path for hot list endpoints.
+#
+# A CompiledSerializer inspects the fields of a regular ModelSerializer once and
+# turns each of them into a (column, converter) pair. Rows then come straight
+# from `.values()` and are rendered without instantiating the DRF field
+# machinery per object, while producing exactly the same output.
+
+
+def _decimal_converter(field):
+    if getattr(field, 'localize', False) or field.decimal_places is None:
+        return field.to_representation
+
+    coerce_to_string = getattr(field, 'coerce_to_string', api_settings.COERCE_DECIMAL_TO_STRING)
+    quantum = decimal.Decimal('.1') ** field.decimal_places
+    context = decimal.getcontext().copy()
+    if field.max_digits is not None:
+        context.prec = field.max_digits
+    rounding = field.rounding
+
+    if not coerce_to_string:
+        return lambda value: value.quantize(quantum, rounding=rounding, context=context)
+    return lambda value: '{:f}'.format(value.quantize(quantum, rounding=rounding, context=context))
+
+
+def _datetime_converter(field):
+    output_format = getattr(field, 'format', api_settings.DATETIME_FORMAT)
+
+    def bind(context):
+        if output_format is None or output_format.lower() != fields.ISO_8601:
+            return field.to_representation
+        # Resolved once per render, the active timezone may change per request.
+        field_timezone = field.timezone if hasattr(field, 'timezone') else field.default_timezone()
+        if field_timezone is None:
+            return field.to_representation
+
+        def convert(value):
+            value = value.astimezone(field_timezone).isoformat()
+            if value.endswith('+00:00'):
+                value = value[:-6] + 'Z'
+            return value
+        return convert
+    return bind
+
+
+def _date_converter(field):
+    output_format = getattr(field, 'format', api_settings.DATE_FORMAT)
+    if output_format is None or output_format.lower() != fields.ISO_8601:
+        return field.to_representation
+    return lambda value: value.isoformat()
+
+
+def _file_converter(field, model_field):
+    if not getattr(field, 'use_url', api_settings.UPLOADED_FILES_USE_URL):
+        return lambda name: name or None
+
+    storage = model_field.storage
+
+    def bind(context):
+        request = context.get('request')
+        if request is None:
+            return lambda name: storage.url(name) if name else None
+        build_absolute_uri = request.build_absolute_uri
+        return lambda name: build_absolute_uri(storage.url(name)) if name else None
+    return bind
+
+
+_DERIVATIVES = object()
+
+
+class CompiledSerializer:
+    """
+    Renders `.values()` rows exactly like `serializer_class` renders instances.
+
+    `related_lookups` maps `StringRelatedField`s to the column holding their
+    string value, `nested` maps nested list serializers to the compiled class
+    used for the children and the name of their foreign key to this model.
+    A `nested_filters` entry in the context, {field name: filter kwargs},
+    limits the children rendered for that field.
+    """
+    serializer_class = None
+    related_lookups = {}
+    nested = {}
+
+    _compiled = None
+
+    def __init__(self, context=None):
+        self.context = context or {}
+        plan = self.compile()
+        self.columns = plan['columns']
+        self.many_related = plan['many_related']
+        self.nested_fields = plan['nested']
+        self.derivative_columns = plan['derivative_columns']
+        self._derivatives = {}
+        # Converters that depend on the request are bound once per instance.
+        self.fields = [
+            (name, column, self._bind(converter) if bound else converter)
+            for name, column, converter, bound in plan['fields']
+        ]
+
+    @classmethod
+    def compile(cls):
+        if cls.__dict__.get('_compiled') is not None:
+            return cls._compiled
+
+        model = cls.serializer_class.Meta.model
+        compiled_fields = []
+        columns = ['pk']
+        many_related = []
+        nested = []
+        derivative_columns = []
+
+        for name, field in cls.serializer_class().fields.items():
+            if field.write_only:
+                continue
+
+            if isinstance(field, serializers.ListSerializer):
+                if name not in cls.nested:
+                    raise ImproperlyConfigured(
+                        f'{cls.__name__}.nested has no entry for nested field `{name}`.'
+                    )
+                child_class, fk_name = cls.nested[name]
+                nested.append((name, getattr(model, field.source).rel.related_model, child_class, fk_name))
+                compiled_fields.append((name, None, None, False))
+                continue
+
+            if isinstance(field, relations.ManyRelatedField):
+                if not isinstance(field.child_relation, relations.PrimaryKeyRelatedField):
+                    raise ImproperlyConfigured(f'Cannot compile many related field `{name}`.')
+                model_field = model._meta.get_field(field.source)
+                through = model_field.remote_field.through
+                source_column = through._meta.get_field(model_field.m2m_field_name()).attname
+                target_column = through._meta.get_field(model_field.m2m_reverse_field_name()).attname
+                many_related.append((name, through, source_column, target_column))
+                compiled_fields.append((name, None, None, False))
+                continue
+
+            if isinstance(field, relations.StringRelatedField):
+                if name not in cls.related_lookups:
+                    raise ImproperlyConfigured(
+                        f'{cls.__name__}.related_lookups has no entry for field `{name}`.'
+                    )
+                column, converter, bound = cls.related_lookups[name], None, False
+            elif isinstance(field, ImageDerivativesField):
+                # Looked up for the whole page in `render`.
+                column, converter, bound = field.source, _DERIVATIVES, True
+                derivative_columns.append(column)
+            elif isinstance(field, relations.PrimaryKeyRelatedField):
+                column, converter, bound = model._meta.get_field(field.source).attname, None, False
+            elif isinstance(field, fields.DecimalField):
+                column, converter, bound = field.source, _decimal_converter(field), False
+            elif isinstance(field, fields.DateTimeField):
+                column, converter, bound = field.source, _datetime_converter(field), True
+            elif isinstance(field, fields.DateField):
+                column, converter, bound = field.source, _date_converter(field), False
+            elif isinstance(field, fields.FileField):
+                converter = _file_converter(field, model._meta.get_field(field.source))
+                column, bound = field.source, getattr(field, 'use_url', api_settings.UPLOADED_FILES_USE_URL)
+            elif isinstance(field, (fields.CharField, fields.ChoiceField, fields.IntegerField, fields.BooleanField)):
+                # Database values already have the representation these fields produce.
+                column, converter, bound = field.source, None, False
+            else:
+                raise ImproperlyConfigured(
+                    f'Cannot compile field `{name}` of type {type(field).__name__}.'
+                )
+
+            if column not in columns:
+                columns.append(column)
+            compiled_fields.append((name, column, converter, bound))
+
+        cls._compiled = {
+            'fields': compiled_fields,
+            'columns': columns,
+            'many_related': many_related,
+            'nested': nested,
+            'derivative_columns': derivative_columns,
+        }
+        return cls._compiled
+
+    def _bind(self, converter):
+        if converter is _DERIVATIVES:
+            request = self.context.get('request')
+            return lambda name: derivative_urls(self._derivatives.get(name), request)
+        return converter(self.context)
+
+    def values(self, queryset):
+        return queryset.values(*self.columns)
+
+    def render(self, rows):
+        rows = list(rows)
+        pks = [row['pk'] for row in rows]
+        extra = {}
+
+        if self.derivative_columns:
+            names = {row[column] for row in rows for column in self.derivative_columns} - {None, ''}
+            self._derivatives = load_derivatives(names)
+
+        for name, through, source_column, target_column in self.many_related:
+            grouped = defaultdict(list)
+            links = through.objects.filter(**{f'{source_column}__in': pks}).order_by(source_column, target_column)
+            for source, target in links.values_list(source_column, target_column):
+                grouped[source].append(target)
+            extra[name] = grouped
+
+        for name, related_model, child_class, fk_name in self.nested_fields:
+            child = child_class(context=self.context)
+            children = related_model.objects.filter(**{f'{fk_name}__in': pks}).order_by('pk')
+            children = children.filter(**self.context.get('nested_filters', {}).get(name, {}))
+            child_rows = list(children.values(*child.columns, fk_name))
+            grouped = defaultdict(list)
+            for parent, data in zip((row[fk_name] for row in child_rows), child.render(child_rows)):
+                grouped[parent].append(data)
+            extra[name] = grouped
+
+        result = []
+        for row in rows:
+            data = {}
+            for name, column, converter in self.fields:
+                if column is None:
+                    data[name] = extra[name].get(row['pk'], [])
+                    continue
+                value = row[column]
+                data[name] = value if value is None or converter is None else converter(value)
+            result.append(data)
+        return result
+
+
+class CompiledProductSerializer(CompiledSerializer):
+    serializer_class = ProductSerializer
+    related_lookups = {'user': 'user__username'}
+
+
+class CompiledOrderItemSerializer(CompiledSerializer):
+    serializer_class = OrderItemSerializer
+
+
+class CompiledOrderSerializer(CompiledSerializer):
+    serializer_class = OrderSerializer
+    related_lookups = {'user': 'user__username'}
+    nested = {'items': (CompiledOrderItemSerializer, 'order_id')}
@@ -0,0 +1,47 @@
+import django_filters
+from rest_framework.filters import OrderingFilter
+
+from .models import Order, OrderItem, Product
+
+
+class OrderFilter(django_filters.FilterSet):
+    created_after = django_filters.IsoDateTimeFilter(field_name='created_at', lookup_expr='gte')
+    created_before = django_filters.IsoDateTimeFilter(field_name='created_at', lookup_expr='lt')
+    # Orders with lines of the caller in this status, for sellers
+    item_status = django_filters.ChoiceFilter(choices=OrderItem.STATUS_CHOICES, method='filter_item_status')
+
+    class Meta:
+        model = Order
+        fields = ['status', 'payment_status', 'created_after', 'created_before', 'item_status']
+
+    def filter_item_status(self, queryset, name, value):
+        items = OrderItem.objects.filter(seller=self.request.user, status=value)
+        return queryset.filter(id__in=items.values('order_id'))
+
+
+class ProductFilter(django_filters.FilterSet):
+    # The shelf price: sale_price while a sale is active, like the price shown
+    price = django_filters.NumberFilter(field_name='effective_price')
+
+    class Meta:
+        model = Product
+        fields = {
+            'category__name': ['exact'],
+            'status': ['exact'],
+            'stock': ['exact'],
+            'effective_price': ['exact', 'gte', 'lte'],
+        }
+
+
+class AliasOrderingFilter(OrderingFilter):
+    """OrderingFilter that sorts the fields named in the view's `ordering_aliases` by another field."""
+
+    def get_ordering(self, request, queryset, view):
+        ordering = super().get_ordering(request, queryset, view)
+        aliases = getattr(view, 'ordering_aliases', {})
+        if not ordering or not aliases:
+            return ordering
+        return [
+            ('-' if field.startswith('-') else '') + aliases.get(field.lstrip('-'), field.lstrip('-'))
+            for field in ordering
+        ]
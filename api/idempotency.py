@@ -0,0 +1,157 @@
+import hashlib
+import json
+import time
+import zlib
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+
+from .models import IdempotencyKey
+
+HEADER = 'Idempotency-Key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+KEPT_HEADERS = ('Location',)
+POLL_SECONDS = 0.05
+
+# A key is claimed by inserting its IdempotencyKey row, committed before the
+# request runs: the unique constraint lets exactly one request win, on every
+# worker and host. Duplicates sent while it runs wait for its response
+# instead of running again. Responses are kept as zlib compressed JSON for
+# IDEMPOTENCY_KEY_TTL, and copied to the default cache. That cache is
+# local to each process by default, so a retry storm costs one query per
+# process before the rest are answered from memory. Requests that raise or
+# answer with a 5xx release the key, their transaction was rolled back and
+# a retry may run again. A claim whose request died is taken over after
+# IDEMPOTENCY_LOCK_SECONDS. The claim is not extended while the request
+# runs, so a request still running by then can be run a second time.
+
+
+def _fingerprint(request):
+    data = request.data
+    if hasattr(data, 'lists'):
+        data = dict(data.lists())
+    # Uploaded files count by name and size
+    payload = json.dumps(
+        [request.method, request.path, data], sort_keys=True,
+        default=lambda value: [getattr(value, 'name', None), getattr(value, 'size', None)],
+    )
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+
+def _replay(status_code, body):
+    data, headers = json.loads(zlib.decompress(body))
+    response = Response(data, status=status_code, headers=headers)
+    response[REPLAYED_HEADER] = 'true'
+    return response
+
+
+def _claim(key, fingerprint, now):
+    """The IdempotencyKey row of `key` and whether this request claimed it."""
+    locked_until = now + timedelta(seconds=settings.IDEMPOTENCY_LOCK_SECONDS)
+    try:
+        with transaction.atomic():
+            return IdempotencyKey.objects.create(
+                key=key, fingerprint=fingerprint, locked_until=locked_until,
+                expires_at=now + timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL),
+            ), True
+    except IntegrityError:
+        pass
+    row = IdempotencyKey.objects.filter(key=key).first()
+    if row is None:
+        return None, False
+    if row.expires_at <= now or (row.status_code is None and row.locked_until <= now):
+        # Expired, or its request died: taken over by whoever updates it first
+        taken = IdempotencyKey.objects.filter(
+            pk=row.pk, status_code=row.status_code, locked_until=row.locked_until
+        ).update(
+            fingerprint=fingerprint, status_code=None, response=None, locked_until=locked_until,
+            expires_at=now + timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL),
+        )
+        if taken:
+            row.refresh_from_db()
+            return row, True
+        return None, False
+    return row, False
+
+
+def run_once(request, key, handler, exclude=()):
+    """
+    Return the response of `handler` for the first request with `key`, and
+    replay it for the others. Top level response fields in `exclude`, e.g.
+    credentials, are left out of the stored response.
+    """
+    if not 0 < len(key) <= 255:
+        raise ValidationError({HEADER: ['Must be 1 to 255 characters long.']})
+    owner = request.user.pk if request.user.is_authenticated else 'anonymous'
+    key = hashlib.sha1(f'{request.path}:{owner}:{key}'.encode()).hexdigest()
+    fingerprint = _fingerprint(request)
+    cache_key = f'idempotency:{key}'
+
+    deadline = time.monotonic() + settings.IDEMPOTENCY_WAIT_SECONDS
+    while True:
+        row = cache.get(cache_key)
+        claimed = False
+        if row is None:
+            row, claimed = _claim(key, fingerprint, timezone.now())
+        if claimed:
+            break
+        if row is not None:
+            if row.fingerprint != fingerprint:
+                return Response(
+                    {'detail': f'This {HEADER} was already used for a different request.'},
+                    status=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                )
+            if row.status_code is not None:
+                cache.set(cache_key, row, max((row.expires_at - timezone.now()).total_seconds(), 1))
+                return _replay(row.status_code, bytes(row.response))
+        if time.monotonic() >= deadline:
+            return Response(
+                {'detail': f'A request with this {HEADER} is still in progress.'},
+                status=status.HTTP_409_CONFLICT, headers={'Retry-After': '1'},
+            )
+        time.sleep(POLL_SECONDS)
+
+    try:
+        response = handler()
+    except Exception:
+        IdempotencyKey.objects.filter(pk=row.pk, status_code__isnull=True).delete()
+        raise
+    if response.status_code >= 500:
+        IdempotencyKey.objects.filter(pk=row.pk, status_code__isnull=True).delete()
+        return response
+    data = response.data
+    if exclude and isinstance(data, dict):
+        data = {field: value for field, value in data.items() if field not in exclude}
+    headers = {name: response[name] for name in KEPT_HEADERS if name in response}
+    IdempotencyKey.objects.filter(pk=row.pk).update(
+        status_code=response.status_code,
+        response=zlib.compress(json.dumps([data, headers], cls=JSONEncoder, separators=(',', ':')).encode()),
+    )
+    return response
+
+
+def purge_idempotency_keys(now=None):
+    return IdempotencyKey.objects.filter(expires_at__lte=now or timezone.now()).delete()[0]
+
+
+class IdempotentMixin:
+    """
+    Runs POST requests that carry an Idempotency-Key header at most once per
+    caller and key. Response fields named in `idempotency_exclude` are not
+    stored and so not replayed.
+    """
+    idempotency_exclude = ()
+
+    def post(self, request, *args, **kwargs):
+        handler = super().post
+        key = request.headers.get(HEADER)
+        if key is None:
+            return handler(request, *args, **kwargs)
+        return run_once(request, key, lambda: handler(request, *args, **kwargs), self.idempotency_exclude)
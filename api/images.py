@@ -0,0 +1,133 @@
+import hashlib
+import io
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+from .models import Brand, Category, ImageDerivative, Product, ProductImage, Store, User
+from .storage import content_addressed_storage
+from .tasks import enqueue, handler
+
+# Image fields that get thumbnails, per model
+IMAGE_FIELDS = {
+    Product: ('main_image',),
+    ProductImage: ('image',),
+    Category: ('image',),
+    Brand: ('brand_logo',),
+    Store: ('store_logo',),
+    User: ('profile_picture',),
+}
+
+EXTENSIONS = {'JPEG': 'jpg', 'WEBP': 'webp'}
+
+
+def derivative_name(content_hash, variant, image_format):
+    return f'derivatives/{content_hash[:2]}/{content_hash}-{variant}.{EXTENSIONS[image_format]}'
+
+
+def _prepare(image, image_format):
+    if image_format == 'JPEG':
+        return image if image.mode in ('RGB', 'L') else image.convert('RGB')
+    if image.mode in ('RGB', 'RGBA'):
+        return image
+    has_alpha = 'A' in image.mode or 'transparency' in image.info
+    return image.convert('RGBA' if has_alpha else 'RGB')
+
+
+def generate_derivatives(name, storage=default_storage):
+    """
+    Render every configured variant and format of the image stored as `name`
+    in `storage`. Derivatives themselves always go to the default storage.
+
+    Files are named after the sha256 of the original, so re-uploads of the same
+    picture share their derivatives and the URLs can be cached forever.
+    """
+    existing = set(ImageDerivative.objects.filter(source=name).values_list('variant', 'format'))
+    wanted = [
+        (variant, image_format)
+        for variant in settings.IMAGE_DERIVATIVE_SIZES
+        for image_format in settings.IMAGE_DERIVATIVE_FORMATS
+        if (variant, image_format) not in existing
+    ]
+    if not wanted:
+        return 0
+
+    with storage.open(name, 'rb') as source:
+        data = source.read()
+    content_hash = hashlib.sha256(data).hexdigest()
+
+    derivatives = []
+    with Image.open(io.BytesIO(data)) as original:
+        original = ImageOps.exif_transpose(original)
+        for variant, image_format in wanted:
+            size = settings.IMAGE_DERIVATIVE_SIZES[variant]
+            image = original.copy()
+            image.thumbnail((size, size), Image.LANCZOS)
+            image = _prepare(image, image_format)
+
+            target = derivative_name(content_hash, variant, image_format)
+            if not default_storage.exists(target):
+                buffer = io.BytesIO()
+                image.save(buffer, image_format, quality=settings.IMAGE_DERIVATIVE_QUALITY)
+                saved = default_storage.save(target, ContentFile(buffer.getvalue()))
+                if saved != target:
+                    # Another worker wrote the same derivative in the meantime.
+                    default_storage.delete(saved)
+
+            derivatives.append(ImageDerivative(
+                source=name, variant=variant, format=image_format, image=target,
+                width=image.width, height=image.height, content_hash=content_hash,
+            ))
+
+    ImageDerivative.objects.bulk_create(derivatives, ignore_conflicts=True)
+    return len(derivatives)
+
+
+def load_derivatives(names):
+    """Map each source name to {variant: {format: storage name}} in one query."""
+    derivatives = defaultdict(lambda: defaultdict(dict))
+    rows = ImageDerivative.objects.filter(source__in=set(names)).values_list('source', 'variant', 'format', 'image')
+    for source, variant, image_format, image in rows:
+        derivatives[source][variant][image_format] = image
+    return derivatives
+
+
+def derivative_urls(entry, request=None):
+    if not entry:
+        return None
+
+    urls = {}
+    for variant in settings.IMAGE_DERIVATIVE_SIZES:
+        formats = entry.get(variant)
+        if not formats:
+            continue
+        urls[variant] = {}
+        for image_format in settings.IMAGE_DERIVATIVE_FORMATS:
+            if image_format in formats:
+                url = default_storage.url(formats[image_format])
+                urls[variant][image_format.lower()] = request.build_absolute_uri(url) if request else url
+    return urls or None
+
+
+# Background tasks, images are never processed on the request thread. Payloads
+# name the storage of the original, see STORAGES.
+
+STORAGES = {'default': default_storage, 'content_addressed': content_addressed_storage}
+
+
+@handler('image_derivatives')
+def generate_queued_derivatives(payloads):
+    # Identical uploads share a name, they only need to be processed once
+    for name, storage in dict.fromkeys((payload['name'], payload['storage']) for payload in payloads):
+        generate_derivatives(name, STORAGES[storage])
+
+
+def schedule_derivatives(name, storage=default_storage):
+    """Queue the derivatives of `name`, in the transaction of the upload."""
+    keys = [key for key, known in STORAGES.items() if known is storage]
+    if not keys:
+        raise ValueError(f'Derivatives of {name} are in an unknown storage {storage!r}')
+    enqueue('image_derivatives', {'name': name, 'storage': keys[0]})
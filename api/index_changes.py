@@ -0,0 +1,45 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import IndexChange
+
+# Workers keep indexes in memory, e.g. of promotions, and are not told of
+# writes made by other workers. Writes append the keys they change to
+# the IndexChange table, in their own transaction, and each index remembers
+# the last change id it has applied: a lookup first applies the newer
+# changes, one indexed query when there are none. An index notes the latest
+# id before it loads the database, and a rebuild applies the changes made
+# while it ran before it is swapped in. Changes are kept for
+# INDEX_CHANGE_RETENTION_SECONDS, indexes older than that are rebuilt.
+
+
+def record(index, keys):
+    IndexChange.objects.bulk_create([IndexChange(index=index, key=str(key)) for key in keys])
+
+
+def latest():
+    """Id of the latest change of any index, 0 when there is none."""
+    return IndexChange.objects.order_by('-id').values_list('id', flat=True).first() or 0
+
+
+def since(index, seen):
+    """Id of the latest change of `index` after `seen`, or `seen`, and the keys they changed."""
+    keys = set()
+    for change_id, key in IndexChange.objects.filter(index=index, id__gt=seen).order_by('id').values_list(
+        'id', 'key'
+    ):
+        seen = change_id
+        keys.add(key)
+    return seen, keys
+
+
+def expired(built_at):
+    """Whether an index built at `built_at`, a timestamp, may have missed purged changes."""
+    return built_at < (timezone.now() - timedelta(seconds=settings.INDEX_CHANGE_RETENTION_SECONDS)).timestamp()
+
+
+def purge():
+    cutoff = timezone.now() - timedelta(seconds=settings.INDEX_CHANGE_RETENTION_SECONDS)
+    return IndexChange.objects.filter(created_at__lt=cutoff).delete()[0]
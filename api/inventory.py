@@ -0,0 +1,252 @@
+import math
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import Order, Product, StockProduct, StockReservation
+from .recommendations import void_orders
+
+STRATEGIES = ('nearest', 'largest')
+
+
+class InsufficientStock(Exception):
+    def __init__(self, available):
+        # Units that could be reserved, per product id that is short
+        self.available = available
+        super().__init__(f'Not enough stock for products {sorted(available)}')
+
+
+class _Conflict(Exception):
+    pass
+
+
+def _distance_km(origin, latitude, longitude):
+    lat1, lon1, lat2, lon2 = map(math.radians, (*origin, latitude, longitude))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 12742 * math.asin(math.sqrt(a))
+
+
+def _allocation_order(rows, strategy, destination):
+    if strategy == 'nearest' and destination is not None:
+        # Warehouses without coordinates come last, each group largest first
+        def key(row):
+            if row['stock__latitude'] is None or row['stock__longitude'] is None:
+                return (math.inf, -row['quantity'], row['id'])
+            distance = _distance_km(destination, float(row['stock__latitude']), float(row['stock__longitude']))
+            return (distance, -row['quantity'], row['id'])
+    else:
+        def key(row):
+            return (-row['quantity'], row['id'])
+    return sorted(rows, key=key)
+
+
+def _by_id(amounts):
+    return Case(*[When(id=pk, then=Value(amount)) for pk, amount in amounts.items()], output_field=IntegerField())
+
+
+def _decrement(queryset, field, amounts):
+    # One UPDATE that only touches rows still holding enough, no value is read first
+    wanted = _by_id(amounts)
+    return queryset.filter(id__in=amounts, **{f'{field}__gte': wanted}).update(**{field: F(field) - wanted})
+
+
+def _increment(queryset, field, amounts):
+    if amounts:
+        queryset.filter(id__in=amounts).update(**{field: F(field) + _by_id(amounts)})
+
+
+def reserve_stock(order, quantities, destination=None, strategy=None, hold_seconds=None):
+    """
+    Take `quantities` ({product id: units}) out of the active warehouses for
+    `order` and return the StockReservation rows.
+
+    Each product is split across its warehouse rows in the order of
+    `strategy`: 'nearest' to `destination` (latitude, longitude), or
+    'largest' on hand first. Products without warehouse rows are reserved on
+    Product.stock alone. The reservations are held for `hold_seconds`, or
+    committed right away when it is None.
+
+    Raises InsufficientStock when a product is short. When a concurrent
+    reservation empties a planned row first the plan is made again.
+    """
+    strategy = strategy or settings.STOCK_ALLOCATION_STRATEGY
+    if strategy not in STRATEGIES:
+        raise ValueError(f'Unknown allocation strategy {strategy!r}')
+    attempts = settings.STOCK_RESERVATION_ATTEMPTS
+    for attempt in range(attempts):
+        try:
+            with transaction.atomic():
+                return _reserve(order, quantities, destination, strategy, hold_seconds, last=attempt == attempts - 1)
+        except _Conflict:
+            continue
+
+
+def _reserve(order, quantities, destination, strategy, hold_seconds, last):
+    rows = defaultdict(list)
+    for row in StockProduct.objects.filter(product_id__in=quantities).values(
+        'id', 'product_id', 'quantity', 'stock__is_active', 'stock__latitude', 'stock__longitude'
+    ):
+        rows[row['product_id']].append(row)
+
+    if hold_seconds is None:
+        status, expires_at = 'COMMITTED', None
+    else:
+        status, expires_at = 'HELD', timezone.now() + timedelta(seconds=hold_seconds)
+
+    taken, reservations, available = {}, [], {}
+    for product_id, wanted in quantities.items():
+        if product_id not in rows:
+            reservations.append(StockReservation(
+                order=order, product_id=product_id, quantity=wanted, status=status, expires_at=expires_at
+            ))
+            continue
+        candidates = [row for row in rows[product_id] if row['stock__is_active'] and row['quantity'] > 0]
+        remaining = wanted
+        for row in _allocation_order(candidates, strategy, destination):
+            units = min(remaining, row['quantity'])
+            taken[row['id']] = units
+            reservations.append(StockReservation(
+                order=order, product_id=product_id, stock_product_id=row['id'], quantity=units,
+                status=status, expires_at=expires_at,
+            ))
+            remaining -= units
+            if not remaining:
+                break
+        if remaining:
+            available[product_id] = wanted - remaining
+    if available:
+        raise InsufficientStock(available)
+
+    if taken and _decrement(StockProduct.objects, 'quantity', taken) != len(taken):
+        if not last:
+            raise _Conflict
+        left = StockProduct.objects.filter(id__in=taken).values('product_id').annotate(total=Sum('quantity'))
+        raise InsufficientStock({row['product_id']: row['total'] for row in left})
+    # Product.stock is the total of the warehouse rows, or the stock itself without any
+    if _decrement(Product.objects, 'stock', quantities) != len(quantities):
+        wanted = _by_id(quantities)
+        raise InsufficientStock(dict(
+            Product.objects.filter(id__in=quantities, stock__lt=wanted).values_list('id', 'stock')
+        ))
+    return StockReservation.objects.bulk_create(reservations)
+
+
+def commit_reservations(order_ids):
+    """Keep the held stock of paid orders for good."""
+    return StockReservation.objects.filter(order_id__in=order_ids, status='HELD').update(
+        status='COMMITTED', expires_at=None
+    )
+
+
+def release_expired_holds(now=None, batch_size=500):
+    """
+    Return the units of expired holds to their warehouses and products and
+    cancel the orders they were held for if still unpaid, one batch per
+    transaction. Returns the number of released reservations.
+    """
+    now = now or timezone.now()
+    released = 0
+    while True:
+        with transaction.atomic():
+            holds = list(
+                StockReservation.objects.select_for_update()
+                .filter(status='HELD', expires_at__lte=now).order_by('expires_at')
+                .values_list(
+                    'id', 'order_id', 'product_id', 'stock_product_id', 'stock_product__stock__is_active', 'quantity'
+                )[:batch_size]
+            )
+            if not holds:
+                return released
+            rows, products = defaultdict(int), defaultdict(int)
+            for _, _, product_id, stock_product_id, active, quantity in holds:
+                if stock_product_id:
+                    rows[stock_product_id] += quantity
+                # Inactive warehouses are left out of Product.stock
+                if not stock_product_id or active:
+                    products[product_id] += quantity
+            _increment(StockProduct.objects, 'quantity', rows)
+            _increment(Product.objects, 'stock', products)
+            StockReservation.objects.filter(id__in=[hold[0] for hold in holds]).update(status='RELEASED')
+            canceled = list(Order.objects.filter(
+                id__in={hold[1] for hold in holds}, status='PENDING', payment_status='UNPAID'
+            ).values_list('id', flat=True))
+            Order.objects.filter(id__in=canceled).update(status='CANCELED')
+            # Bulk updates send no signals
+            void_orders(canceled)
+            released += len(holds)
+
+
+def next_expiry_at():
+    return StockReservation.objects.filter(status='HELD').order_by('expires_at').values_list(
+        'expires_at', flat=True
+    ).first()
+
+
+def sync_product_stock(product_ids):
+    """Set Product.stock to the total of the product's rows in active warehouses."""
+    total = StockProduct.objects.filter(product=OuterRef('pk'), stock__is_active=True).values('product').annotate(
+        total=Sum('quantity')
+    ).values('total')
+    return Product.objects.filter(id__in=product_ids).update(stock=Coalesce(Subquery(total), 0))
+
+
+def _offers(choices, value):
+    # Products without a list of sizes or colors are not restricted
+    if not value or not choices:
+        return True
+    return value.strip().lower() in {choice.strip().lower() for choice in choices.split(',')}
+
+
+def availability(ids=(), skus=(), size=None, color=None):
+    """
+    Stock of many products at once, looked up by id or SKU, in two grouped
+    queries: one per product and one per warehouse row.
+
+    `available` can be ordered now, `reserved` is held for unpaid orders and
+    `on_hand` is both together. Stock is not tracked per size or color, a
+    product that does not come in the requested `size` or `color` has
+    `offered` false and nothing available.
+    """
+    held = Q(reservations__status='HELD')
+    products = list(
+        Product.objects.filter(Q(id__in=ids) | Q(sku__in=skus))
+        .annotate(reserved=Coalesce(Sum('reservations__quantity', filter=held), 0))
+        .values('id', 'sku', 'stock', 'sizes', 'colors', 'reserved')
+    )
+    warehouses = defaultdict(list)
+    rows = (
+        StockProduct.objects.filter(product_id__in=[product['id'] for product in products], stock__is_active=True)
+        .annotate(reserved=Coalesce(Sum('reservations__quantity', filter=held), 0))
+        .values('product_id', 'stock_id', 'stock__name', 'quantity', 'reserved')
+        .order_by('product_id', 'stock_id')
+    )
+    for row in rows:
+        warehouses[row['product_id']].append({
+            'warehouse': row['stock_id'],
+            'name': row['stock__name'],
+            'on_hand': row['quantity'] + row['reserved'],
+            'reserved': row['reserved'],
+            'available': row['quantity'],
+        })
+
+    results = []
+    for product in products:
+        offered = _offers(product['sizes'], size) and _offers(product['colors'], color)
+        results.append({
+            'product': product['id'],
+            'sku': product['sku'],
+            'offered': offered,
+            'on_hand': product['stock'] + product['reserved'],
+            'reserved': product['reserved'],
+            'available': product['stock'] if offered else 0,
+            'warehouses': warehouses[product['id']],
+        })
+    found_ids = {product['id'] for product in products}
+    found_skus = {product['sku'] for product in products}
+    missing = [pk for pk in ids if pk not in found_ids] + [sku for sku in skus if sku not in found_skus]
+    return {'results': results, 'missing': missing}
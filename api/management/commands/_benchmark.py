@@ -0,0 +1,68 @@
+from contextlib import contextmanager
+from decimal import Decimal
+
+from django.db import transaction
+from django.utils import timezone
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from api.models import Category, Order, OrderItem, Product, Tag, User
+
+
+# Shared fixtures for the bench_* commands. Rows are seeded inside a
+# transaction that is always rolled back, so the commands are safe to run
+# against a real database.
+
+
+class _Rollback(Exception):
+    pass
+
+
+def benchmark_context():
+    return {'request': Request(APIRequestFactory().get('/api/', HTTP_HOST='localhost'))}
+
+
+@contextmanager
+def seeded(rows):
+    try:
+        with transaction.atomic():
+            _seed(rows)
+            yield (
+                Product.objects.filter(sku__startswith='bench-').order_by('id'),
+                Order.objects.filter(note='bench').order_by('id'),
+            )
+            raise _Rollback
+    except _Rollback:
+        pass
+
+
+def _seed(rows):
+    user = User.objects.create(username='bench-user')
+    category = Category.objects.create(name='Bench', slug='bench-category')
+    tags = [Tag.objects.create(name=f'bench-{i}', slug=f'bench-{i}') for i in range(3)]
+    now = timezone.now()
+
+    products = Product.objects.bulk_create([
+        Product(
+            user=user, name=f'Bench product {i}', sku=f'bench-{i}', slug=f'bench-product-{i}',
+            description='Áo thun cotton – benchmark product', category=category, price=Decimal('199000.00'),
+            sale_price=Decimal('149000.50'), start_sale_date=now, stock=i, weight=Decimal('0.35'),
+            main_image=f'product_images/bench-{i}.jpg',
+        )
+        for i in range(rows)
+    ])
+    Product.tags.through.objects.bulk_create([
+        Product.tags.through(product_id=product.id, tag_id=tag.id) for product in products for tag in tags
+    ])
+
+    for i in range(rows):
+        order = Order.objects.create(
+            user=user, order_number=f'BENCH{i}', subtotal_price=Decimal('447000.00'),
+            total_price=Decimal('477000.00'), payment_method='COD', note='bench',
+        )
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=product, seller=user, quantity=1, price=product.price,
+                      total_price=product.price, size='M', weight=Decimal('0.35'))
+            for product in products[:3]
+        ])
+
@@ -0,0 +1,55 @@
+import secrets
+import time
+
+from django.core.management.base import BaseCommand
+
+from api import carts
+from api.models import Cart
+
+from ._benchmark import seeded
+
+
+def _percentile(samples, percent):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * percent / 100))]
+
+
+class Command(BaseCommand):
+    help = 'Measure cart operation latency against the cart cache, and the cost of flushing a cart to the database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--operations', type=int, default=2000)
+        parser.add_argument('--lines', type=int, default=20, help='Distinct products in the cart.')
+
+    def handle(self, *args, **options):
+        owner = ('session', f'bench-{secrets.token_hex(8)}')
+        # Changes make no database writes, the cart is flushed once at the end
+        with seeded(options['lines']) as (products, _):
+            product_ids = list(products.values_list('id', flat=True))
+            for product_id in product_ids:
+                carts.add_item(owner, product_id, size='M')
+
+            timings = {'add_item': [], 'update_item': [], 'get_cart': []}
+            for position in range(options['operations']):
+                product_id = product_ids[position % len(product_ids)]
+                for name, operation in (
+                    ('add_item', lambda: carts.add_item(owner, product_id, size='M')),
+                    ('update_item', lambda: carts.update_item(owner, product_id, size='M', quantity=2)),
+                    ('get_cart', lambda: carts.get_cart(owner)),
+                ):
+                    started = time.perf_counter()
+                    operation()
+                    timings[name].append((time.perf_counter() - started) * 1e6)
+            for name, samples in timings.items():
+                self.stdout.write(
+                    f'{name}: p50 {_percentile(samples, 50):.0f} us, p99 {_percentile(samples, 99):.0f} us'
+                )
+
+            started = time.perf_counter()
+            carts.flush(owner)
+            self.stdout.write(
+                f'flush of {len(product_ids)} lines after {3 * options["operations"]} operations: '
+                f'{(time.perf_counter() - started) * 1000:.1f} ms'
+            )
+        carts._cache().delete_many([carts._key(owner), f'{carts._key(owner)}:dirty'])
+        Cart.objects.filter(session_key=owner[1]).delete()
@@ -0,0 +1,62 @@
+import multiprocessing
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.order_numbers import OrderNumberGenerator
+
+
+def _generate(worker_id, count, threads):
+    generator = OrderNumberGenerator(worker_id)
+    results = [None] * threads
+
+    def run(slot):
+        results[slot] = [generator() for _ in range(count // threads)]
+
+    workers = [threading.Thread(target=run, args=(slot,)) for slot in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return [number for numbers in results for number in numbers]
+
+
+class Command(BaseCommand):
+    help = 'Measure order number throughput and check that ids from concurrent threads and processes never clash.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=200000, help='Ids per process.')
+        parser.add_argument('--threads', type=int, default=8, help='Threads per process.')
+        parser.add_argument('--processes', type=int, default=4)
+        parser.add_argument(
+            '--same-worker', action='store_true',
+            help='Give every process the same worker id, as when ORDER_NUMBER_WORKER_ID is misconfigured.',
+        )
+
+    def handle(self, *args, **options):
+        count, threads, processes = options['count'], options['threads'], options['processes']
+
+        started = time.perf_counter()
+        single = _generate(0, count, 1)
+        elapsed = time.perf_counter() - started
+        self.stdout.write(f'1 thread: {len(single) / elapsed:,.0f} ids/s, e.g. {single[0]}')
+        if single != sorted(single):
+            raise CommandError('Ids from one thread are not increasing.')
+
+        jobs = [(0 if options['same_worker'] else worker_id, count, threads) for worker_id in range(processes)]
+        started = time.perf_counter()
+        with multiprocessing.get_context('spawn').Pool(processes) as pool:
+            batches = pool.starmap(_generate, jobs)
+        elapsed = time.perf_counter() - started
+        numbers = [number for batch in batches for number in batch]
+        self.stdout.write(
+            f'{processes} processes x {threads} threads: {len(numbers) / elapsed:,.0f} ids/s including process startup'
+        )
+
+        if max(len(number) for number in numbers) > 20:
+            raise CommandError('Ids are longer than 20 characters.')
+        duplicates = len(numbers) - len(set(numbers))
+        if duplicates:
+            raise CommandError(f'{duplicates} duplicate ids.')
+        self.stdout.write(self.style.SUCCESS(f'{len(numbers):,} ids, no duplicates'))
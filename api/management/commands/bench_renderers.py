@@ -0,0 +1,67 @@
+import io
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+
+from api import renderers
+from api.parsers import FastJSONParser
+from api.renderers import FastJSONRenderer
+from api.serializers import OrderSerializer, ProductSerializer
+
+from ._benchmark import benchmark_context, seeded
+
+
+class Command(BaseCommand):
+    help = 'Compare FastJSONRenderer/FastJSONParser against the stdlib JSON renderer and parser.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=100, help='Rows per payload.')
+        parser.add_argument('--repeat', type=int, default=200, help='Timed iterations per payload.')
+
+    def handle(self, *args, **options):
+        if renderers.orjson is None:
+            self.stdout.write('orjson is not installed, FastJSONRenderer falls back to the stdlib renderer.')
+
+        rows, repeat = options['rows'], options['repeat']
+        context = benchmark_context()
+
+        with seeded(rows) as (products, orders):
+            payloads = {
+                'products': {'count': rows, 'results': ProductSerializer(products, many=True, context=context).data},
+                'orders': {'count': rows, 'results': OrderSerializer(orders, many=True, context=context).data},
+            }
+
+        for label, data in payloads.items():
+            self.compare(label, data, repeat)
+
+    def compare(self, label, data, repeat):
+        stdlib, fast = JSONRenderer(), FastJSONRenderer()
+        body = stdlib.render(data)
+        if fast.render(data) != body:
+            raise CommandError(f'FastJSONRenderer output differs from JSONRenderer for {label}.')
+        if FastJSONParser().parse(io.BytesIO(body)) != JSONParser().parse(io.BytesIO(body)):
+            raise CommandError(f'FastJSONParser output differs from JSONParser for {label}.')
+
+        render = {
+            'stdlib': self.time(repeat, lambda: stdlib.render(data)),
+            'fast': self.time(repeat, lambda: fast.render(data)),
+        }
+        parse = {
+            'stdlib': self.time(repeat, lambda: JSONParser().parse(io.BytesIO(body))),
+            'fast': self.time(repeat, lambda: FastJSONParser().parse(io.BytesIO(body))),
+        }
+        self.stdout.write(
+            f'{label} ({len(body) / 1024:.1f} KiB): '
+            f'render stdlib {render["stdlib"]:.1f} us, fast {render["fast"]:.1f} us '
+            f'({render["stdlib"] / render["fast"]:.1f}x); '
+            f'parse stdlib {parse["stdlib"]:.1f} us, fast {parse["fast"]:.1f} us '
+            f'({parse["stdlib"] / parse["fast"]:.1f}x)'
+        )
+
+    def time(self, repeat, func):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            func()
+        return (time.perf_counter() - start) / repeat * 1e6
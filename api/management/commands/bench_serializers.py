@@ -0,0 +1,48 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.renderers import JSONRenderer
+
+from api.fast_serializers import CompiledOrderSerializer, CompiledProductSerializer
+from api.serializers import OrderSerializer, ProductSerializer
+
+from ._benchmark import benchmark_context, seeded
+
+
+class Command(BaseCommand):
+    help = 'Compare per-row cost of the compiled list serializers against the DRF serializers.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=100, help='Rows per page to serialize.')
+        parser.add_argument('--repeat', type=int, default=20, help='Timed iterations per serializer.')
+
+    def handle(self, *args, **options):
+        rows, repeat = options['rows'], options['repeat']
+        context = benchmark_context()
+
+        with seeded(rows) as (products, orders):
+            self.compare('products', rows, repeat,
+                         lambda: ProductSerializer(list(products), many=True, context=context).data,
+                         lambda: CompiledProductSerializer(context).render(
+                             CompiledProductSerializer(context).values(products)))
+            self.compare('orders', rows, repeat,
+                         lambda: OrderSerializer(list(orders), many=True, context=context).data,
+                         lambda: CompiledOrderSerializer(context).render(
+                             CompiledOrderSerializer(context).values(orders)))
+
+    def compare(self, label, rows, repeat, baseline, compiled):
+        renderer = JSONRenderer()
+        if renderer.render(baseline()) != renderer.render(compiled()):
+            raise CommandError(f'Compiled {label} output differs from the DRF serializer.')
+
+        timings = {}
+        for name, func in (('drf', baseline), ('compiled', compiled)):
+            start = time.perf_counter()
+            for _ in range(repeat):
+                func()
+            timings[name] = (time.perf_counter() - start) / (repeat * rows) * 1e6
+
+        self.stdout.write(
+            f'{label}: drf {timings["drf"]:.1f} us/row, compiled {timings["compiled"]:.1f} us/row '
+            f'({timings["drf"] / timings["compiled"]:.1f}x), output identical'
+        )
@@ -0,0 +1,67 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from api.suggest import SuggestIndex
+
+WORDS = (
+    'ao thun so mi quan jean kaki short vay dam chan khoac len hoodie polo tank top cotton linen lua '
+    'den trang do xanh vang hong nau xam be basic oversize slim regular form rong nam nu tre em unisex '
+    'classic vintage sport premium summer winter denim knit striped plain graphic cargo jogger blazer'
+).split()
+
+
+def _percentile(samples, percent):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * percent / 100))]
+
+
+class Command(BaseCommand):
+    help = 'Measure search suggestion latency on a synthetic catalogue, without touching the database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=100000, help='Synthetic products to index.')
+        parser.add_argument('--queries', type=int, default=20000, help='Random prefixes to look up.')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        start = time.perf_counter()
+        index = SuggestIndex()
+        index.start_build()
+        for category_id in range(200):
+            index.update_group('category', category_id, ' '.join(rng.sample(WORDS, 2)))
+        for tag_id in range(1000):
+            index.update_group('tag', tag_id, ' '.join(rng.sample(WORDS, 2)))
+        for product_id in range(options['products']):
+            index.update_product(
+                product_id, ' '.join(rng.sample(WORDS, rng.randint(2, 5))), rng.randint(0, 5000),
+                rng.randrange(200), rng.choice(WORDS).title(), rng.sample(range(1000), 3),
+            )
+        index.finish_build()
+        self.stdout.write(f'Built {len(index.keys)} keys in {time.perf_counter() - start:.2f}s')
+
+        labels = list(index.labels.values())
+        prefixes = []
+        for _ in range(options['queries']):
+            label = rng.choice(labels).lower()
+            prefixes.append(label[:rng.randint(1, min(len(label), 12))])
+
+        for name in ('first', 'repeated'):
+            timings = []
+            for prefix in prefixes:
+                started = time.perf_counter()
+                index.suggest(prefix)
+                timings.append((time.perf_counter() - started) * 1e6)
+            self.stdout.write(
+                f'suggest {name}: p50 {_percentile(timings, 50):.0f} us, p99 {_percentile(timings, 99):.0f} us, '
+                f'max {max(timings):.0f} us'
+            )
+
+        timings = []
+        for product_id in rng.sample(range(options['products']), 2000):
+            started = time.perf_counter()
+            index.update_product(product_id, ' '.join(rng.sample(WORDS, 3)), rng.randint(0, 5000), rng.randrange(200))
+            timings.append((time.perf_counter() - started) * 1e6)
+        self.stdout.write(f'update_product: p50 {_percentile(timings, 50):.0f} us, p99 {_percentile(timings, 99):.0f} us')
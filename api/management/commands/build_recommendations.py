@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from api.recommendations import fold_orders, rebuild_similar
+
+
+class Command(BaseCommand):
+    help = 'Fold new orders into the product co-occurrence counts and refresh "frequently bought together".'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild', action='store_true', help='Recount the whole order history.')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Orders counted per chunk.')
+        parser.add_argument('--settle-seconds', type=int, default=300,
+                            help='Leave orders younger than this for the next run.')
+        parser.add_argument('--top-k', type=int, help='Neighbours kept per product, RECOMMENDATION_TOP_K by default.')
+        parser.add_argument('--similar', action='store_true',
+                            help='Also rebuild the similar products index from tags, category, brand and price.')
+
+    def handle(self, *args, **options):
+        folded = fold_orders(
+            chunk_size=options['chunk_size'], settle_seconds=options['settle_seconds'],
+            rebuild=options['rebuild'], top_k=options['top_k'],
+        )
+        self.stdout.write(f'Folded {folded} orders into the co-occurrence counts.')
+
+        if options['similar']:
+            indexed = rebuild_similar(top_k=options['top_k'])
+            self.stdout.write(f'Indexed similar products of {indexed} products.')
@@ -0,0 +1,22 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api.suggest import SuggestIndex
+
+
+class Command(BaseCommand):
+    help = 'Build the search suggestion index and write the snapshot workers load at startup.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default=str(settings.SEARCH_SUGGEST_SNAPSHOT), help='Snapshot path.')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        index = SuggestIndex.build()
+        index.save_snapshot(options['output'])
+        self.stdout.write(
+            f'Indexed {len(index.labels)} suggestions under {len(index.keys)} keys '
+            f'in {time.perf_counter() - start:.2f}s, snapshot written to {options["output"]}.'
+        )
@@ -0,0 +1,72 @@
+from collections import Counter
+from datetime import timedelta
+
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from django.db import models, transaction
+from django.utils import timezone
+
+from api.models import StoredBlob
+from api.storage import content_addressed_storage, is_content_addressed
+
+
+class Command(BaseCommand):
+    help = 'Delete stored blobs that no file field references anymore, in batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Blobs examined per batch.')
+        parser.add_argument('--grace-minutes', type=int, default=60,
+                            help='Skip blobs uploaded more recently than this, their owner may not be saved yet.')
+        parser.add_argument('--dry-run', action='store_true', help='Report without deleting anything.')
+
+    def handle(self, *args, **options):
+        batch_size, dry_run = options['batch_size'], options['dry_run']
+        cutoff = timezone.now() - timedelta(minutes=options['grace_minutes'])
+        owners = [
+            (model, field.attname)
+            for model in apps.get_app_config('api').get_models()
+            for field in model._meta.concrete_fields
+            if isinstance(field, models.FileField) and is_content_addressed(field)
+        ]
+
+        last_id, deleted, repaired, kept, freed = 0, 0, 0, 0, 0
+        while True:
+            batch = list(
+                StoredBlob.objects.filter(ref_count=0, last_uploaded_at__lt=cutoff, id__gt=last_id)
+                .order_by('id').values_list('id', 'name', 'size')[:batch_size]
+            )
+            if not batch:
+                break
+            last_id = batch[-1][0]
+
+            # Counts are maintained by signals, which queryset updates bypass,
+            # so references are re-checked before anything is removed.
+            names = [name for _, name, _ in batch]
+            references = Counter()
+            for model, field in owners:
+                references.update(model.objects.filter(**{f'{field}__in': names}).values_list(field, flat=True))
+
+            orphans = [(blob_id, name, size) for blob_id, name, size in batch if not references[name]]
+            repaired += len(batch) - len(orphans)
+            if dry_run:
+                deleted += len(orphans)
+                freed += sum(size for _, _, size in orphans)
+                continue
+
+            with transaction.atomic():
+                for name, count in references.items():
+                    StoredBlob.objects.filter(name=name).update(ref_count=count)
+            for blob_id, name, size in orphans:
+                # Only while still unreferenced and not uploaded again since the batch was read
+                if not StoredBlob.objects.filter(id=blob_id, ref_count=0, last_uploaded_at__lt=cutoff).delete()[0]:
+                    kept += 1
+                    continue
+                content_addressed_storage.purge(name)
+                freed += size
+                deleted += 1
+
+        verb = 'Would delete' if dry_run else 'Deleted'
+        self.stdout.write(
+            f'{verb} {deleted} blobs ({freed / 1024 / 1024:.1f} MiB), repaired {repaired} reference counts, '
+            f'kept {kept} reused meanwhile.'
+        )
@@ -0,0 +1,166 @@
+import re
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, models, transaction
+from django.urls import get_resolver
+from django.utils import timezone
+from django_filters.rest_framework import DjangoFilterBackend
+from rest_framework import filters, mixins
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from api.models import User
+
+# SQLite reports a table read without index as "SCAN <table>" and a sort
+# that no index provides as "USE TEMP B-TREE FOR ORDER BY". A sort is only
+# flagged when it covers the whole table, sorting the rows an index search
+# returned is expected for filter and ordering combinations.
+FULL_SCAN = re.compile(r'\bSCAN (\w+)')
+TEMP_SORT = 'USE TEMP B-TREE FOR ORDER BY'
+
+
+def _sample_value(field):
+    if isinstance(field, models.BooleanField):
+        return True
+    if isinstance(field, (models.DateTimeField, models.DateField)):
+        return timezone.now()
+    if isinstance(field, models.DecimalField):
+        return Decimal('1')
+    if isinstance(field, (models.IntegerField, models.AutoField, models.ForeignKey)):
+        return 1
+    if field.choices:
+        return field.choices[0][0]
+    return 'x'
+
+
+def _filter_value(model, name, filter_):
+    choices = filter_.extra.get('choices')
+    if choices:
+        return choices[0][0]
+    value = _sample_value(_resolve_field(model, filter_.field_name or name))
+    return value.isoformat() if hasattr(value, 'isoformat') else str(value)
+
+
+def _resolve_field(model, path):
+    *relations, name = path.split('__')
+    for part in relations:
+        model = model._meta.get_field(part).related_model
+    return model._meta.get_field(name)
+
+
+def _list_views(resolver=None, prefix=''):
+    resolver = resolver or get_resolver()
+    for pattern in resolver.url_patterns:
+        if hasattr(pattern, 'url_patterns'):
+            yield from _list_views(pattern, prefix + str(pattern.pattern))
+            continue
+        view = getattr(pattern.callback, 'view_class', None)
+        if view and issubclass(view, mixins.ListModelMixin) and getattr(view, 'queryset', None) is not None:
+            yield prefix + str(pattern.pattern), view
+
+
+class Command(BaseCommand):
+    help = ('Run EXPLAIN for every declared filter and ordering combination of the list views '
+            'and flag full table scans and unindexed sorts.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--view', help='Only check views whose class name contains this string.')
+        parser.add_argument('--fail-on-scan', action='store_true', help='Exit with an error when a scan is found.')
+        parser.add_argument('--verbose-plans', action='store_true', help='Print every query plan.')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError('Plan checks are written against SQLite EXPLAIN QUERY PLAN output.')
+
+        problems = 0
+        checked = 0
+        seen = set()
+        # Scoped querysets are built for a staff user that only exists inside this transaction
+        with transaction.atomic():
+            user = User.objects.create(username='explain-list-queries', is_staff=True, is_superuser=True)
+            for route, view in _list_views():
+                if view in seen or (options['view'] and options['view'] not in view.__name__):
+                    continue
+                seen.add(view)
+                for label, queryset in self.combinations(view, route, user):
+                    plan = queryset.explain()
+                    checked += 1
+                    issues = self.issues(plan)
+                    if issues:
+                        problems += 1
+                        self.stdout.write(self.style.WARNING(
+                            f'{view.__name__} {route} [{label}]: {", ".join(issues)}'
+                        ))
+                    if options['verbose_plans'] or (issues and options['verbosity'] > 1):
+                        self.stdout.write(plan)
+            transaction.set_rollback(True)
+
+        self.stdout.write(f'Checked {checked} query plans, {problems} with full scans or unindexed sorts.')
+        if problems and options['fail_on_scan']:
+            raise CommandError(f'{problems} query plans are not backed by an index.')
+
+    def scoped(self, view_class, route, user):
+        """(label, view, queryset) of each scope of the view, its queryset as get_queryset builds it."""
+        request = Request(APIRequestFactory().get(f'/{route}'))
+        request.user = user
+        view = view_class(request=request, args=(), kwargs={}, format_kwarg=None)
+        for scope in getattr(view_class, 'scopes', None) or [None]:
+            view.scope = scope
+            try:
+                queryset = view.get_queryset()
+            except Exception as error:
+                # E.g. views that need URL arguments, checked without their scoping
+                self.stderr.write(f'{view_class.__name__}: get_queryset() failed ({error}), using its queryset.')
+                queryset = view_class.queryset.all()
+            yield (f'scope={scope}' if scope else ''), view, queryset
+
+    def combinations(self, view_class, route, user):
+        page_size = 10
+        backends = getattr(view_class, 'filter_backends', ())
+        for scope, view, queryset in self.scoped(view_class, route, user):
+            model = queryset.model
+            prefix = f'{scope}&' if scope else ''
+
+            filtered = []
+            if DjangoFilterBackend in backends:
+                filterset_class = DjangoFilterBackend().get_filterset_class(view, queryset)
+                for name, filter_ in (filterset_class.base_filters if filterset_class else {}).items():
+                    value = _filter_value(model, name, filter_)
+                    filterset = filterset_class({name: value}, queryset=queryset, request=view.request)
+                    if filterset.is_valid():
+                        filtered.append((f'{name}={value}', filterset.qs))
+
+            orderings = []
+            default_ordering = None
+            if any(issubclass(backend, filters.OrderingFilter) for backend in backends):
+                aliases = getattr(view_class, 'ordering_aliases', {})
+                for name in getattr(view_class, 'ordering_fields', None) or []:
+                    field = aliases.get(name, name)
+                    orderings += [(name, field), (f'-{name}', f'-{field}')]
+                # Without ?ordering= the filter sorts by the view's ordering, the plans have to as well
+                default_ordering = filters.OrderingFilter().get_default_ordering(view)
+
+            def ordered(queryset):
+                return queryset.order_by(*default_ordering) if default_ordering else queryset
+
+            if scope:
+                yield scope, ordered(queryset)[:page_size]
+            for label, filtered_queryset in filtered:
+                yield prefix + label, ordered(filtered_queryset)[:page_size]
+            for label, ordering in orderings:
+                yield f'{prefix}ordering={label}', queryset.order_by(ordering)[:page_size]
+            for label, filtered_queryset in filtered:
+                for ordering_label, ordering in orderings:
+                    yield (f'{prefix}{label}&ordering={ordering_label}',
+                           filtered_queryset.order_by(ordering)[:page_size])
+
+    def issues(self, plan):
+        issues = []
+        for line in plan.splitlines():
+            match = FULL_SCAN.search(line)
+            if match and 'USING' not in line:
+                issues.append(f'full scan of {match.group(1)}')
+            if TEMP_SORT in line and 'SEARCH' not in plan:
+                issues.append('sort without index')
+        return issues
@@ -0,0 +1,24 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from api.carts import flush_journal
+
+
+class Command(BaseCommand):
+    help = 'Write the carts changed in the cart cache to the database, every CART_FLUSH_SECONDS.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Write the changed carts and exit.')
+
+    def handle(self, *args, **options):
+        while True:
+            started = time.monotonic()
+            written = flush_journal()
+            if written:
+                self.stdout.write(f'{timezone.now():%Y-%m-%d %H:%M:%S} wrote {written} carts.')
+            if options['once']:
+                return
+            time.sleep(max(settings.CART_FLUSH_SECONDS - (time.monotonic() - started), 0))
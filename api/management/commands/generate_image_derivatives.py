@@ -0,0 +1,50 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.models import Count
+
+from api.images import IMAGE_FIELDS, generate_derivatives
+from api.models import ImageDerivative
+
+
+class Command(BaseCommand):
+    help = 'Generate missing thumbnails and WebP variants for every uploaded image.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=settings.IMAGE_DERIVATIVE_WORKERS,
+                            help='Images processed in parallel.')
+
+    def handle(self, *args, **options):
+        names = {}
+        for model, fields in IMAGE_FIELDS.items():
+            for field in fields:
+                storage = model._meta.get_field(field).storage
+                for name in model.objects.exclude(**{field: ''}).exclude(**{f'{field}__isnull': True}) \
+                        .values_list(field, flat=True).distinct():
+                    names[name] = storage
+
+        expected = len(settings.IMAGE_DERIVATIVE_SIZES) * len(settings.IMAGE_DERIVATIVE_FORMATS)
+        complete = set(
+            ImageDerivative.objects.values('source').annotate(total=Count('id'))
+            .filter(total__gte=expected).values_list('source', flat=True)
+        )
+        pending = [(name, storage) for name, storage in names.items() if name not in complete]
+        self.stdout.write(f'{len(pending)} of {len(names)} images need derivatives.')
+
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            for name, result in zip((name for name, _ in pending), executor.map(self.generate, pending)):
+                if isinstance(result, Exception):
+                    self.stderr.write(f'{name}: {result}')
+                else:
+                    self.stdout.write(f'{name}: {result} derivatives')
+
+    def generate(self, item):
+        name, storage = item
+        try:
+            return generate_derivatives(name, storage)
+        except Exception as exc:
+            return exc
+        finally:
+            connections.close_all()
@@ -0,0 +1,103 @@
+import hashlib
+import hmac
+import json
+import random
+import secrets
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+from rest_framework.test import APIRequestFactory
+
+from api.models import Order, StockReservation, Task, Transaction, User
+from api.order_numbers import generate_order_number
+from api.payments import process_payment_events
+from api.views import PaymentWebhookView
+
+
+class Command(BaseCommand):
+    help = (
+        'Send bursts of payment callbacks, with resent duplicates, through the webhook view on one thread, then '
+        'process the queued events and check every order was paid once. The rows it creates are committed and '
+        'deleted at the end.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--orders', type=int, default=5000)
+        parser.add_argument('--batch-size', type=int, default=100, help='Events per webhook call, 1 for single events.')
+        parser.add_argument('--duplicates', type=float, default=0.3,
+                            help='Share of extra events that resend an event already sent.')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        user = User.objects.create(username=f'load-payments-{time.time_ns()}')
+        last_task = Task.objects.order_by('-id').values_list('id', flat=True).first() or 0
+        try:
+            orders = Order.objects.bulk_create([
+                Order(user=user, order_number=generate_order_number(), payment_method='CREDIT_CARD',
+                      total_price=rng.randint(1, 500))
+                for _ in range(options['orders'])
+            ])
+            events = [
+                {'transaction_id': f'{user.username}-{order.id}', 'order': order.id, 'status': 'SUCCESS',
+                 'amount': str(order.total_price), 'currency': 'VND'}
+                for order in orders
+            ]
+            events += rng.choices(events, k=int(len(events) * options['duplicates']))
+            rng.shuffle(events)
+
+            # Signed like a gateway would, with a throwaway secret when none is configured
+            with override_settings(PAYMENT_WEBHOOK_SECRET=settings.PAYMENT_WEBHOOK_SECRET or secrets.token_hex(16)):
+                received = self._send(events, options['batch_size'])
+            self._process(last_task)
+            self._check(user, orders, received)
+        finally:
+            Task.objects.filter(id__gt=last_task, name='payment_events').delete()
+            user.delete()
+
+    def _send(self, events, batch_size):
+        view = PaymentWebhookView.as_view()
+        factory = APIRequestFactory()
+        totals = {'accepted': 0, 'duplicates': 0, 'rejected': 0}
+        started = time.perf_counter()
+        for start in range(0, len(events), batch_size):
+            batch = events[start:start + batch_size]
+            body = json.dumps(batch[0] if batch_size == 1 else batch).encode()
+            signature = hmac.new(settings.PAYMENT_WEBHOOK_SECRET.encode(), body, hashlib.sha256).hexdigest()
+            response = view(factory.post(
+                '/api/payments/webhook/', body, content_type='application/json', HTTP_X_SIGNATURE=signature
+            ))
+            if response.status_code != 202:
+                raise CommandError(f'Webhook answered {response.status_code}: {response.data}')
+            totals['accepted'] += response.data['accepted']
+            totals['duplicates'] += response.data['duplicates']
+            totals['rejected'] += len(response.data['rejected'])
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            f'Ingested {len(events)} events in {elapsed:.2f}s ({len(events) / elapsed:.0f} events/s): '
+            f'{totals["accepted"]} accepted, {totals["duplicates"]} duplicates, {totals["rejected"]} rejected'
+        )
+        return totals
+
+    def _process(self, last_task):
+        tasks = list(Task.objects.filter(id__gt=last_task, name='payment_events').order_by('id'))
+        count = sum(len(task.payload['transactions']) for task in tasks)
+        started = time.perf_counter()
+        # The worker's batching, without running other queued tasks of this database
+        for start in range(0, len(tasks), settings.TASK_QUEUE_BATCH_SIZE):
+            process_payment_events([task.payload for task in tasks[start:start + settings.TASK_QUEUE_BATCH_SIZE]])
+        elapsed = time.perf_counter() - started
+        self.stdout.write(f'Processed {count} events in {elapsed:.2f}s ({count / max(elapsed, 1e-9):.0f} events/s)')
+
+    def _check(self, user, orders, received):
+        stored = Transaction.objects.filter(user=user).count()
+        paid = Order.objects.filter(user=user, payment_status='PAID').count()
+        if received['rejected'] or received['accepted'] != len(orders) or stored != len(orders):
+            raise CommandError(f'{received["accepted"]} accepted and {stored} stored for {len(orders)} orders.')
+        if paid != len(orders):
+            raise CommandError(f'{paid} of {len(orders)} orders are paid.')
+        if StockReservation.objects.filter(order__user=user, status='HELD').exists():
+            raise CommandError('Paid orders still have held stock.')
+        self.stdout.write(self.style.SUCCESS(f'{len(orders)} orders paid once each.'))
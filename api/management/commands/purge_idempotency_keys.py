@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from api.idempotency import purge_idempotency_keys
+
+
+class Command(BaseCommand):
+    help = 'Delete the Idempotency-Key claims and responses older than IDEMPOTENCY_KEY_TTL, e.g. from cron.'
+
+    def handle(self, *args, **options):
+        self.stdout.write(f'Deleted {purge_idempotency_keys()} expired idempotency keys.')
@@ -0,0 +1,18 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand
+
+from api.analytics import rebuild_sales_rollups
+
+
+class Command(BaseCommand):
+    help = 'Recompute the seller daily sales rollups from the orders, then product and store sales totals.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', type=date.fromisoformat, help='First day to rebuild, YYYY-MM-DD.')
+        parser.add_argument('--end', type=date.fromisoformat, help='Last day to rebuild, YYYY-MM-DD.')
+        parser.add_argument('--days-per-batch', type=int, default=7, help='Days recomputed per transaction.')
+
+    def handle(self, *args, **options):
+        written = rebuild_sales_rollups(options['start'], options['end'], options['days_per_batch'])
+        self.stdout.write(f'Wrote {written} rollup rows.')
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from api.reviews import reconcile_review_aggregates
+
+
+class Command(BaseCommand):
+    help = 'Recompute product, store and seller review aggregates from the reviews and fix drifted rows.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Rows read and updated per batch.')
+        parser.add_argument('--dry-run', action='store_true', help='Only report drifted rows.')
+
+    def handle(self, *args, **options):
+        drifted = reconcile_review_aggregates(batch_size=options['batch_size'], dry_run=options['dry_run'])
+        verb = 'Found' if options['dry_run'] else 'Fixed'
+        for model, count in drifted.items():
+            self.stdout.write(f'{verb} {count} drifted {model} rows.')
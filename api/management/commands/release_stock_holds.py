@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from api.inventory import next_expiry_at, release_expired_holds
+
+
+class Command(BaseCommand):
+    help = 'Return the stock held for unpaid orders once their hold expires and cancel those orders.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Release expired holds and exit.')
+        parser.add_argument('--batch-size', type=int, default=500, help='Holds released per transaction.')
+        parser.add_argument('--max-sleep', type=float, default=60.0,
+                            help='Longest wait in seconds before looking for new holds.')
+
+    def handle(self, *args, **options):
+        while True:
+            released = release_expired_holds(batch_size=options['batch_size'])
+            if released:
+                self.stdout.write(f'{timezone.now():%Y-%m-%d %H:%M:%S} released {released} holds.')
+            if options['once']:
+                return
+
+            next_at = next_expiry_at()
+            delay = options['max_sleep']
+            if next_at is not None:
+                delay = min(delay, max((next_at - timezone.now()).total_seconds(), 0))
+            time.sleep(delay)
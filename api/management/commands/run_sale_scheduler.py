@@ -0,0 +1,41 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from api.models import Product
+from api.sales import apply_due_transitions, next_transition_at, refresh_sale_state
+
+
+class Command(BaseCommand):
+    help = 'Start and end product sales at their boundaries, keeping effective_price up to date.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Apply due transitions and exit.')
+        parser.add_argument('--batch-size', type=int, default=500, help='Transitions applied per transaction.')
+        parser.add_argument('--max-sleep', type=float, default=60.0,
+                            help='Longest wait in seconds before looking for new transitions.')
+        parser.add_argument('--refresh-all', action='store_true',
+                            help='Recompute the sale state of every product first, e.g. after bulk price updates.')
+
+    def handle(self, *args, **options):
+        if options['refresh_all']:
+            ids = list(Product.objects.values_list('id', flat=True))
+            for start in range(0, len(ids), options['batch_size']):
+                refresh_sale_state(Product.objects.filter(id__in=ids[start:start + options['batch_size']]))
+            self.stdout.write(f'Refreshed {len(ids)} products.')
+
+        while True:
+            updated = apply_due_transitions(batch_size=options['batch_size'])
+            if updated:
+                self.stdout.write(f'{timezone.now():%Y-%m-%d %H:%M:%S} updated {updated} products.')
+            if options['once']:
+                return
+
+            # Sleep until the head of the queue is due, transitions created in
+            # the meantime are picked up after at most --max-sleep seconds.
+            next_at = next_transition_at()
+            delay = options['max_sleep']
+            if next_at is not None:
+                delay = min(delay, max((next_at - timezone.now()).total_seconds(), 0))
+            time.sleep(delay)
@@ -0,0 +1,42 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from api.tasks import next_task_at, queue_stats, run_tasks
+
+
+class Command(BaseCommand):
+    help = 'Run queued background tasks in batches, retrying failures with backoff.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Run the due tasks and exit.')
+        parser.add_argument('--batch-size', type=int, help='Tasks claimed per batch.')
+        parser.add_argument('--max-sleep', type=float, default=1.0,
+                            help='Longest wait in seconds before looking for new tasks.')
+        parser.add_argument('--stats', action='store_true', help='Print queue depth and lag as JSON and exit.')
+
+    def handle(self, *args, **options):
+        if options['stats']:
+            self.stdout.write(json.dumps(queue_stats()))
+            return
+
+        while True:
+            ran = 0
+            while True:
+                claimed = run_tasks(options['batch_size'])
+                ran += claimed
+                if not claimed:
+                    break
+            if ran:
+                self.stdout.write(f'{timezone.now():%Y-%m-%d %H:%M:%S} ran {ran} tasks.')
+            if options['once']:
+                return
+
+            # Retries due before --max-sleep are picked up on time, new tasks after at most --max-sleep
+            next_at = next_task_at()
+            delay = options['max_sleep']
+            if next_at is not None:
+                delay = min(delay, max((next_at - timezone.now()).total_seconds(), 0))
+            time.sleep(delay)
@@ -0,0 +1,125 @@
+import random
+import threading
+import time
+from collections import Counter
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connections
+from django.db.models import Sum
+
+from api.inventory import InsufficientStock, release_expired_holds, reserve_stock
+from api.models import Order, Product, Stock, StockProduct, StockReservation, User
+
+
+class Command(BaseCommand):
+    help = (
+        'Place orders for a few scarce products from many threads at once and check that no warehouse row '
+        'goes negative, nothing is sold twice and Product.stock stays the warehouse total. The rows it creates '
+        'are committed, since every thread uses its own connection, and deleted at the end.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--orders', type=int, default=50, help='Orders per thread.')
+        parser.add_argument('--products', type=int, default=3)
+        parser.add_argument('--warehouses', type=int, default=3)
+        parser.add_argument('--units', type=int, default=40, help='Units of each product per warehouse.')
+        parser.add_argument('--hold-seconds', type=float, default=None,
+                            help='Hold instead of commit, and release expired holds from another thread meanwhile.')
+        parser.add_argument('--strategy', choices=('nearest', 'largest'), default='largest')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        user = User.objects.create(username=f'stress-stock-{time.time_ns()}')
+        warehouses = [
+            Stock.objects.create(name=f'stress {i}', location='stress', latitude=10 + i, longitude=106 + i)
+            for i in range(options['warehouses'])
+        ]
+        products = [
+            Product.objects.create(
+                user=user, name=f'Stress {i}', sku=f'{user.username}-{i}', slug=f'{user.username}-{i}',
+                description='stress', price=1, effective_price=1,
+            )
+            for i in range(options['products'])
+        ]
+        for product in products:
+            for warehouse in warehouses:
+                StockProduct.objects.create(stock=warehouse, product=product, quantity=options['units'])
+        try:
+            outcomes = self._run(user, [product.id for product in products], options)
+            self._check(products, options)
+        finally:
+            StockProduct.objects.filter(stock__in=warehouses).delete()
+            Stock.objects.filter(id__in=[warehouse.id for warehouse in warehouses]).delete()
+            user.delete()
+        self.stdout.write(self.style.SUCCESS(
+            'No oversell: ' + ', '.join(f'{count} {outcome}' for outcome, count in sorted(outcomes.items()))
+        ))
+
+    def _run(self, user, product_ids, options):
+        outcomes = Counter()
+        stop = threading.Event()
+
+        def place(seed):
+            rng = random.Random(seed)
+            try:
+                for _ in range(options['orders']):
+                    order = Order.objects.create(user=user, payment_method='COD', total_price=0)
+                    lines = {pid: rng.randint(1, 5) for pid in rng.sample(product_ids, rng.randint(1, len(product_ids)))}
+                    destination = (rng.uniform(9, 14), rng.uniform(105, 110))
+                    try:
+                        reserve_stock(order, lines, destination, options['strategy'], options['hold_seconds'])
+                        outcomes['placed'] += 1
+                    except InsufficientStock:
+                        outcomes['short'] += 1
+                    except OperationalError:
+                        # SQLite allows one writer at a time and gives up on busy locks
+                        outcomes['busy'] += 1
+            finally:
+                connections.close_all()
+
+        def sweep():
+            try:
+                while not stop.is_set():
+                    try:
+                        outcomes['released'] += release_expired_holds()
+                    except OperationalError:
+                        pass
+                    time.sleep(0.05)
+            finally:
+                connections.close_all()
+
+        sweeper = threading.Thread(target=sweep) if options['hold_seconds'] is not None else None
+        if sweeper:
+            sweeper.start()
+        workers = [
+            threading.Thread(target=place, args=(options['seed'] + i,)) for i in range(options['threads'])
+        ]
+        started = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - started
+        stop.set()
+        if sweeper:
+            sweeper.join()
+        self.stdout.write(f'{sum(outcomes[key] for key in ("placed", "short", "busy"))} orders in {elapsed:.2f}s')
+        return outcomes
+
+    def _check(self, products, options):
+        initial = options['units'] * options['warehouses']
+        for product in products:
+            rows = StockProduct.objects.filter(product=product)
+            on_hand = rows.aggregate(total=Sum('quantity'))['total']
+            reserved = StockReservation.objects.filter(product=product).exclude(status='RELEASED').aggregate(
+                total=Sum('quantity')
+            )['total'] or 0
+            stock = Product.objects.values_list('stock', flat=True).get(pk=product.pk)
+            self.stdout.write(f'{product.name}: {reserved} reserved, {on_hand} on hand, Product.stock {stock}')
+            if rows.filter(quantity__lt=0).exists():
+                raise CommandError(f'{product.name} has a negative warehouse row.')
+            if reserved + on_hand != initial:
+                raise CommandError(f'{product.name}: {reserved} reserved + {on_hand} on hand != {initial}.')
+            if stock != on_hand:
+                raise CommandError(f'{product.name}: Product.stock {stock} != warehouse total {on_hand}.')
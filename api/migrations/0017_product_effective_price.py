@@ -0,0 +1,81 @@
+# Generated by Django 5.1.1 on 2026-10-19 14:12
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Case, F, Q, When
+from django.utils import timezone
+
+
+def populate_effective_price(apps, schema_editor):
+    Product = apps.get_model('api', 'Product')
+    SaleTransition = apps.get_model('api', 'SaleTransition')
+    now = timezone.now()
+
+    dated = Q(start_sale_date__isnull=False) | Q(end_sale_date__isnull=False)
+    active = (
+        dated & Q(sale_price__isnull=False)
+        & (Q(start_sale_date__isnull=True) | Q(start_sale_date__lte=now))
+        & (Q(end_sale_date__isnull=True) | Q(end_sale_date__gt=now))
+    )
+    Product.objects.update(
+        is_on_sale=Case(
+            When(sale_price__isnull=True, then=False),
+            When(active, then=True),
+            When(dated, then=False),
+            default=F('is_on_sale'),
+        ),
+        effective_price=Case(
+            When(sale_price__isnull=True, then=F('price')),
+            When(active, then=F('sale_price')),
+            When(dated, then=F('price')),
+            When(is_on_sale=True, then=F('sale_price')),
+            default=F('price'),
+        ),
+    )
+
+    transitions = []
+    upcoming = Product.objects.filter(sale_price__isnull=False).filter(
+        Q(start_sale_date__gt=now) | Q(end_sale_date__gt=now)
+    )
+    for product_id, start, end in upcoming.values_list('id', 'start_sale_date', 'end_sale_date'):
+        transitions += [
+            SaleTransition(product_id=product_id, run_at=boundary)
+            for boundary in {start, end} if boundary and boundary > now
+        ]
+    SaleTransition.objects.bulk_create(transitions)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0016_storedblob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SaleTransition',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('run_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='effective_price',
+            field=models.DecimalField(decimal_places=2, default=0.0, max_digits=12),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['effective_price'], name='api_product_effecti_0fda1b_idx'),
+        ),
+        migrations.AddField(
+            model_name='saletransition',
+            name='product',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sale_transitions', to='api.product'),
+        ),
+        migrations.AddIndex(
+            model_name='saletransition',
+            index=models.Index(fields=['run_at'], name='api_saletra_run_at_2e2fb2_idx'),
+        ),
+        migrations.RunPython(populate_effective_price, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.1 on 2026-10-19 14:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0019_product_recommendations'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='productrecommendation',
+            name='kind',
+            field=models.CharField(choices=[('BOUGHT_TOGETHER', 'Frequently bought together'), ('SIMILAR', 'Similar products')], max_length=20),
+        ),
+    ]
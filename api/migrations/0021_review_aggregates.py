@@ -0,0 +1,54 @@
+# Generated by Django 5.1.1 on 2026-10-19 14:20
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def populate_review_aggregates(apps, schema_editor):
+    Review = apps.get_model('api', 'Review')
+    targets = (
+        (apps.get_model('api', 'Product'), 'product_id', 'id', 'num_reviews', 'rating'),
+        (apps.get_model('api', 'Store'), 'product__user_id', 'user_id', 'total_reviews', 'rating'),
+        (apps.get_model('api', 'SellerProfile'), 'product__user_id', 'user_id', 'total_reviews', 'seller_rating'),
+    )
+    for model, group_by, key_field, count_field, average_field in targets:
+        totals = Review.objects.values_list(group_by).annotate(total=Sum('rating'), count=Count('id'))
+        for key, total, count in totals.values_list(group_by, 'total', 'count'):
+            model.objects.filter(**{key_field: key}).update(**{
+                'rating_sum': total, count_field: count, average_field: round(total / count, 2),
+            })
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0020_similar_products'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='rating_sum',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='sellerprofile',
+            name='rating_sum',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='sellerprofile',
+            name='total_reviews',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='store',
+            name='rating_sum',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['rating'], name='api_product_rating_18e6d3_idx'),
+        ),
+        migrations.RunPython(populate_review_aggregates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 5.1.1 on 2026-10-19 14:22
+
+import math
+
+from django.db import migrations, models
+
+
+def populate_helpfulness_score(apps, schema_editor):
+    # Same formula as api.models.wilson_lower_bound, migrations keep their own copy
+    Review = apps.get_model('api', 'Review')
+    z = 1.96
+    reviews = []
+    for review in Review.objects.filter(models.Q(upvotes__gt=0) | models.Q(downvotes__gt=0)).only('upvotes', 'downvotes'):
+        total = review.upvotes + review.downvotes
+        ratio = review.upvotes / total
+        spread = z * math.sqrt(ratio * (1 - ratio) / total + z * z / (4 * total * total))
+        review.helpfulness_score = round((ratio + z * z / (2 * total) - spread) / (1 + z * z / total), 6)
+        reviews.append(review)
+    Review.objects.bulk_update(reviews, ['helpfulness_score'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0021_review_aggregates'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='review',
+            name='helpfulness_score',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='review',
+            index=models.Index(fields=['product', 'created_at'], name='api_review_product_f88e7a_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='review',
+            index=models.Index(fields=['product', 'rating', 'created_at'], name='api_review_product_12d0ad_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='review',
+            index=models.Index(fields=['product', 'helpfulness_score'], name='api_review_product_a021e9_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='review',
+            index=models.Index(fields=['user', 'created_at'], name='api_review_user_id_763f4a_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='review',
+            index=models.Index(fields=['user', 'rating', 'created_at'], name='api_review_user_id_1f15e9_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='review',
+            index=models.Index(fields=['user', 'helpfulness_score'], name='api_review_user_id_2a7513_idx'),
+        ),
+        migrations.RunPython(populate_helpfulness_score, migrations.RunPython.noop),
+    ]
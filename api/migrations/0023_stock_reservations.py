@@ -0,0 +1,85 @@
+# Generated by Django 5.1.1 on 2026-10-19 14:31
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Min, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def merge_duplicate_stock_products(apps, schema_editor):
+    # Rows for the same warehouse and product are merged into the oldest one
+    StockProduct = apps.get_model('api', 'StockProduct')
+    duplicates = StockProduct.objects.values('stock_id', 'product_id').annotate(
+        rows=Count('id'), keep=Min('id'), total=Sum('quantity')
+    ).filter(rows__gt=1)
+    for duplicate in duplicates:
+        StockProduct.objects.filter(id=duplicate['keep']).update(quantity=duplicate['total'])
+        StockProduct.objects.filter(
+            stock_id=duplicate['stock_id'], product_id=duplicate['product_id']
+        ).exclude(id=duplicate['keep']).delete()
+
+
+def sync_product_stock(apps, schema_editor):
+    # Products with warehouse rows take the total of the active ones as their stock
+    Product = apps.get_model('api', 'Product')
+    StockProduct = apps.get_model('api', 'StockProduct')
+    total = StockProduct.objects.filter(product=OuterRef('pk'), stock__is_active=True).values('product').annotate(
+        total=Sum('quantity')
+    ).values('total')
+    stocked = StockProduct.objects.values('product_id')
+    Product.objects.filter(id__in=stocked).update(stock=Coalesce(Subquery(total), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0022_review_listing'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockReservation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.PositiveIntegerField()),
+                ('status', models.CharField(choices=[('HELD', 'Held'), ('COMMITTED', 'Committed'), ('RELEASED', 'Released')], default='HELD', max_length=20)),
+                ('expires_at', models.DateTimeField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='stock',
+            name='latitude',
+            field=models.DecimalField(blank=True, decimal_places=6, max_digits=9, null=True),
+        ),
+        migrations.AddField(
+            model_name='stock',
+            name='longitude',
+            field=models.DecimalField(blank=True, decimal_places=6, max_digits=9, null=True),
+        ),
+        migrations.RunPython(merge_duplicate_stock_products, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='stockproduct',
+            constraint=models.UniqueConstraint(fields=('stock', 'product'), name='unique_stock_product'),
+        ),
+        migrations.AddField(
+            model_name='stockreservation',
+            name='order',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reservations', to='api.order'),
+        ),
+        migrations.AddField(
+            model_name='stockreservation',
+            name='product',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reservations', to='api.product'),
+        ),
+        migrations.AddField(
+            model_name='stockreservation',
+            name='stock_product',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='reservations', to='api.stockproduct'),
+        ),
+        migrations.AddIndex(
+            model_name='stockreservation',
+            index=models.Index(fields=['status', 'expires_at'], name='api_stockre_status_fd423a_idx'),
+        ),
+        migrations.RunPython(sync_product_stock, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.1.1 on 2026-10-19 14:38
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def populate_redemptions(apps, schema_editor):
+    Order = apps.get_model('api', 'Order')
+    CouponRedemption = apps.get_model('api', 'CouponRedemption')
+    counts = Order.objects.filter(coupon__isnull=False).values('coupon_id', 'user_id').annotate(count=Count('id'))
+    CouponRedemption.objects.bulk_create([
+        CouponRedemption(coupon_id=row['coupon_id'], user_id=row['user_id'], count=row['count']) for row in counts
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0024_anonymous_carts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CouponRedemption',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('coupon', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='redemptions', to='api.coupon')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='coupon_redemptions', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('coupon', 'user'), name='unique_coupon_redemption')],
+            },
+        ),
+        migrations.RunPython(populate_redemptions, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.1.1 on 2026-10-19 14:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0029_idempotency_keys'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(fields=['claimed_by'], name='api_task_claimed_03d788_idx'),
+        ),
+    ]
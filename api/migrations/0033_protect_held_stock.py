@@ -0,0 +1,19 @@
+# Generated by Django 5.1.1 on 2026-10-19 15:03
+
+import api.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0032_index_changes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='stockreservation',
+            name='stock_product',
+            field=models.ForeignKey(blank=True, null=True, on_delete=api.models.protect_held, related_name='reservations', to='api.stockproduct'),
+        ),
+    ]
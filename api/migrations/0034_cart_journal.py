@@ -0,0 +1,21 @@
+# Generated by Django 5.1.1 on 2026-10-19 15:20
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0033_protect_held_stock'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='cart',
+            name='flushed_version',
+        ),
+        migrations.RemoveField(
+            model_name='cart',
+            name='pending_lines',
+        ),
+    ]
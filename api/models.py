@@ -1,9 +1,15 @@
+import math
+
 from django.db import models
+from django.db.models import Q
 from django.contrib.auth.models import AbstractUser
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.utils import timezone
 from django.utils.text import slugify
 
+from .order_numbers import generate_order_number
+from .storage import content_addressed_storage
+
 
 class Role(models.Model):
     name = models.CharField(max_length=50, unique=True)
@@ -135,7 +141,9 @@ class Category(models.Model):
     )
     slug = models.SlugField(unique=True)
     description = models.TextField(blank=True)
-    image = models.ImageField(upload_to='category_images/', blank=True, null=True)
+    image = models.ImageField(
+        upload_to='category_images/', blank=True, null=True, storage=content_addressed_storage
+    )
     is_active = models.BooleanField(default=True)
     meta_title = models.CharField(max_length=255, blank=True)
     meta_description = models.TextField(blank=True)
@@ -143,6 +151,7 @@ class Category(models.Model):
 
     class Meta:
         verbose_name_plural = 'Categories'
+        indexes = [models.Index(fields=['name'])]
 
     def __str__(self):
         return self.name
@@ -157,6 +166,10 @@ class Tag(models.Model):
         return self.name
 
 
+# Fields the sale transitions of a product are scheduled from
+SALE_FIELDS = ('sale_price', 'start_sale_date', 'end_sale_date')
+
+
 # Product model with additional fields
 class Product(models.Model):
     STATUS_CHOICES = (
@@ -197,10 +210,16 @@ class Product(models.Model):
     is_featured = models.BooleanField(default=False)
     is_new_arrival = models.BooleanField(default=False)
     is_on_sale = models.BooleanField(default=False)
+    # Shelf price, sale_price while a sale is active and price otherwise
+    effective_price = models.DecimalField(max_digits=12, decimal_places=2, default=0.0)
     rating = models.DecimalField(max_digits=3, decimal_places=2, default=0.0)
     num_reviews = models.PositiveIntegerField(default=0)
+    # Sum of review ratings, kept next to num_reviews so rating can be updated by deltas
+    rating_sum = models.PositiveIntegerField(default=0)
     quantity_sold = models.PositiveIntegerField(default=0)
-    main_image = models.ImageField(upload_to='product_images/', blank=True, null=True)
+    main_image = models.ImageField(
+        upload_to='product_images/', blank=True, null=True, storage=content_addressed_storage
+    )
     video_url = models.URLField(blank=True, null=True)
     meta_title = models.CharField(max_length=255, blank=True)
     meta_description = models.TextField(blank=True)
@@ -209,8 +228,27 @@ class Product(models.Model):
     # For SEO purposes
     slug = models.SlugField(unique=True, max_length=255, blank=True)
 
+    # Product list filters and orderings, the partial indexes serve storefront
+    # queries restricted to status=ACTIVE
     class Meta:
         ordering = ['id']
+        indexes = [
+            models.Index(fields=['effective_price']),
+            models.Index(fields=['price']),
+            models.Index(fields=['stock']),
+            models.Index(fields=['name']),
+            models.Index(fields=['category', 'price']),
+            models.Index(fields=['category', 'effective_price']),
+            models.Index(fields=['rating']),
+            models.Index(fields=['price'], condition=Q(status='ACTIVE'), name='product_active_price_idx'),
+            models.Index(
+                fields=['effective_price'], condition=Q(status='ACTIVE'), name='product_active_eff_price_idx'
+            ),
+            models.Index(fields=['stock'], condition=Q(status='ACTIVE'), name='product_active_stock_idx'),
+            models.Index(fields=['name'], condition=Q(status='ACTIVE'), name='product_active_name_idx'),
+            models.Index(fields=['category', 'effective_price'], condition=Q(status='ACTIVE'),
+                         name='product_active_cat_price_idx'),
+        ]
 
     def save(self, *args, **kwargs):
         if not self.slug:
@@ -221,13 +259,66 @@ class Product(models.Model):
                 slug = f'{base_slug}-{counter}'
                 counter += 1
             self.slug = slug
+        self.update_sale_state()
+        adding = self._state.adding
         super().save(*args, **kwargs)
+        # Transitions only move with the sale fields, other saves leave them be.
+        # Products loaded without those fields are rescheduled.
+        sale = self._sale_fields()
+        saved = (None,) * len(SALE_FIELDS) if adding else getattr(self, '_saved_sale_fields', None)
+        if sale != saved:
+            self.schedule_sale_transitions()
+        self._saved_sale_fields = sale
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if all(field in instance.__dict__ for field in SALE_FIELDS):
+            instance._saved_sale_fields = instance._sale_fields()
+        return instance
+
+    def _sale_fields(self):
+        return tuple(getattr(self, field) for field in SALE_FIELDS)
+
+    def update_sale_state(self, now=None):
+        # Without sale dates the manually set is_on_sale flag is kept.
+        now = now or timezone.now()
+        if self.sale_price is None:
+            self.is_on_sale = False
+        elif self.start_sale_date or self.end_sale_date:
+            self.is_on_sale = (
+                (self.start_sale_date is None or self.start_sale_date <= now)
+                and (self.end_sale_date is None or now < self.end_sale_date)
+            )
+        self.effective_price = self.sale_price if self.is_on_sale else self.price
+
+    def schedule_sale_transitions(self, now=None):
+        now = now or timezone.now()
+        self.sale_transitions.all().delete()
+        if self.sale_price is not None:
+            SaleTransition.objects.bulk_create([
+                SaleTransition(product=self, run_at=boundary)
+                for boundary in {self.start_sale_date, self.end_sale_date}
+                if boundary and boundary > now
+            ])
+
+
+# Upcoming sale start or end of a product, consumed in run_at order by the sale scheduler
+class SaleTransition(models.Model):
+    product = models.ForeignKey(Product, related_name='sale_transitions', on_delete=models.CASCADE)
+    run_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [models.Index(fields=['run_at'])]
+
+    def __str__(self):
+        return f"Sale transition of product {self.product_id} at {self.run_at}"
 
 
 # ProductImage model with additional fields
 class ProductImage(models.Model):
     product = models.ForeignKey(Product, related_name='images', on_delete=models.CASCADE)
-    image = models.ImageField(upload_to='product_images/')
+    image = models.ImageField(upload_to='product_images/', storage=content_addressed_storage)
     is_main = models.BooleanField(default=False)
     caption = models.CharField(max_length=255, blank=True)
     alt_text = models.CharField(max_length=255, blank=True)
@@ -239,13 +330,22 @@ class ProductImage(models.Model):
 
 # Cart and CartItem models with additional fields
 class Cart(models.Model):
-    user = models.OneToOneField(User, related_name='cart', on_delete=models.CASCADE)
+    user = models.OneToOneField(User, related_name='cart', on_delete=models.CASCADE, null=True, blank=True)
     updated_at = models.DateTimeField(auto_now=True)
     # For anonymous users
     session_key = models.CharField(max_length=40, null=True, blank=True)
+    # Version of the cached cart written to the CartItem rows, see api.carts
+    version = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['session_key'], condition=Q(user__isnull=True), name='unique_anonymous_cart'
+            ),
+        ]
 
     def __str__(self):
-        return f"Cart of {self.user.username}"
+        return f"Cart of {self.user.username if self.user_id else self.session_key}"
 
 
 class CartItem(models.Model):
@@ -333,6 +433,16 @@ class Order(models.Model):
 
     # For multi-vendor scenarios, remove 'seller' from Order
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['created_at']),
+            models.Index(fields=['total_price']),
+            models.Index(fields=['user', 'created_at']),
+            # Staff listings filtered on a status, newest first
+            models.Index(fields=['status', 'created_at']),
+            models.Index(fields=['payment_status', 'created_at']),
+        ]
+
     def __str__(self):
         return f"Order {self.order_number} by {self.user.username}"
 
@@ -342,7 +452,7 @@ class Order(models.Model):
         super(Order, self).save(*args, **kwargs)
 
     def generate_order_number(self):
-        return timezone.now().strftime('%Y%m%d%H%M%S') + str(self.user.id)
+        return generate_order_number()
 
 
 class OrderItem(models.Model):
@@ -371,10 +481,40 @@ class OrderItem(models.Model):
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='PENDING')
     tracking_number = models.CharField(max_length=100, blank=True, null=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['seller', 'status']),
+        ]
+
     def __str__(self):
         return f"{self.quantity} x {self.product.name}"
 
 
+# Units and revenue sold per seller, day and product, kept by api.analytics
+class SellerDailySales(models.Model):
+    seller = models.ForeignKey(User, related_name='daily_sales', on_delete=models.CASCADE)
+    product = models.ForeignKey(Product, related_name='daily_sales', on_delete=models.CASCADE)
+    day = models.DateField()
+    units = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['seller', 'day', 'product'], name='unique_seller_daily_sales'),
+        ]
+
+
+def wilson_lower_bound(upvotes, downvotes, z=1.96):
+    # Ranks 9 up / 1 down above 1 up / 0 down, unlike the plain ratio
+    total = upvotes + downvotes
+    if not total:
+        return 0.0
+    ratio = upvotes / total
+    spread = z * math.sqrt(ratio * (1 - ratio) / total + z * z / (4 * total * total))
+    return round((ratio + z * z / (2 * total) - spread) / (1 + z * z / total), 6)
+
+
 # Review and ReviewImage models with additional fields
 class Review(models.Model):
     product = models.ForeignKey(Product, related_name='reviews', on_delete=models.CASCADE)
@@ -390,18 +530,35 @@ class Review(models.Model):
     upvotes = models.PositiveIntegerField(default=0)
     downvotes = models.PositiveIntegerField(default=0)
     helpful_count = models.PositiveIntegerField(default=0)
+    # Lower bound of the Wilson score interval of upvotes / (upvotes + downvotes)
+    helpfulness_score = models.FloatField(default=0)
     reported = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     # Removed seller field as it can be accessed via product
 
+    # Review lists per product and per user, one index per sort
+    class Meta:
+        indexes = [
+            models.Index(fields=['product', 'created_at']),
+            models.Index(fields=['product', 'rating', 'created_at']),
+            models.Index(fields=['product', 'helpfulness_score']),
+            models.Index(fields=['user', 'created_at']),
+            models.Index(fields=['user', 'rating', 'created_at']),
+            models.Index(fields=['user', 'helpfulness_score']),
+        ]
+
     def __str__(self):
         return f"Review by {self.user.username} on {self.product.name}"
 
+    def save(self, *args, **kwargs):
+        self.helpfulness_score = wilson_lower_bound(self.upvotes, self.downvotes)
+        super().save(*args, **kwargs)
+
 
 class ReviewImage(models.Model):
-    image = models.ImageField(upload_to='review_images/')
+    image = models.ImageField(upload_to='review_images/', storage=content_addressed_storage)
     uploaded_at = models.DateTimeField(auto_now_add=True)
 
 
@@ -430,7 +587,7 @@ class Coupon(models.Model):
     def __str__(self):
         return self.code
 
-    def is_valid(self, user=None):
+    def is_valid(self, user=None, redeemed=None):
         now = timezone.now()
         if not self.active:
             return False
@@ -440,13 +597,29 @@ class Coupon(models.Model):
             return False
         if self.usage_limit and self.used_count >= self.usage_limit:
             return False
-        if user and self.per_user_limit:
-            user_usage = Order.objects.filter(user=user, coupon=self).count()
-            if user_usage >= self.per_user_limit:
+        if user and user.pk and self.per_user_limit:
+            if redeemed is None:
+                redeemed = CouponRedemption.objects.filter(coupon=self, user=user).values_list(
+                    'count', flat=True
+                ).first() or 0
+            if redeemed >= self.per_user_limit:
                 return False
         return True
 
 
+# Times each user redeemed each coupon, so per user limits need no COUNT over orders
+class CouponRedemption(models.Model):
+    coupon = models.ForeignKey(Coupon, related_name='redemptions', on_delete=models.CASCADE)
+    user = models.ForeignKey(User, related_name='coupon_redemptions', on_delete=models.CASCADE)
+    count = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['coupon', 'user'], name='unique_coupon_redemption'),
+        ]
+
+
 # LoyaltyPoint model with additional fields
 class LoyaltyPoint(models.Model):
     user = models.OneToOneField(User, related_name='loyalty_points', on_delete=models.CASCADE)
@@ -526,7 +699,9 @@ class Promotion(models.Model):
     )
     title = models.CharField(max_length=255)
     description = models.TextField()
-    image = models.ImageField(upload_to='promotion_images/', blank=True, null=True)
+    image = models.ImageField(
+        upload_to='promotion_images/', blank=True, null=True, storage=content_addressed_storage
+    )
     discount_type = models.CharField(max_length=20, choices=DISCOUNT_TYPE_CHOICES)
     discount_value = models.DecimalField(max_digits=12, decimal_places=2)
     minimum_purchase_amount = models.DecimalField(max_digits=12, decimal_places=2, default=0.0)
@@ -636,7 +811,9 @@ class SellerProfile(models.Model):
     )
     store_name = models.CharField(max_length=255)
     store_description = models.TextField(blank=True)
-    store_logo = models.ImageField(upload_to='store_logos/', blank=True, null=True)
+    store_logo = models.ImageField(
+        upload_to='store_logos/', blank=True, null=True, storage=content_addressed_storage
+    )
     rating = models.DecimalField(max_digits=3, decimal_places=2, default=0.0)
     total_sales = models.PositiveIntegerField(default=0)
     joined_date = models.DateField(auto_now_add=True)
@@ -648,6 +825,9 @@ class SellerProfile(models.Model):
     return_policy = models.TextField(blank=True)
     shipping_policy = models.TextField(blank=True)
     seller_rating = models.DecimalField(max_digits=3, decimal_places=2, default=0.0)
+    # Reviews of the seller's products, seller_rating is rating_sum / total_reviews
+    rating_sum = models.PositiveIntegerField(default=0)
+    total_reviews = models.PositiveIntegerField(default=0)
 
     def __str__(self):
         return self.store_name
@@ -670,6 +850,9 @@ class Stock(models.Model):
     description = models.TextField(blank=True)
     is_active = models.BooleanField(default=True)
     location = models.TextField()
+    # Used by the 'nearest' allocation strategy
+    latitude = models.DecimalField(max_digits=9, decimal_places=6, null=True, blank=True)
+    longitude = models.DecimalField(max_digits=9, decimal_places=6, null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -681,17 +864,71 @@ class StockProduct(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['updated_at']),
+            models.Index(fields=['quantity']),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['stock', 'product'], name='unique_stock_product'),
+        ]
+
     def __str__(self):
         return f"Stock of {self.product.name} - {self.quantity} items"
 
 
+def protect_held(collector, field, sub_objs, using):
+    """
+    on_delete of StockReservation.stock_product: a warehouse row cannot be
+    deleted while it holds units for unpaid orders, their units could not
+    be returned anywhere. Committed and released reservations are kept
+    without the row.
+    """
+    held = list(sub_objs.filter(status='HELD'))
+    if held:
+        raise models.ProtectedError('Cannot delete stock that is held for unpaid orders.', held)
+    models.SET_NULL(collector, field, sub_objs, using)
+
+
+class StockReservation(models.Model):
+    """
+    Units taken from a warehouse row for an order line. HELD units return to
+    the warehouse when expires_at passes, COMMITTED ones are sold. Products
+    without warehouse rows are reserved on Product.stock with no stock_product,
+    and so are finished reservations whose warehouse row was deleted.
+    """
+    STATUS_CHOICES = (
+        ('HELD', 'Held'),
+        ('COMMITTED', 'Committed'),
+        ('RELEASED', 'Released'),
+    )
+    order = models.ForeignKey(Order, related_name='reservations', on_delete=models.CASCADE)
+    product = models.ForeignKey(Product, related_name='reservations', on_delete=models.CASCADE)
+    stock_product = models.ForeignKey(
+        StockProduct, related_name='reservations', on_delete=protect_held, null=True, blank=True
+    )
+    quantity = models.PositiveIntegerField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='HELD')
+    expires_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'expires_at']),
+        ]
+
+
 # Store Model
 class Store(models.Model):
     user = models.ForeignKey('User', on_delete=models.CASCADE, related_name='stores')
     store_name = models.CharField(max_length=255)
     store_description = models.TextField(blank=True)
-    store_logo = models.ImageField(upload_to='store_logos/', blank=True, null=True)
+    store_logo = models.ImageField(
+        upload_to='store_logos/', blank=True, null=True, storage=content_addressed_storage
+    )
     rating = models.DecimalField(max_digits=3, decimal_places=2, default=0.0)
+    # Units sold by the store's seller: products are not tied to a store, so
+    # every store of a seller shows the same total, see api.analytics
     total_sales = models.PositiveIntegerField(default=0)
     joined_date = models.DateField(auto_now_add=True)
     is_verified = models.BooleanField(default=False)
@@ -707,6 +944,7 @@ class Store(models.Model):
     store_tags = models.CharField(max_length=255, blank=True)  # Tags to classify the store
     location_coordinates = models.CharField(max_length=100, blank=True, null=True)  # Geolocation coordinates
     total_reviews = models.PositiveIntegerField(default=0)  # Number of reviews
+    rating_sum = models.PositiveIntegerField(default=0)  # Sum of review ratings, rating is rating_sum / total_reviews
 
     def __str__(self):
         return self.store_name
@@ -717,7 +955,9 @@ class Brand(models.Model):
     brand_name = models.CharField(max_length=255)
     brand_description = models.TextField(blank=True)
     website = models.URLField(blank=True, null=True)
-    brand_logo = models.ImageField(upload_to='brand_logos/', blank=True, null=True)
+    brand_logo = models.ImageField(
+        upload_to='brand_logos/', blank=True, null=True, storage=content_addressed_storage
+    )
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     is_verified = models.BooleanField(default=False)
@@ -741,5 +981,149 @@ class Customer(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['email']),
+            models.Index(fields=['phone_number']),
+            models.Index(fields=['last_name', 'first_name']),
+            models.Index(fields=['first_name']),
+            models.Index(fields=['created_at']),
+        ]
+
+    def __str__(self):
+        return f"Customer with email {self.email}"
+
+# Resized JPEG/WebP variants of an uploaded image, keyed by the original's storage name
+class ImageDerivative(models.Model):
+    source = models.CharField(max_length=255)
+    variant = models.CharField(max_length=50)
+    format = models.CharField(max_length=10)
+    image = models.ImageField(max_length=255)
+    width = models.PositiveIntegerField()
+    height = models.PositiveIntegerField()
+    content_hash = models.CharField(max_length=64)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('source', 'variant', 'format')
+
+    def __str__(self):
+        return f"{self.variant} {self.format} of {self.source}"
+
+
+# Deduplicated upload stored by ContentAddressedStorage, shared by every file field holding its name
+class StoredBlob(models.Model):
+    name = models.CharField(max_length=255, unique=True)
+    content_hash = models.CharField(max_length=64)
+    size = models.PositiveBigIntegerField()
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_uploaded_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [models.Index(fields=['ref_count', 'last_uploaded_at'])]
+
+    def __str__(self):
+        return f"{self.name} ({self.ref_count} references)"
+
+
+# Number of orders containing both products, stored in both directions
+class ProductCooccurrence(models.Model):
+    product = models.ForeignKey(Product, related_name='cooccurrences', on_delete=models.CASCADE)
+    other = models.ForeignKey(Product, related_name='+', on_delete=models.CASCADE)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('product', 'other')
+
+    def __str__(self):
+        return f"Products {self.product_id} and {self.other_id} bought together {self.count} times"
+
+
+# Precomputed top neighbours of a product, as [[product_id, score], ...] best first
+class ProductRecommendation(models.Model):
+    KIND_CHOICES = (
+        ('BOUGHT_TOGETHER', 'Frequently bought together'),
+        ('SIMILAR', 'Similar products'),
+    )
+    product = models.ForeignKey(Product, related_name='recommendations', on_delete=models.CASCADE)
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    neighbours = models.JSONField(default=list)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('product', 'kind')
+
+    def __str__(self):
+        return f"{self.get_kind_display()} for product {self.product_id}"
+
+
+# Position of an incremental background job, e.g. the last order folded into the co-occurrence counts
+class JobCursor(models.Model):
+    name = models.CharField(max_length=100, unique=True)
+    position = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} at {self.position}"
+
+
+# Durable background work, run by the run_task_worker command, see api.tasks
+class Task(models.Model):
+    STATUS_CHOICES = (
+        ('PENDING', 'Pending'),
+        ('RUNNING', 'Running'),
+        ('FAILED', 'Failed'),
+    )
+    name = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='PENDING')
+    run_at = models.DateTimeField(default=timezone.now)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    claimed_by = models.CharField(max_length=32, blank=True)
+    # A running task whose worker died is claimed again after this
+    locked_until = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_at']),
+            # Workers load and delete their claimed tasks by token
+            models.Index(fields=['claimed_by']),
+        ]
+
+    def __str__(self):
+        return f"{self.name} task {self.pk} ({self.status})"
+
+
+# Claim and stored response of an Idempotency-Key, see api.idempotency
+class IdempotencyKey(models.Model):
+    # sha1 of the path, the caller and the key
+    key = models.CharField(max_length=40, unique=True)
+    fingerprint = models.CharField(max_length=40)
+    # Empty while the first request runs
+    status_code = models.PositiveSmallIntegerField(null=True, blank=True)
+    response = models.BinaryField(null=True, blank=True)
+    locked_until = models.DateTimeField()
+    expires_at = models.DateTimeField(db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Idempotency key {self.key}"
+
+
+# Changes to the in-memory indexes that every worker keeps, see api.index_changes
+class IndexChange(models.Model):
+    index = models.CharField(max_length=50)
+    key = models.CharField(max_length=100)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['index', 'id']),
+        ]
+
     def __str__(self):
-        return f"Customer with email {self.email}"
\ No newline at end of file
+        return f"{self.index} change {self.key}"
@@ -0,0 +1,88 @@
+import hashlib
+import itertools
+import os
+import secrets
+import socket
+import time
+
+# Order numbers are 20 base 36 digits: 8 for the milliseconds since EPOCH_MS
+# (enough until 2113), 4 for the worker and 8 for a per process sequence.
+# Digits are 0-9 then A-Z, so with a fixed width the string order is the
+# numeric order and order numbers sort by creation time.
+DIGITS = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+EPOCH_MS = 1704067200000  # 2024-01-01 UTC
+TIME_WIDTH, WORKER_WIDTH, SEQUENCE_WIDTH = 8, 4, 8
+WORKER_IDS = 36 ** WORKER_WIDTH
+SEQUENCES = 36 ** SEQUENCE_WIDTH
+# Environment variable with the worker id of this process, 0 to 36**4 - 1, different in every process
+WORKER_ID_VARIABLE = 'ORDER_NUMBER_WORKER_ID'
+
+
+def _encode(value, width):
+    digits = []
+    for _ in range(width):
+        value, digit = divmod(value, 36)
+        digits.append(DIGITS[digit])
+    return ''.join(reversed(digits))
+
+
+def _worker_id():
+    # Settings are the same in every process, the worker id comes from the
+    # environment of each process, e.g. supervisor's %(process_num)s. Processes
+    # forked from one (gunicorn --preload) inherit its environment, theirs is
+    # derived from the host name and process id like when it is not set.
+    configured = os.environ.get(WORKER_ID_VARIABLE)
+    if configured and not _forked:
+        return int(configured) % WORKER_IDS
+    digest = hashlib.blake2b(f'{socket.gethostname()}:{os.getpid()}'.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % WORKER_IDS
+
+
+class OrderNumberGenerator:
+    """
+    Snowflake style ids from a timestamp, a worker id and a sequence.
+
+    No lock is taken: next() on an itertools.count is atomic, so concurrent
+    threads always get distinct sequence values, and a sequence value is
+    only reused after 36**8 ids. Processes and nodes differ by worker id and
+    by the random start of their sequence. The timestamp comes from the
+    monotonic clock, anchored to the wall clock once per process, so wall
+    clock steps backwards never make ids go backwards within a process.
+    """
+
+    def __init__(self, worker_id=None):
+        self.reset(worker_id)
+
+    def reset(self, worker_id=None):
+        self.worker = _encode(_worker_id() if worker_id is None else worker_id % WORKER_IDS, WORKER_WIDTH)
+        self.sequence = itertools.count(secrets.randbelow(SEQUENCES))
+        self.anchor_ms = time.time_ns() // 1_000_000 - EPOCH_MS
+        self.anchor_ns = time.monotonic_ns()
+
+    def __call__(self):
+        sequence = next(self.sequence) % SEQUENCES
+        elapsed_ms = self.anchor_ms + (time.monotonic_ns() - self.anchor_ns) // 1_000_000
+        return _encode(elapsed_ms, TIME_WIDTH) + self.worker + _encode(sequence, SEQUENCE_WIDTH)
+
+
+_generator = None
+_forked = False
+
+
+def generate_order_number():
+    global _generator
+    if _generator is None:
+        # Created on first use, after settings are configured
+        _generator = OrderNumberGenerator()
+    return _generator()
+
+
+def _after_fork():
+    # Forked workers (e.g. gunicorn --preload) must not share the parent's worker id and sequence
+    global _generator, _forked
+    _generator = None
+    _forked = True
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
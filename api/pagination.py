@@ -0,0 +1,108 @@
+import base64
+import json
+from collections import OrderedDict
+
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db.models import Q
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Cursor pagination on a composite sort key.
+
+    Each entry of `sorts` is a tuple of order_by() fields ending in a unique
+    one, e.g. ('-rating', '-created_at', '-id'). The cursor holds the key of
+    the last row of the page and the next page starts strictly after it, so
+    pages are found with an index seek instead of an OFFSET, whatever the
+    depth and however many rows share a rating.
+    """
+    page_size = 20
+    max_page_size = 100
+    sorts = {}
+    default_sort = None
+    sort_query_param = 'sort'
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+
+    def get_sort(self, request):
+        sort = request.query_params.get(self.sort_query_param, self.default_sort)
+        if sort not in self.sorts:
+            raise ValidationError({self.sort_query_param: f'Expected one of: {", ".join(self.sorts)}.'})
+        return sort
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params.get(self.page_size_query_param, self.page_size))
+        except ValueError:
+            return self.page_size
+        return min(max(size, 1), self.max_page_size)
+
+    def decode_cursor(self, request, fields, model):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            values = json.loads(base64.urlsafe_b64decode(encoded.encode()))
+            if len(values) != len(fields) or None in values:
+                raise ValueError
+            # clean() also refuses integers out of the column's range
+            return [model._meta.get_field(field.lstrip('-')).clean(value, None) for field, value in zip(fields, values)]
+        except (ValueError, TypeError, DjangoValidationError):
+            raise ValidationError({self.cursor_query_param: 'Invalid cursor.'})
+
+    def encode_cursor(self, row, fields):
+        values = []
+        for field in fields:
+            value = getattr(row, field.lstrip('-'))
+            values.append(value.isoformat() if hasattr(value, 'isoformat') else value)
+        return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+    def after(self, fields, values):
+        # (a, b, id) > cursor expanded for order_by(), with a bound on the
+        # first field so that the database can seek in the index.
+        condition = None
+        for field, value in reversed(list(zip(fields, values))):
+            name = field.lstrip('-')
+            beyond = Q(**{f'{name}__{"lt" if field.startswith("-") else "gt"}': value})
+            condition = beyond if condition is None else beyond | (Q(**{name: value}) & condition)
+        first = fields[0].lstrip('-')
+        bound = Q(**{f'{first}__{"lte" if fields[0].startswith("-") else "gte"}': values[0]})
+        return bound & condition
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.sort = self.get_sort(request)
+        self.fields = self.sorts[self.sort]
+        size = self.get_page_size(request)
+
+        queryset = queryset.order_by(*self.fields)
+        values = self.decode_cursor(request, self.fields, queryset.model)
+        if values is not None:
+            queryset = queryset.filter(self.after(self.fields, values))
+
+        rows = list(queryset[:size + 1])
+        self.has_next = len(rows) > size
+        self.page = rows[:size]
+        return self.page
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        url = replace_query_param(url, self.sort_query_param, self.sort)
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.page[-1], self.fields))
+
+    def get_first_link(self):
+        return remove_query_param(self.request.build_absolute_uri(), self.cursor_query_param)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('sort', self.sort),
+            ('next', self.get_next_link()),
+            ('first', self.get_first_link()),
+            ('results', data),
+        ]))
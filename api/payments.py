@@ -0,0 +1,170 @@
+import hashlib
+import hmac
+import logging
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import OuterRef, Q, Subquery
+from django.utils import timezone
+
+from .analytics import refresh_order_sales
+from .inventory import commit_reservations
+from .models import Order, Transaction
+from .tasks import enqueue, handler
+
+logger = logging.getLogger(__name__)
+
+STATUSES = {choice for choice, _ in Transaction.TRANSACTION_STATUS_CHOICES}
+
+# Gateway callbacks are stored as Transaction rows and acknowledged right
+# away, the orders are updated by the payment_events task. Providers resend
+# events until they are acknowledged: transaction_id is unique, so a resent
+# event is found or ignored on insert and queues nothing.
+
+
+def valid_signature(body, signature):
+    """HMAC-SHA256 of the raw body with PAYMENT_WEBHOOK_SECRET, as hex."""
+    expected = hmac.new(settings.PAYMENT_WEBHOOK_SECRET.encode(), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature or '')
+
+
+def _clean(event):
+    # Checked by hand rather than with a serializer, this runs for every event of every burst
+    if not isinstance(event, dict):
+        return None, 'Not an object.'
+    transaction_id = event.get('transaction_id')
+    if not isinstance(transaction_id, str) or not 0 < len(transaction_id) <= 100:
+        return None, 'transaction_id must be a string of 1 to 100 characters.'
+    if event.get('status') not in STATUSES:
+        return None, f'status must be one of {", ".join(sorted(STATUSES))}.'
+    order, order_number = event.get('order'), event.get('order_number')
+    if not (isinstance(order, int) and not isinstance(order, bool)) and not isinstance(order_number, str):
+        return None, 'order or order_number is required.'
+    try:
+        amount = Decimal(str(event.get('amount')))
+    except InvalidOperation:
+        return None, 'amount must be a number.'
+    if not amount.is_finite() or amount < 0:
+        return None, 'amount must be a number.'
+    return {
+        'transaction_id': transaction_id, 'status': event['status'], 'order': order, 'order_number': order_number,
+        'amount': amount, 'event': event,
+    }, None
+
+
+def ingest_events(events):
+    """
+    Store the new events of a webhook call as Transaction rows and queue them
+    for processing, in a constant number of queries unless a concurrent call
+    stores some of the same events. Returns counts of the events this call
+    stored and of duplicates, and the rejected events with why.
+    """
+    rejected, unique = [], {}
+    for position, event in enumerate(events):
+        clean, error = _clean(event)
+        if error:
+            rejected.append({'index': position, 'error': error})
+        else:
+            # The first of the copies in one call wins, like the first stored one
+            clean['index'] = position
+            unique.setdefault(clean['transaction_id'], clean)
+
+    existing = set(Transaction.objects.filter(transaction_id__in=list(unique)).values_list(
+        'transaction_id', flat=True
+    ))
+    fresh = [event for transaction_id, event in unique.items() if transaction_id not in existing]
+    orders = Order.objects.filter(
+        Q(id__in=[event['order'] for event in fresh if event['order'] is not None])
+        | Q(order_number__in=[event['order_number'] for event in fresh if event['order_number']])
+    ).values('id', 'order_number', 'user_id', 'payment_method')
+    by_id, by_number = {}, {}
+    for order in orders:
+        by_id[order['id']] = by_number[order['order_number']] = order
+
+    rows = []
+    for event in fresh:
+        order = by_id.get(event['order']) or by_number.get(event['order_number'])
+        if order is None:
+            rejected.append({'index': event['index'], 'error': 'Unknown order.'})
+            continue
+        optional = {field: event['event'][field] for field in ('currency', 'description')
+                    if isinstance(event['event'].get(field), str)}
+        rows.append(Transaction(
+            user_id=order['user_id'], order_id=order['id'], amount=event['amount'],
+            payment_method=str(event['event'].get('payment_method') or order['payment_method'])[:20],
+            status=event['status'], transaction_id=event['transaction_id'], gateway_response=event['event'],
+            **optional,
+        ))
+    with transaction.atomic():
+        while rows:
+            try:
+                with transaction.atomic():
+                    Transaction.objects.bulk_create(rows)
+                break
+            except IntegrityError:
+                # A concurrent call stored some of these events since the lookup
+                # above: they are its events, neither counted nor queued here
+                taken = set(Transaction.objects.filter(
+                    transaction_id__in=[row.transaction_id for row in rows]
+                ).values_list('transaction_id', flat=True))
+                if not taken:
+                    raise
+                rows = [row for row in rows if row.transaction_id not in taken]
+        if rows:
+            enqueue('payment_events', {'transactions': [row.transaction_id for row in rows]})
+    rejected.sort(key=lambda item: item['index'])
+    return {
+        'received': len(events),
+        'accepted': len(rows),
+        'duplicates': len(events) - len(rejected) - len(rows),
+        'rejected': rejected,
+    }
+
+
+@handler('payment_events')
+def process_payment_events(payloads):
+    """
+    Apply the payment status transitions of stored events, for a batch of
+    webhook calls at once: UNPAID orders become PAID when a successful
+    payment covers their total, and PAID orders become REFUNDED. Applying
+    events again changes nothing. Returns the ids of the paid and refunded
+    orders.
+    """
+    transaction_ids = [transaction_id for payload in payloads for transaction_id in payload['transactions']]
+    payments, refunds = {}, set()
+    for order_id, status, amount, transaction_id in Transaction.objects.filter(
+        transaction_id__in=transaction_ids, status__in=('SUCCESS', 'REFUNDED')
+    ).order_by('id').values_list('order_id', 'status', 'amount', 'transaction_id'):
+        if status == 'REFUNDED':
+            refunds.add(order_id)
+        elif order_id not in payments or amount > payments[order_id][0]:
+            payments[order_id] = (amount, transaction_id)
+
+    now = timezone.now()
+    paid_ids = []
+    for order_id, total, status in Order.objects.select_for_update().filter(
+        id__in=payments, payment_status='UNPAID'
+    ).values_list('id', 'total_price', 'status'):
+        amount, transaction_id = payments[order_id]
+        if status == 'CANCELED' or amount < total:
+            # Paid late or short, left for someone to look at
+            logger.warning('Payment %s of %s for order %s (%s, total %s) was not applied',
+                           transaction_id, amount, order_id, status, total)
+            continue
+        paid_ids.append(order_id)
+    # One UPDATE, the transaction of each order being its largest successful payment
+    largest = Transaction.objects.filter(order=OuterRef('pk'), status='SUCCESS').order_by('-amount', 'id')
+    Order.objects.filter(id__in=paid_ids).update(
+        payment_status='PAID', transaction_id=Subquery(largest.values('transaction_id')[:1]), updated_at=now
+    )
+    commit_reservations(paid_ids)
+
+    refunded_ids = list(Order.objects.select_for_update().filter(
+        id__in=refunds, payment_status='PAID'
+    ).values_list('id', flat=True))
+    Order.objects.filter(id__in=refunded_ids).update(payment_status='REFUNDED', updated_at=now)
+
+    # Bulk updates send no signals, the sales rollups are refreshed here
+    refresh_order_sales(paid_ids + refunded_ids)
+    return paid_ids, refunded_ids
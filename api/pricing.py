@@ -0,0 +1,117 @@
+from django.conf import settings
+
+from .models import ShippingMethod
+from .promotions import ZERO, Rule, get_rule_index, money
+
+
+def _shipping_cost(shipping_method):
+    if not shipping_method:
+        return money(settings.ORDER_DEFAULT_SHIPPING_COST)
+    method = ShippingMethod.objects.filter(name=shipping_method, is_active=True).only('cost').first()
+    return money(method.cost if method else settings.ORDER_DEFAULT_SHIPPING_COST)
+
+
+def compiled_coupon(coupon, index=None):
+    """The coupon's rule from the index, or compiled from the database when it is not live there."""
+    rule = (index or get_rule_index()).coupon(coupon.id)
+    if rule is not None:
+        return rule
+    return Rule(
+        coupon, coupon.applicable_products.values_list('id', flat=True),
+        coupon.applicable_categories.values_list('id', flat=True),
+        coupon.applicable_users.values_list('id', flat=True),
+    )
+
+
+def price_order(lines, user=None, coupon=None, shipping_method=None, redeemed=None):
+    """
+    Price an order from its lines, each a dict with a `product` and a `quantity`.
+
+    Unit prices and weights come from the products, never from the client.
+    Every amount is rounded half up to cents when it is computed, so the
+    totals are the exact sums of the rounded line amounts. A line gets the
+    best of the promotions covering it, the coupon applies on top to the
+    lines in its scope, and tax is charged on the discounted subtotal.
+
+    Returns a dict of Order field values plus `lines`, each line with the
+    OrderItem `price`, `total_price` and `weight` and its `discount`.
+    Raises ValueError with a message when the coupon cannot be used,
+    `redeemed` is the user's redemption count of it when already known.
+    """
+    index = get_rule_index()
+    # Only the rules scoped to these products or their categories, or to everything
+    promotion_rules = index.promotions_for([line['product'] for line in lines])
+    coupon_rule = None
+    if coupon is not None:
+        if not coupon.is_valid(user, redeemed):
+            raise ValueError('This coupon is not valid.')
+        coupon_rule = compiled_coupon(coupon, index)
+        if not coupon_rule.allows(user.id if user else None):
+            raise ValueError('This coupon is not available for this account.')
+
+    priced = []
+    subtotal = weight = promotion_discount = coupon_base = ZERO
+    promotion_bases = [ZERO] * len(promotion_rules)
+    for line in lines:
+        product, quantity = line['product'], line['quantity']
+        price = money(product.effective_price)
+        total = money(price * quantity)
+        unit_weight = product.weight or ZERO
+
+        # The best promotion for the line, checked against its minimum below
+        best, best_discount = None, ZERO
+        for position, rule in enumerate(promotion_rules):
+            if rule.matches(product):
+                promotion_bases[position] += total
+                discount = rule.discount(total, quantity)
+                if discount > best_discount:
+                    best, best_discount = position, discount
+
+        priced.append({**line, 'price': price, 'total_price': total, 'weight': unit_weight,
+                       'promotion': best, 'discount': best_discount})
+        subtotal += total
+        weight += unit_weight * quantity
+
+    # Promotions only count once the lines they cover reach their minimum purchase amount
+    eligible = [
+        base > ZERO and base >= rule.rule.minimum_purchase_amount
+        for rule, base in zip(promotion_rules, promotion_bases)
+    ]
+    for line in priced:
+        if line['promotion'] is not None and not eligible[line['promotion']]:
+            line['discount'] = ZERO
+        promotion_discount += line['discount']
+        if coupon_rule and coupon_rule.matches(line['product']):
+            coupon_base += line['total_price'] - line['discount']
+
+    free_shipping = any(
+        ok and rule.rule.discount_type == 'FREE_SHIPPING' for rule, ok in zip(promotion_rules, eligible)
+    )
+    coupon_discount = ZERO
+    if coupon_rule:
+        if coupon_base <= ZERO or coupon_base < coupon.minimum_purchase_amount:
+            raise ValueError('The order does not reach the minimum purchase amount of this coupon.')
+        if coupon.discount_type == 'PERCENTAGE':
+            coupon_discount = money(coupon_base * coupon.discount_value / 100)
+        elif coupon.discount_type == 'FIXED':
+            coupon_discount = min(money(coupon.discount_value), coupon_base)
+        free_shipping = free_shipping or coupon.discount_type == 'FREE_SHIPPING' or coupon.is_free_shipping
+
+    threshold = settings.ORDER_FREE_SHIPPING_THRESHOLD
+    if threshold is not None and subtotal >= threshold:
+        free_shipping = True
+    shipping = ZERO if free_shipping or not priced else _shipping_cost(shipping_method)
+
+    discount = promotion_discount + coupon_discount
+    tax = money((subtotal - discount) * settings.ORDER_TAX_RATE)
+    for line in priced:
+        del line['promotion']
+    return {
+        'lines': priced,
+        'subtotal_price': subtotal,
+        'discount_amount': discount,
+        'shipping_cost': shipping,
+        'tax_amount': tax,
+        'total_price': subtotal - discount + shipping + tax,
+        'total_weight': money(weight),
+    }
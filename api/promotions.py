@@ -0,0 +1,277 @@
+import heapq
+import logging
+import threading
+import time
+from collections import defaultdict
+from datetime import timedelta
+from decimal import ROUND_HALF_UP, Decimal
+
+from django.conf import settings
+from django.db import connections
+from django.utils import timezone
+
+from . import index_changes
+from .models import Coupon, Promotion
+
+logger = logging.getLogger(__name__)
+
+INDEX = 'promotions'
+CENT = Decimal('0.01')
+ZERO = Decimal('0.00')
+
+# Per rule kind, the model and its scopes: {scope: (through model, rule column, scope column)}
+RULE_KINDS = {
+    'promotion': (Promotion, {
+        'product': (Promotion.products.through, 'promotion_id', 'product_id'),
+        'category': (Promotion.applicable_categories.through, 'promotion_id', 'category_id'),
+    }),
+    'coupon': (Coupon, {
+        'product': (Coupon.applicable_products.through, 'coupon_id', 'product_id'),
+        'category': (Coupon.applicable_categories.through, 'coupon_id', 'category_id'),
+        'user': (Coupon.applicable_users.through, 'coupon_id', 'user_id'),
+    }),
+}
+
+
+def money(value):
+    return Decimal(value).quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+class Rule:
+    """A promotion or coupon with its product, category and user scopes, empty scopes match everything."""
+
+    def __init__(self, rule, products=(), categories=(), users=()):
+        self.rule = rule
+        self.products = frozenset(products)
+        self.categories = frozenset(categories)
+        self.users = frozenset(users)
+
+    @property
+    def usable(self):
+        return self.rule.active and not (self.rule.usage_limit and self.rule.used_count >= self.rule.usage_limit)
+
+    def live(self, now):
+        return self.usable and self.rule.start_date <= now <= self.rule.end_date
+
+    def matches(self, product):
+        if not self.products and not self.categories:
+            return True
+        return product.id in self.products or product.category_id in self.categories
+
+    def allows(self, user_id):
+        return not self.users or user_id in self.users
+
+    def discount(self, amount, quantity):
+        if self.rule.discount_type == 'PERCENTAGE':
+            return money(amount * self.rule.discount_value / 100)
+        if self.rule.discount_type == 'FIXED':
+            return min(money(self.rule.discount_value * quantity), amount)
+        return ZERO
+
+
+class RuleIndex:
+    """
+    Active promotions and coupons, compiled for cart pricing.
+
+    Every rule is filed under the products and categories it is scoped to, or
+    as unscoped, so a cart only looks at the rules of its own products and
+    categories. Start and end dates are kept in a heap of events: rules that
+    start later are compiled ahead of time and go live when their start is
+    popped, and rules drop out when their end is popped. Replaced rules
+    leave stale events behind, which only re-check the current rule.
+    """
+
+    def __init__(self):
+        self.rules = {}
+        self.by_scope = defaultdict(set)
+        self.unscoped = defaultdict(set)
+        self.codes = {}
+        self.live = set()
+        self.events = []
+        self.clock = timezone.now()
+        self.built_at = time.time()
+        # Last IndexChange applied
+        self.seen = 0
+        self.lock = threading.RLock()
+
+    # Updates
+
+    def _file(self, key, rule, delta):
+        kind = key[0]
+        scoped = False
+        for scope, ids in (('product', rule.products), ('category', rule.categories)):
+            for scope_id in ids:
+                scoped = True
+                bucket = self.by_scope[(kind, scope, scope_id)]
+                bucket.add(key) if delta > 0 else bucket.discard(key)
+        if not scoped:
+            self.unscoped[kind].add(key) if delta > 0 else self.unscoped[kind].discard(key)
+
+    def _check(self, key):
+        rule = self.rules.get(key)
+        if rule is not None and rule.live(self.clock):
+            self.live.add(key)
+        else:
+            self.live.discard(key)
+
+    def put(self, key, rule):
+        with self.lock:
+            self.remove(key)
+            if not rule.usable or rule.rule.end_date < self.clock:
+                return
+            self.rules[key] = rule
+            self._file(key, rule, 1)
+            if key[0] == 'coupon':
+                self.codes[rule.rule.code] = key[1]
+            # End dates are inclusive, the rule drops out just after its end
+            for when in (rule.rule.start_date, rule.rule.end_date + timedelta(microseconds=1)):
+                if when > self.clock:
+                    heapq.heappush(self.events, (when, key))
+            self._check(key)
+
+    def remove(self, key):
+        with self.lock:
+            rule = self.rules.pop(key, None)
+            if rule is None:
+                return
+            self._file(key, rule, -1)
+            if key[0] == 'coupon' and self.codes.get(rule.rule.code) == key[1]:
+                del self.codes[rule.rule.code]
+            self.live.discard(key)
+
+    def advance(self, now):
+        with self.lock:
+            self.clock = max(self.clock, now)
+            while self.events and self.events[0][0] <= self.clock:
+                _, key = heapq.heappop(self.events)
+                rule = self.rules.get(key)
+                if rule is not None and rule.rule.end_date < self.clock:
+                    self.remove(key)
+                else:
+                    self._check(key)
+
+    # Lookups
+
+    def _candidates(self, kind, products, now):
+        self.advance(now)
+        keys = set(self.unscoped[kind])
+        for product in products:
+            keys |= self.by_scope.get((kind, 'product', product.id), set())
+            if product.category_id:
+                keys |= self.by_scope.get((kind, 'category', product.category_id), set())
+        return sorted(keys & self.live)
+
+    def promotions_for(self, products, now=None):
+        """Live promotions that can apply to some of `products`, in id order."""
+        with self.lock:
+            return [self.rules[key] for key in self._candidates('promotion', products, now or timezone.now())]
+
+    def coupons_for(self, products, user_id=None, now=None):
+        """Live coupons that can apply to some of `products` and that `user_id` may use."""
+        with self.lock:
+            rules = [self.rules[key] for key in self._candidates('coupon', products, now or timezone.now())]
+        return [rule for rule in rules if rule.allows(user_id)]
+
+    def coupon(self, coupon_id=None, code=None, now=None):
+        """The compiled coupon if it is live, by id or code."""
+        with self.lock:
+            self.advance(now or timezone.now())
+            key = ('coupon', coupon_id if code is None else self.codes.get(code))
+            return self.rules[key] if key in self.live else None
+
+    # Loading
+
+    @staticmethod
+    def load(kind, ids=None):
+        """Compiled rules of `kind` from the database, all of the unexpired ones or those in `ids`."""
+        model, scopes = RULE_KINDS[kind]
+        if ids is None:
+            queryset = model.objects.filter(active=True, end_date__gte=timezone.now())
+        else:
+            queryset = model.objects.filter(id__in=ids)
+        if kind == 'promotion':
+            queryset = queryset.defer('description', 'image')
+        rows = {row.id: row for row in queryset}
+        scoped = {scope: defaultdict(list) for scope in scopes}
+        for scope, (through, rule_field, scope_field) in scopes.items():
+            for rule_id, scope_id in through.objects.filter(**{f'{rule_field}__in': list(rows)}).values_list(
+                rule_field, scope_field
+            ):
+                scoped[scope][rule_id].append(scope_id)
+        return {
+            rule_id: Rule(row, scoped['product'][rule_id], scoped['category'][rule_id],
+                          scoped['user'][rule_id] if 'user' in scoped else ())
+            for rule_id, row in rows.items()
+        }
+
+    @classmethod
+    def build(cls):
+        index = cls()
+        # Changes committed while loading are applied again by catch_up
+        index.seen = index_changes.latest()
+        for kind in RULE_KINDS:
+            for rule_id, rule in cls.load(kind).items():
+                index.put((kind, rule_id), rule)
+        return index
+
+    def refresh(self, kind, ids):
+        loaded = self.load(kind, ids)
+        for rule_id in ids:
+            if rule_id in loaded:
+                self.put((kind, rule_id), loaded[rule_id])
+            else:
+                self.remove((kind, rule_id))
+
+    def catch_up(self):
+        """Reload the rules changed by any worker since the last call, see api.index_changes."""
+        with self.lock:
+            seen, keys = index_changes.since(INDEX, self.seen)
+            by_kind = defaultdict(list)
+            for key in keys:
+                kind, rule_id = key.split(':')
+                by_kind[kind].append(int(rule_id))
+            for kind, ids in by_kind.items():
+                self.refresh(kind, ids)
+            self.seen = seen
+
+
+# Process wide index, built on first use and rebuilt in the background once
+# PROMOTION_INDEX_MAX_AGE has passed. Every lookup first applies the rule
+# changes recorded by rules_changed, made by this or any other worker.
+
+_index = None
+_index_lock = threading.Lock()
+_rebuilding = False
+
+
+def _rebuild():
+    global _index, _rebuilding
+    try:
+        index = RuleIndex.build()
+        # Changes made while it was built, later ones are applied by the next lookup
+        index.catch_up()
+        _index = index
+        index_changes.purge()
+    except Exception:
+        logger.exception('Could not rebuild the promotion index')
+    finally:
+        _rebuilding = False
+        connections.close_all()
+
+
+def get_rule_index():
+    global _index, _rebuilding
+    with _index_lock:
+        if _index is None or index_changes.expired(_index.built_at):
+            _index = RuleIndex.build()
+        elif not _rebuilding and time.time() - _index.built_at > settings.PROMOTION_INDEX_MAX_AGE:
+            _rebuilding = True
+            threading.Thread(target=_rebuild, name='promotion-index', daemon=True).start()
+        index = _index
+    index.catch_up()
+    return index
+
+
+def rules_changed(kind, ids):
+    """Record that rules of `kind` changed, in the transaction of the change."""
+    index_changes.record(INDEX, [f'{kind}:{rule_id}' for rule_id in ids])
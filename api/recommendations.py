@@ -0,0 +1,502 @@
+import logging
+import math
+import os
+import pickle
+import tempfile
+import time
+from datetime import timedelta
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+from scipy import sparse
+
+from . import index_changes
+from .analytics import VOID_STATUSES
+from .models import JobCursor, Order, OrderItem, Product, ProductCooccurrence, ProductRecommendation
+from .tasks import enqueue, handler
+
+logger = logging.getLogger(__name__)
+
+BOUGHT_TOGETHER = 'BOUGHT_TOGETHER'
+BOUGHT_TOGETHER_CURSOR = 'bought_together'
+SIMILAR = 'SIMILAR'
+# api.index_changes index of the products whose similarity features changed
+SIMILAR_FEATURES = 'similar-features'
+
+# Pairs are handled as one int64 key, product ids fit in the lower 32 bits
+_SHIFT = np.int64(32)
+_MASK = np.int64(0xFFFFFFFF)
+
+
+def _pair_keys(products, others):
+    return (products.astype(np.int64) << _SHIFT) | others.astype(np.int64)
+
+
+def _split_keys(keys):
+    return keys >> _SHIFT, keys & _MASK
+
+
+def _sum_by_key(keys, counts):
+    keys, inverse = np.unique(keys, return_inverse=True)
+    return keys, np.bincount(inverse, weights=counts, minlength=len(keys)).astype(np.int64)
+
+
+def _empty():
+    return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+
+def count_pairs(order_ids, product_ids, max_basket=None):
+    """
+    Count the product pairs bought in the same order.
+
+    Takes parallel arrays of order and product ids, as read from `OrderItem`,
+    and returns sorted pair keys with the number of orders containing each
+    pair. A product appearing on several lines of one order counts once, and
+    every pair is counted in both directions.
+    """
+    max_basket = max_basket or settings.RECOMMENDATION_MAX_BASKET
+    if not len(order_ids):
+        return _empty()
+
+    lines = np.unique(_pair_keys(np.asarray(order_ids), np.asarray(product_ids)))
+    orders, products = _split_keys(lines)
+
+    # Single product orders have no pairs, oversized ones would dominate the counts
+    starts = np.flatnonzero(np.r_[True, orders[1:] != orders[:-1]])
+    sizes = np.diff(np.r_[starts, len(orders)])
+    basket_size = np.repeat(sizes, sizes)
+    keep = (basket_size > 1) & (basket_size <= max_basket)
+    if not keep.any():
+        return _empty()
+    orders, products = orders[keep], products[keep]
+
+    # Pair each line with every line of its order, itself excluded
+    starts = np.flatnonzero(np.r_[True, orders[1:] != orders[:-1]])
+    sizes = np.diff(np.r_[starts, len(orders)])
+    repeats = np.repeat(sizes, sizes)
+    left = np.repeat(np.arange(len(products)), repeats)
+    first = np.repeat(np.repeat(starts, sizes), repeats)
+    right = first + np.arange(len(left)) - np.repeat(np.cumsum(repeats) - repeats, repeats)
+    distinct = left != right
+
+    keys = _pair_keys(products[left[distinct]], products[right[distinct]])
+    return _sum_by_key(keys, np.ones(len(keys), dtype=np.int64))
+
+
+def top_neighbours(keys, counts, top_k=None):
+    """Group pair counts by product and keep the `top_k` best, ties broken by product id."""
+    top_k = top_k or settings.RECOMMENDATION_TOP_K
+    products, others = _split_keys(keys)
+    order = np.lexsort((others, -counts, products))
+    products, others, counts = products[order], others[order], counts[order]
+
+    starts = np.flatnonzero(np.r_[True, products[1:] != products[:-1]]) if len(products) else products
+    rank = np.arange(len(products)) - np.repeat(starts, np.diff(np.r_[starts, len(products)]))
+    keep = rank < top_k
+
+    neighbours = {}
+    for product, other, count in zip(products[keep].tolist(), others[keep].tolist(), counts[keep].tolist()):
+        neighbours.setdefault(product, []).append([other, count])
+    return neighbours
+
+
+def _read_order_lines(after, until, chunk_size):
+    """Yield (last order id, order ids, product ids) for orders after `after`, `chunk_size` orders at a time."""
+    lines = OrderItem.objects.exclude(order__status__in=VOID_STATUSES).filter(
+        order_id__gt=after, order__created_at__lt=until
+    )
+    while True:
+        order_ids = list(
+            lines.filter(order_id__gt=after).order_by('order_id')
+            .values_list('order_id', flat=True).distinct()[:chunk_size]
+        )
+        if not order_ids:
+            return
+        rows = lines.filter(order_id__gt=after, order_id__lte=order_ids[-1]).values_list('order_id', 'product_id')
+        pairs = np.array(list(rows), dtype=np.int64).reshape(-1, 2)
+        yield order_ids[-1], pairs[:, 0], pairs[:, 1]
+        after = order_ids[-1]
+
+
+def _load_counts(product_ids, batch_size=500):
+    keys, counts = [], []
+    for start in range(0, len(product_ids), batch_size):
+        rows = ProductCooccurrence.objects.filter(
+            product_id__in=product_ids[start:start + batch_size]
+        ).values_list('product_id', 'other_id', 'count')
+        rows = np.array(list(rows), dtype=np.int64).reshape(-1, 3)
+        keys.append(_pair_keys(rows[:, 0], rows[:, 1]))
+        counts.append(rows[:, 2])
+    if not keys:
+        return _empty()
+    return np.concatenate(keys), np.concatenate(counts)
+
+
+def _order_pairs(order_ids):
+    rows = OrderItem.objects.filter(order_id__in=order_ids).values_list('order_id', 'product_id')
+    pairs = np.array(list(rows), dtype=np.int64).reshape(-1, 2)
+    return count_pairs(pairs[:, 0], pairs[:, 1])
+
+
+def _apply_counts(delta_keys, delta_counts, top_k=None, rebuild=False):
+    """
+    Add pair count deltas, negative for orders taken out, to the stored
+    counts and refresh the bought-together neighbours of every product they
+    touch. With `rebuild` the deltas replace every stored count.
+    """
+    affected = np.unique(_split_keys(delta_keys)[0])
+    if rebuild:
+        ProductCooccurrence.objects.all().delete()
+        ProductRecommendation.objects.filter(kind=BOUGHT_TOGETHER).delete()
+        keys, counts = delta_keys, delta_counts
+    else:
+        existing_keys, existing_counts = _load_counts(affected.tolist())
+        keys, counts = _sum_by_key(np.r_[existing_keys, delta_keys], np.r_[existing_counts, delta_counts])
+    counts = np.maximum(counts, 0)
+
+    # Only pairs in the deltas are written back, those down to zero are deleted
+    changed = np.isin(keys, delta_keys, assume_unique=True)
+    products, others = _split_keys(keys[changed])
+    ProductCooccurrence.objects.bulk_create(
+        [
+            ProductCooccurrence(product_id=product, other_id=other, count=count)
+            for product, other, count in zip(products.tolist(), others.tolist(), counts[changed].tolist())
+        ],
+        batch_size=500, update_conflicts=True, unique_fields=['product', 'other'], update_fields=['count'],
+    )
+    ProductCooccurrence.objects.filter(product_id__in=affected.tolist(), count=0).delete()
+
+    kept = counts > 0
+    neighbours = top_neighbours(keys[kept], counts[kept], top_k)
+    ProductRecommendation.objects.bulk_create(
+        [
+            ProductRecommendation(product_id=product, kind=BOUGHT_TOGETHER, neighbours=neighbours[product])
+            for product in affected.tolist() if product in neighbours
+        ],
+        batch_size=500, update_conflicts=True, unique_fields=['product', 'kind'],
+        update_fields=['neighbours', 'updated_at'],
+    )
+    ProductRecommendation.objects.filter(
+        kind=BOUGHT_TOGETHER, product_id__in=[product for product in affected.tolist() if product not in neighbours]
+    ).delete()
+
+
+def fold_orders(chunk_size=1000, settle_seconds=300, rebuild=False, top_k=None):
+    """
+    Fold orders placed since the last run into the co-occurrence counts and
+    refresh the bought-together neighbours of every product they touch.
+
+    Orders are read `chunk_size` at a time and counted with numpy, the counts
+    of all chunks are merged in memory and written in a single transaction
+    together with the cursor. Orders younger than `settle_seconds` are left for
+    the next run so that orders still being written are not skipped, canceled
+    and returned ones are left out.
+    Returns the number of orders folded in.
+    """
+    cursor, _ = JobCursor.objects.get_or_create(name=BOUGHT_TOGETHER_CURSOR)
+    start = 0 if rebuild else cursor.position
+    until = timezone.now() - timedelta(seconds=settle_seconds)
+
+    delta_keys, delta_counts = _empty()
+    position, read = start, []
+    for last_order, order_ids, product_ids in _read_order_lines(start, until, chunk_size):
+        keys, counts = count_pairs(order_ids, product_ids)
+        delta_keys, delta_counts = _sum_by_key(np.r_[delta_keys, keys], np.r_[delta_counts, counts])
+        read.append(np.unique(order_ids))
+        position = last_order
+
+    if position == start and not rebuild:
+        return 0
+
+    with transaction.atomic():
+        cursor = JobCursor.objects.select_for_update().get(pk=cursor.pk)
+        if not rebuild and cursor.position != start:
+            # Another run folded the same orders in the meantime.
+            return 0
+
+        # Orders voided since they were read saw the old cursor in void_orders, they are taken out here
+        read = np.concatenate(read) if read else np.empty(0, dtype=np.int64)
+        voided = Order.objects.filter(id__gt=start, id__lte=position, status__in=VOID_STATUSES)
+        voided = np.intersect1d(np.fromiter(voided.values_list('id', flat=True), dtype=np.int64), read)
+        if len(voided):
+            keys, counts = _order_pairs(voided.tolist())
+            delta_keys, delta_counts = _sum_by_key(np.r_[delta_keys, keys], np.r_[delta_counts, -counts])
+
+        _apply_counts(delta_keys, delta_counts, top_k, rebuild)
+        cursor.position = position
+        cursor.save(update_fields=['position', 'updated_at'])
+    return len(read) - len(voided)
+
+
+def void_orders(order_ids, restored=False):
+    """
+    Take orders that were just canceled or returned out of the co-occurrence
+    counts, or put them back when `restored`. Orders the cursor has not
+    reached are left to fold_orders, which skips void ones. Call in the
+    transaction of the status change, the cursor stays locked until it
+    commits. Returns the number of orders taken out or put back.
+    """
+    with transaction.atomic():
+        cursor = JobCursor.objects.select_for_update().filter(name=BOUGHT_TOGETHER_CURSOR).first()
+        folded = [order_id for order_id in order_ids if cursor and order_id <= cursor.position]
+        if not folded:
+            return 0
+        keys, counts = _order_pairs(folded)
+        if len(keys):
+            _apply_counts(keys, counts if restored else -counts)
+    return len(folded)
+
+
+# Similar products, cosine similarity over weighted tag, category, brand and price band features
+
+def similar_cache_key(product_id):
+    return f'similar-products:{product_id}'
+
+
+def _base_features(category_id, brand, price):
+    features = set()
+    if category_id:
+        features.add(('category', category_id))
+    if brand and brand.strip():
+        features.add(('brand', brand.strip().lower()))
+    if price and price > 0:
+        features.add(('price_band', math.floor(math.log(price) / math.log(settings.RECOMMENDATION_PRICE_BAND_RATIO))))
+    return features
+
+
+def similarity_features(product):
+    """Feature set of a saved product, compared before and after updates to decide on a refresh."""
+    features = _base_features(product.category_id, product.brand, product.price)
+    features.update(('tag', tag_id) for tag_id in product.tags.values_list('id', flat=True))
+    return frozenset(features)
+
+
+def _load_features(product_ids=None):
+    """Feature sets of the active products among `product_ids`, or of all of them."""
+    products = Product.objects.filter(status='ACTIVE')
+    tags = Product.tags.through.objects.filter(product__status='ACTIVE')
+    if product_ids is not None:
+        products = products.filter(id__in=list(product_ids))
+        tags = tags.filter(product_id__in=list(product_ids))
+    features = {}
+    for product_id, category_id, brand, price in products.values_list('id', 'category_id', 'brand', 'price'):
+        features[product_id] = _base_features(category_id, brand, price)
+    for product_id, tag_id in tags.values_list('product_id', 'tag_id'):
+        features[product_id].add(('tag', tag_id))
+    return features
+
+
+class FeatureMatrix:
+    """
+    Features of every active product in a row normalised sparse matrix, so
+    that the product of two rows is their cosine similarity. Rows are in
+    product id order, columns are appended as new features show up.
+
+    The matrix is kept in a snapshot file between refreshes. Product changes
+    are recorded in api.index_changes, and a loaded snapshot replaces the
+    rows of the products changed since it was saved, read from the database,
+    instead of loading the whole catalogue again.
+    """
+
+    def __init__(self, features, seen=0):
+        self.columns = {}
+        self.ids, self.matrix = self._rows(features)
+        self._reindex()
+        # Last IndexChange applied, and when
+        self.seen = seen
+        self.caught_up_at = time.time()
+
+    def _rows(self, features):
+        ids = sorted(features)
+        rows, columns, values = [], [], []
+        weights = settings.RECOMMENDATION_SIMILARITY_WEIGHTS
+        for row, product_id in enumerate(ids):
+            for key in features[product_id]:
+                rows.append(row)
+                columns.append(self.columns.setdefault(key, len(self.columns)))
+                values.append(weights[key[0]])
+        matrix = sparse.csr_matrix(
+            (np.array(values, dtype=np.float64), (np.array(rows, dtype=np.int64), np.array(columns, dtype=np.int64))),
+            shape=(len(ids), len(self.columns)),
+        )
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        norms[norms == 0] = 1
+        return np.array(ids, dtype=np.int64), sparse.diags(1 / norms).dot(matrix).tocsr()
+
+    def _reindex(self):
+        self.index = {product_id: row for row, product_id in enumerate(self.ids.tolist())}
+
+    @classmethod
+    def build(cls):
+        # Changes committed while loading are applied again by catch_up
+        seen = index_changes.latest()
+        return cls(_load_features(), seen)
+
+    def features_of(self, product_ids):
+        """Columns of the current rows of `product_ids`."""
+        rows = [self.index[product_id] for product_id in product_ids if product_id in self.index]
+        return set(self.matrix[rows].indices.tolist()) if rows else set()
+
+    def update(self, product_ids):
+        """Replace the rows of `product_ids` with their features from the database."""
+        product_ids = set(product_ids)
+        keep = np.flatnonzero(~np.isin(self.ids, list(product_ids)))
+        new_ids, new_rows = self._rows(_load_features(product_ids))
+        kept = self.matrix[keep]
+        kept.resize((len(keep), len(self.columns)))
+        ids = np.r_[self.ids[keep], new_ids]
+        order = np.argsort(ids, kind='stable')
+        self.ids = ids[order]
+        self.matrix = sparse.vstack([kept, new_rows]).tocsr()[order]
+        self._reindex()
+
+    def catch_up(self, product_ids=()):
+        """
+        Replace the rows of `product_ids` and of the products changed since
+        the last call. Returns the changed product ids and the feature
+        columns of their previous rows.
+        """
+        seen, keys = index_changes.since(SIMILAR_FEATURES, self.seen)
+        changed = set(product_ids) | {int(key) for key in keys}
+        previous = self.features_of(changed)
+        self.update(changed)
+        self.seen, self.caught_up_at = seen, time.time()
+        return changed, previous
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['index']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reindex()
+
+    def save(self, path):
+        directory = os.path.dirname(path) or '.'
+        os.makedirs(directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=directory, delete=False) as snapshot:
+            pickle.dump(self, snapshot, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(snapshot.name, path)
+
+    @classmethod
+    def load(cls, path):
+        # Written by the task worker or build_recommendations on this host, never uploaded.
+        try:
+            with open(path, 'rb') as snapshot:
+                matrix = pickle.load(snapshot)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+            return None
+        # Changes older than the retention may have been purged
+        return None if index_changes.expired(matrix.caught_up_at) else matrix
+
+
+def _most_similar(matrix, ids, rows, top_k):
+    """Top `top_k` neighbours of each of `rows`, computed a block of rows at a time."""
+    neighbours = {}
+    block = max(1, 2 ** 22 // max(len(ids), 1))
+    for start in range(0, len(rows), block):
+        chunk = np.asarray(rows[start:start + block])
+        scores = matrix[chunk].dot(matrix.T).toarray().round(4)
+        scores[np.arange(len(chunk)), chunk] = 0
+
+        # Everything scoring at least the k-th best, so that ties are broken by product id
+        k = min(top_k, len(ids))
+        kth = np.partition(scores, len(ids) - k, axis=1)[:, len(ids) - k]
+        for position, row in enumerate(chunk.tolist()):
+            columns = np.flatnonzero((scores[position] >= kth[position]) & (scores[position] > 0))
+            ranked = sorted(zip((-scores[position, columns]).tolist(), ids[columns].tolist()))[:top_k]
+            neighbours[int(ids[row])] = [[product_id, -score] for score, product_id in ranked]
+    return neighbours
+
+
+def _save_similar(neighbours, removed=()):
+    with transaction.atomic():
+        ProductRecommendation.objects.filter(product_id__in=list(removed), kind=SIMILAR).delete()
+        ProductRecommendation.objects.bulk_create(
+            [
+                ProductRecommendation(product_id=product_id, kind=SIMILAR, neighbours=products)
+                for product_id, products in neighbours.items()
+            ],
+            batch_size=500, update_conflicts=True, unique_fields=['product', 'kind'],
+            update_fields=['neighbours', 'updated_at'],
+        )
+    cache.delete_many([similar_cache_key(product_id) for product_id in [*neighbours, *removed]])
+
+
+def rebuild_similar(top_k=None):
+    """Recompute the similar products of every active product, returns the number of products indexed."""
+    features = FeatureMatrix.build()
+    ids, matrix = features.ids, features.matrix
+    neighbours = _most_similar(matrix, ids, list(range(len(ids))), top_k or settings.RECOMMENDATION_TOP_K)
+    stale = ProductRecommendation.objects.filter(kind=SIMILAR).exclude(product_id__in=ids.tolist())
+    _save_similar(neighbours, removed=list(stale.values_list('product_id', flat=True)))
+    features.save(settings.RECOMMENDATION_SIMILARITY_MATRIX)
+    return len(neighbours)
+
+
+def refresh_similar(product_ids, top_k=None):
+    """
+    Update the index after products changed.
+
+    The rows of the changed products are read again and diffed against the
+    saved feature matrix. Besides the changed products themselves, only
+    products sharing an old or new feature with them can be affected, and of
+    those only the ones that listed a changed product or would now rank one
+    above their last neighbour are recomputed. Products changed by other
+    workers since the matrix was saved are refreshed too. Returns the number
+    of products recomputed.
+    """
+    top_k = top_k or settings.RECOMMENDATION_TOP_K
+    # Without a saved matrix the previous features are unknown, only the new ones find candidates
+    features = FeatureMatrix.load(settings.RECOMMENDATION_SIMILARITY_MATRIX) or FeatureMatrix.build()
+    changes, feature_columns = features.catch_up(product_ids)
+
+    ids, index, matrix = features.ids, features.index, features.matrix
+    changed = sorted(product_id for product_id in changes if product_id in index)
+    changed_rows = [index[product_id] for product_id in changed]
+    removed = [product_id for product_id in changes if product_id not in index]
+
+    feature_columns.update(matrix[changed_rows].indices.tolist())
+    candidates = np.empty(0, dtype=np.int64)
+    if feature_columns:
+        candidates = np.flatnonzero(matrix[:, sorted(feature_columns)].getnnz(axis=1))
+    candidates = np.setdiff1d(candidates, changed_rows)
+
+    stale = []
+    if len(candidates):
+        new_scores = matrix[candidates].dot(matrix[changed_rows].T).toarray().round(4) if changed_rows else None
+        current = dict(ProductRecommendation.objects.filter(
+            product_id__in=ids[candidates].tolist(), kind=SIMILAR
+        ).values_list('product_id', 'neighbours'))
+        for position, row in enumerate(candidates.tolist()):
+            listed = current.get(int(ids[row]), [])
+            if any(product_id in changes for product_id, _ in listed):
+                stale.append(row)
+            elif new_scores is not None:
+                threshold = listed[-1][1] if len(listed) >= top_k else 0
+                if ((new_scores[position] > 0) & (new_scores[position] >= threshold)).any():
+                    stale.append(row)
+
+    neighbours = _most_similar(matrix, ids, changed_rows + stale, top_k)
+    _save_similar(neighbours, removed)
+    # Saved once the recommendations are, a failed refresh is retried from the previous matrix
+    features.save(settings.RECOMMENDATION_SIMILARITY_MATRIX)
+    return len(neighbours)
+
+
+# Background refreshes, run by the task worker in batches
+
+@handler('similar_products')
+def refresh_similar_products(payloads):
+    refresh_similar({payload['product'] for payload in payloads})
+
+
+def schedule_similar_refresh(product_id):
+    """Record that a product's features changed and queue the refresh, in the transaction of the change."""
+    with transaction.atomic():
+        index_changes.record(SIMILAR_FEATURES, [product_id])
+        enqueue('similar_products', {'product': product_id})
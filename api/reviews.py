@@ -0,0 +1,76 @@
+from django.db import transaction
+from django.db.models import Case, Count, DecimalField, F, FloatField, Sum, Value, When
+from django.db.models.functions import Cast, Round
+
+from .models import Product, Review, SellerProfile, Store
+
+# Stored review aggregates: (model, sum column, count column, average column,
+# lookup from the model to the reviewed product)
+REVIEW_AGGREGATES = (
+    (Product, 'rating_sum', 'num_reviews', 'rating', 'id'),
+    (Store, 'rating_sum', 'total_reviews', 'rating', 'user__products__id'),
+    (SellerProfile, 'rating_sum', 'total_reviews', 'seller_rating', 'user__products__id'),
+)
+
+
+def _average(sum_field, count_field, rating_delta, count_delta):
+    # Evaluated against the row before the update, like the sum and count deltas.
+    return Case(
+        When(**{f'{count_field}__gt': -count_delta}, then=Round(
+            Cast(F(sum_field) + rating_delta, FloatField()) / (F(count_field) + count_delta), 2
+        )),
+        default=Value(0),
+        output_field=DecimalField(max_digits=3, decimal_places=2),
+    )
+
+
+def apply_review_delta(product_id, rating_delta, count_delta):
+    """
+    Add `rating_delta` to the rating sum and `count_delta` to the review count
+    of a product, its store and its seller, recomputing their averages in the
+    same UPDATE statements.
+    """
+    if not rating_delta and not count_delta:
+        return
+    with transaction.atomic():
+        for model, sum_field, count_field, average_field, product_lookup in REVIEW_AGGREGATES:
+            model.objects.filter(**{product_lookup: product_id}).update(**{
+                sum_field: F(sum_field) + rating_delta,
+                count_field: F(count_field) + count_delta,
+                average_field: _average(sum_field, count_field, rating_delta, count_delta),
+            })
+
+
+def _round_average(total, count):
+    return round(total / count, 2) if count else 0
+
+
+def reconcile_review_aggregates(batch_size=500, dry_run=False):
+    """
+    Recompute every stored review aggregate from the reviews and fix the rows
+    that drifted, e.g. after reviews were changed with queryset updates.
+    Returns the number of drifted rows per model.
+    """
+    drifted = {}
+    for model, sum_field, count_field, average_field, product_lookup in REVIEW_AGGREGATES:
+        group_by = 'product_id' if model is Product else 'product__user_id'
+        totals = {
+            key: (total, count)
+            for key, total, count in Review.objects.values_list(group_by).annotate(
+                total=Sum('rating'), count=Count('id')
+            ).values_list(group_by, 'total', 'count')
+        }
+
+        key_field = 'id' if model is Product else 'user_id'
+        stale = []
+        rows = model.objects.values_list('id', key_field, sum_field, count_field, average_field)
+        for pk, key, stored_sum, stored_count, stored_average in rows.iterator(chunk_size=batch_size):
+            total, count = totals.get(key, (0, 0))
+            average = _round_average(total, count)
+            if (stored_sum, stored_count) != (total, count) or abs(float(stored_average) - average) >= 0.005:
+                stale.append(model(**{'id': pk, sum_field: total, count_field: count, average_field: average}))
+
+        drifted[model.__name__] = len(stale)
+        if stale and not dry_run:
+            model.objects.bulk_update(stale, [sum_field, count_field, average_field], batch_size=batch_size)
+    return drifted
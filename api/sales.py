@@ -0,0 +1,63 @@
+from django.db import transaction
+from django.db.models import Case, F, Q, When
+from django.utils import timezone
+
+from .models import Product, SaleTransition
+
+
+def active_sale_q(now):
+    # SQL counterpart of Product.update_sale_state, for products with sale dates.
+    return (
+        Q(sale_price__isnull=False)
+        & (Q(start_sale_date__isnull=True) | Q(start_sale_date__lte=now))
+        & (Q(end_sale_date__isnull=True) | Q(end_sale_date__gt=now))
+    )
+
+
+def refresh_sale_state(queryset, now=None):
+    """Recompute is_on_sale and effective_price for `queryset` in one UPDATE."""
+    now = now or timezone.now()
+    dated = Q(start_sale_date__isnull=False) | Q(end_sale_date__isnull=False)
+    active = dated & active_sale_q(now)
+    # Both columns are computed from the row as it was before the update,
+    # so effective_price repeats the conditions instead of reading is_on_sale.
+    return queryset.update(
+        is_on_sale=Case(
+            When(sale_price__isnull=True, then=False),
+            When(active, then=True),
+            When(dated, then=False),
+            default=F('is_on_sale'),
+        ),
+        effective_price=Case(
+            When(sale_price__isnull=True, then=F('price')),
+            When(active, then=F('sale_price')),
+            When(dated, then=F('price')),
+            When(is_on_sale=True, then=F('sale_price')),
+            default=F('price'),
+        ),
+    )
+
+
+def apply_due_transitions(now=None, batch_size=500):
+    """
+    Pop transitions due at `now` from the head of the run_at ordered queue and
+    flip the sale state of their products, one batch per transaction.
+    Returns the number of products updated.
+    """
+    now = now or timezone.now()
+    updated = 0
+    while True:
+        with transaction.atomic():
+            due = list(
+                SaleTransition.objects.select_for_update()
+                .filter(run_at__lte=now).order_by('run_at').values_list('id', 'product_id')[:batch_size]
+            )
+            if not due:
+                return updated
+            product_ids = {product_id for _, product_id in due}
+            updated += refresh_sale_state(Product.objects.filter(id__in=product_ids), now)
+            SaleTransition.objects.filter(id__in=[transition_id for transition_id, _ in due]).delete()
+
+
+def next_transition_at():
+    return SaleTransition.objects.order_by('run_at').values_list('run_at', flat=True).first()
@@ -1,10 +1,57 @@
 import secrets
 import string
+from collections import defaultdict
+from datetime import timedelta
 from rest_framework import serializers
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Manager
+from django.utils import timezone
 from .models import *
+from .images import derivative_urls, load_derivatives
+from .coupons import check_coupons, redeem_coupon
+from .inventory import InsufficientStock, reserve_stock
+from .pricing import price_order
+from .recommendations import schedule_similar_refresh, similarity_features
+from .tasks import enqueue
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 
 
+class ImageDerivativesField(serializers.Field):
+    """
+    Read-only thumbnail URLs of the image in `source`, as {variant: {format: url}},
+    or None until the background worker has generated them.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+
+    def get_attribute(self, instance):
+        image = super().get_attribute(instance)
+        return image.name if image else None
+
+    def to_representation(self, value):
+        derivatives = self.context.setdefault('_image_derivatives', {})
+        if value not in derivatives:
+            derivatives.update(load_derivatives([value]))
+        return derivative_urls(derivatives.get(value), self.context.get('request'))
+
+
+class ImageDerivativeListSerializer(serializers.ListSerializer):
+    # Loads the derivatives of the whole page in one query instead of one per row.
+    def to_representation(self, data):
+        data = list(data.all() if isinstance(data, Manager) else data)
+        fields = [field for field in self.child.fields.values() if isinstance(field, ImageDerivativesField)]
+        names = {field.get_attribute(instance) for instance in data for field in fields} - {None}
+
+        derivatives = self.context.setdefault('_image_derivatives', {})
+        derivatives.update(load_derivatives(names - derivatives.keys()))
+        for name in names:
+            derivatives.setdefault(name, None)
+        return super().to_representation(data)
+
+
 class UserRegistrationSerializer(serializers.ModelSerializer):
     password = serializers.CharField(write_only=True, required=True, style={'input_type': 'password'})
     password2 = serializers.CharField(write_only=True, required=True, label='Confirm Password',
@@ -81,6 +128,7 @@ class CustomTokenObtainPairSerializer(TokenObtainPairSerializer):
 
 class UserSerializer(serializers.ModelSerializer):
     profile_picture = serializers.ImageField(required=False)
+    profile_picture_derivatives = ImageDerivativesField(source='profile_picture')
     social_links = serializers.JSONField(required=False)
     preferences = serializers.JSONField(required=False)
     role_display = serializers.SerializerMethodField()
@@ -89,10 +137,11 @@ class UserSerializer(serializers.ModelSerializer):
         model = User
         fields = (
             'id', 'username', 'email', 'phone_number', 'first_name', 'last_name',
-            'date_of_birth', 'gender', 'profile_picture', 'bio',
+            'date_of_birth', 'gender', 'profile_picture', 'profile_picture_derivatives', 'bio',
             'social_links', 'preferences', 'role', 'role_display'
         )
         read_only_fields = ('id',)
+        list_serializer_class = ImageDerivativeListSerializer
 
     def get_role_display(self, obj):
         return obj.role.name if obj.role else None
@@ -175,46 +224,76 @@ class CreatePasswordSerializer(serializers.Serializer):
 
 
 class CategorySerializer(serializers.ModelSerializer):
+    image_derivatives = ImageDerivativesField(source='image')
+
     class Meta:
         model = Category
         fields = (
-            'id', 'name', 'parent', 'slug', 'description', 'image',
+            'id', 'name', 'parent', 'slug', 'description', 'image', 'image_derivatives',
             'is_active', 'meta_title', 'meta_description', 'sort_order'
         )
+        list_serializer_class = ImageDerivativeListSerializer
 
 class ProductSerializer(serializers.ModelSerializer):
     user = serializers.StringRelatedField(read_only=True)
     category = serializers.PrimaryKeyRelatedField(queryset=Category.objects.all(), required=False, allow_null=True)
     tags = serializers.PrimaryKeyRelatedField(queryset=Tag.objects.all(), many=True, required=False, allow_null=True)
+    main_image_derivatives = ImageDerivativesField(source='main_image')
 
     class Meta:
         model = Product
         fields = [
             'id', 'user', 'name', 'sku', 'barcode', 'brand', 'description',
             'material', 'care_instructions', 'category', 'tags', 'price',
-            'sale_price', 'start_sale_date', 'end_sale_date', 'stock', 'weight',
+            'sale_price', 'effective_price', 'start_sale_date', 'end_sale_date', 'stock', 'weight',
             'dimensions', 'sizes', 'colors', 'status', 'is_featured',
-            'is_new_arrival', 'is_on_sale', 'main_image', 'video_url',
-            'meta_title', 'meta_description', 'slug'
+            'is_new_arrival', 'is_on_sale', 'rating', 'num_reviews', 'main_image', 'main_image_derivatives',
+            'video_url', 'meta_title', 'meta_description', 'slug'
         ]
-        read_only_fields = ('user', 'slug')
+        read_only_fields = ('user', 'slug', 'effective_price', 'rating', 'num_reviews')
+        list_serializer_class = ImageDerivativeListSerializer
 
     def create(self, validated_data):
         user = self.context['request'].user
         tags = validated_data.pop('tags', [])
         product = Product.objects.create(user=user, **validated_data)
         product.tags.set(tags)
+        schedule_similar_refresh(product.pk)
         return product
 
     def update(self, instance, validated_data):
         tags = validated_data.pop('tags', None)
+        previous = (instance.status, similarity_features(instance))
         for attr, value in validated_data.items():
             setattr(instance, attr, value)
         instance.save()
         if tags is not None:
             instance.tags.set(tags)
+        # Only edits that move the product in the similarity index refresh it
+        if (instance.status, similarity_features(instance)) != previous:
+            schedule_similar_refresh(instance.pk)
         return instance
 
+class ReviewImageSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ReviewImage
+        fields = ['id', 'image', 'uploaded_at']
+
+
+class ReviewSerializer(serializers.ModelSerializer):
+    user = serializers.StringRelatedField(read_only=True)
+    images = ReviewImageSerializer(many=True, read_only=True)
+
+    class Meta:
+        model = Review
+        fields = [
+            'id', 'product', 'user', 'rating', 'title', 'comment', 'images', 'video_url',
+            'is_verified_purchase', 'upvotes', 'downvotes', 'helpful_count', 'helpfulness_score',
+            'created_at', 'updated_at',
+        ]
+        read_only_fields = fields
+
+
 class PermissionSerializer(serializers.ModelSerializer):
     class Meta:
         model = Permission
@@ -273,7 +352,9 @@ class RoleSerializer(serializers.ModelSerializer):
 class StockSerializer(serializers.ModelSerializer):
     class Meta:
         model = Stock
-        fields = ['id', 'name', 'description', 'is_active', 'location', 'created_at', 'updated_at']
+        fields = [
+            'id', 'name', 'description', 'is_active', 'location', 'latitude', 'longitude', 'created_at', 'updated_at'
+        ]
 
 
 class StockProductSerializer(serializers.ModelSerializer):
@@ -285,12 +366,125 @@ class StockProductSerializer(serializers.ModelSerializer):
         fields = ['id', 'stock', 'product', 'quantity', 'created_at', 'updated_at']
 
 
+class CommaSeparatedListField(serializers.ListField):
+    """A list given as a JSON array, or as one comma separated string in query parameters."""
+
+    def to_internal_value(self, data):
+        if isinstance(data, str):
+            data = [item for item in data.split(',') if item.strip()]
+        return super().to_internal_value(data)
+
+    def get_value(self, dictionary):
+        if hasattr(dictionary, 'getlist') and self.field_name in dictionary:
+            return ','.join(dictionary.getlist(self.field_name))
+        return super().get_value(dictionary)
+
+
+class AvailabilityQuerySerializer(serializers.Serializer):
+    ids = CommaSeparatedListField(child=serializers.IntegerField(), required=False, default=list)
+    skus = CommaSeparatedListField(child=serializers.CharField(), required=False, default=list)
+    size = serializers.CharField(required=False, allow_blank=True)
+    color = serializers.CharField(required=False, allow_blank=True)
+
+    def validate(self, attrs):
+        count = len(attrs['ids']) + len(attrs['skus'])
+        if not count:
+            raise serializers.ValidationError('Pass product ids or skus.')
+        if count > settings.INVENTORY_AVAILABILITY_MAX_ITEMS:
+            raise serializers.ValidationError(
+                f'At most {settings.INVENTORY_AVAILABILITY_MAX_ITEMS} products per request.'
+            )
+        attrs['ids'] = list(dict.fromkeys(attrs['ids']))
+        attrs['skus'] = list(dict.fromkeys(attrs['skus']))
+        return attrs
+
+
+class SellerAnalyticsQuerySerializer(serializers.Serializer):
+    start = serializers.DateField(required=False)
+    end = serializers.DateField(required=False)
+    top = serializers.IntegerField(min_value=1, max_value=100, default=10)
+
+    def validate(self, attrs):
+        attrs.setdefault('end', timezone.localdate())
+        attrs.setdefault('start', attrs['end'] - timedelta(days=29))
+        if attrs['start'] > attrs['end']:
+            raise serializers.ValidationError('start must not be after end.')
+        if (attrs['end'] - attrs['start']).days >= settings.SELLER_ANALYTICS_MAX_DAYS:
+            raise serializers.ValidationError(f'At most {settings.SELLER_ANALYTICS_MAX_DAYS} days per request.')
+        return attrs
+
+
+class SellerSalesDaySerializer(serializers.Serializer):
+    day = serializers.DateField()
+    units = serializers.IntegerField()
+    revenue = serializers.DecimalField(max_digits=14, decimal_places=2)
+
+
+class SellerTopProductSerializer(serializers.Serializer):
+    product = serializers.IntegerField()
+    name = serializers.CharField()
+    units = serializers.IntegerField()
+    revenue = serializers.DecimalField(max_digits=14, decimal_places=2)
+
+
+class SellerAnalyticsSerializer(serializers.Serializer):
+    seller = serializers.IntegerField()
+    start = serializers.DateField()
+    end = serializers.DateField()
+    units = serializers.IntegerField()
+    revenue = serializers.DecimalField(max_digits=14, decimal_places=2)
+    days = SellerSalesDaySerializer(many=True)
+    top_products = SellerTopProductSerializer(many=True)
+
+
+class CartItemInputSerializer(serializers.Serializer):
+    product = serializers.IntegerField(source='product_id')
+    size = serializers.CharField(max_length=50, required=False, allow_null=True, allow_blank=True)
+    color = serializers.CharField(max_length=50, required=False, allow_null=True, allow_blank=True)
+    quantity = serializers.IntegerField(min_value=1, default=1)
+
+
+class CartItemUpdateSerializer(CartItemInputSerializer):
+    quantity = serializers.IntegerField(min_value=0, required=False)
+    is_saved_for_later = serializers.BooleanField(required=False)
+
+
+class CartLineSerializer(serializers.Serializer):
+    product = serializers.IntegerField()
+    size = serializers.CharField(allow_null=True)
+    color = serializers.CharField(allow_null=True)
+    quantity = serializers.IntegerField()
+    price_at_time = serializers.DecimalField(max_digits=12, decimal_places=2)
+    is_saved_for_later = serializers.BooleanField()
+    added_at = serializers.DateTimeField()
+
+
+class PrefetchedPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    """Resolves ids from `context[context_key]` when the parent loaded them in bulk."""
+
+    def __init__(self, context_key=None, **kwargs):
+        self.context_key = context_key
+        super().__init__(**kwargs)
+
+    def to_internal_value(self, data):
+        prefetched = self.context.get(self.context_key)
+        if prefetched is None or isinstance(data, bool):
+            return super().to_internal_value(data)
+        try:
+            return prefetched[int(data)]
+        except (KeyError, TypeError, ValueError):
+            return super().to_internal_value(data)
+
+
 class OrderItemSerializer(serializers.ModelSerializer):
+    product = PrefetchedPrimaryKeyRelatedField(queryset=Product.objects.all(), context_key='order_products')
+
     class Meta:
         model = OrderItem
         fields = [
             'product', 'quantity', 'price', 'total_price', 'size', 'color', 'weight'
         ]
+        read_only_fields = ('price', 'total_price', 'weight')
 
 class OrderSerializer(serializers.ModelSerializer):
     user = serializers.StringRelatedField()
@@ -306,37 +500,152 @@ class OrderSerializer(serializers.ModelSerializer):
             'loyalty_points_used', 'tracking_number', 'estimated_delivery_date',
             'note', 'transaction_id', 'created_at', 'updated_at', 'items'
         ]
-        read_only_fields = ('user', 'order_number', 'payment_status', 'status', 'created_at', 'updated_at')
+        read_only_fields = (
+            'user', 'order_number', 'subtotal_price', 'shipping_cost', 'discount_amount', 'tax_amount',
+            'total_price', 'total_weight', 'payment_status', 'status', 'created_at', 'updated_at'
+        )
+
+    def to_internal_value(self, data):
+        # Every line's product is loaded by one query instead of one per line
+        items = data.get('items') if hasattr(data, 'get') else None
+        if isinstance(items, list):
+            ids = {item.get('product') for item in items if isinstance(item, dict)}
+            ids = [int(pk) for pk in ids if isinstance(pk, (int, str)) and str(pk).isdigit()]
+            self.context['order_products'] = Product.objects.in_bulk(ids)
+        return super().to_internal_value(data)
+
+    def price(self, validated_data):
+        # Totals are always computed here, whatever the client sent
+        try:
+            return price_order(
+                validated_data['items'], self.context['request'].user,
+                validated_data.get('coupon'), validated_data.get('shipping_method'),
+            )
+        except ValueError as error:
+            raise serializers.ValidationError({'coupon': [str(error)]})
 
     def create(self, validated_data):
-        items_data = validated_data.pop('items')
+        quote = self.price(validated_data)
+        validated_data.pop('items')
+        items_data = quote.pop('lines')
         user = self.context['request'].user
-        order = Order.objects.create(user=user, **validated_data)
 
+        quantities = defaultdict(int)
         for item_data in items_data:
-            product = Product.objects.get(id=item_data['product'].id)
-            seller = item_data.get('seller', product.user)
-            OrderItem.objects.create(order=order, seller=seller, **item_data)
+            quantities[item_data['product'].id] += item_data['quantity']
+
+        with transaction.atomic():
+            order = Order.objects.create(user=user, **validated_data, **quote)
+
+            address = order.shipping_address
+            destination = None
+            if address and address.latitude is not None and address.longitude is not None:
+                destination = (float(address.latitude), float(address.longitude))
+            # Cash on delivery orders keep their stock, others hold it until paid
+            hold_seconds = None if order.payment_method == 'COD' else settings.STOCK_HOLD_SECONDS
+            try:
+                reserve_stock(order, quantities, destination, hold_seconds=hold_seconds)
+            except InsufficientStock as error:
+                raise serializers.ValidationError({'items': [
+                    f'Only {available} left in stock for product {product_id}.'
+                    for product_id, available in error.available.items()
+                ]})
+            if order.coupon_id:
+                try:
+                    redeem_coupon(order.coupon, user)
+                except ValueError as error:
+                    raise serializers.ValidationError({'coupon': [str(error)]})
+
+            OrderItem.objects.bulk_create([
+                OrderItem(
+                    order=order, seller_id=item_data['product'].user_id,
+                    **{field: value for field, value in item_data.items() if field != 'discount'}
+                )
+                for item_data in items_data
+            ])
+            # Rollups, notifications and the activity log are updated by the task worker
+            enqueue('order_placed', {'order': order.id})
 
         return order
 
 
+class QuoteLineSerializer(serializers.Serializer):
+    product = serializers.PrimaryKeyRelatedField(read_only=True)
+    quantity = serializers.IntegerField()
+    size = serializers.CharField(allow_null=True, required=False)
+    color = serializers.CharField(allow_null=True, required=False)
+    price = serializers.DecimalField(max_digits=12, decimal_places=2)
+    total_price = serializers.DecimalField(max_digits=12, decimal_places=2)
+    weight = serializers.DecimalField(max_digits=6, decimal_places=2)
+    discount = serializers.DecimalField(max_digits=12, decimal_places=2)
+
+
+class QuoteSerializer(serializers.Serializer):
+    lines = QuoteLineSerializer(many=True)
+    subtotal_price = serializers.DecimalField(max_digits=12, decimal_places=2)
+    shipping_cost = serializers.DecimalField(max_digits=12, decimal_places=2)
+    discount_amount = serializers.DecimalField(max_digits=12, decimal_places=2)
+    tax_amount = serializers.DecimalField(max_digits=12, decimal_places=2)
+    total_price = serializers.DecimalField(max_digits=12, decimal_places=2)
+    total_weight = serializers.DecimalField(max_digits=12, decimal_places=2)
+
+
+class OrderQuoteSerializer(OrderSerializer):
+    """The pricing inputs of an order, quoted exactly as orders/create/ would charge them."""
+
+    class Meta(OrderSerializer.Meta):
+        fields = ['items', 'coupon', 'shipping_method']
+        read_only_fields = ()
+
+    def quote(self):
+        return QuoteSerializer(self.price(self.validated_data)).data
+
+
+class CouponCheckSerializer(serializers.Serializer):
+    code = serializers.CharField()
+    valid = serializers.BooleanField()
+    message = serializers.CharField(allow_null=True)
+    discount_amount = serializers.DecimalField(max_digits=12, decimal_places=2, allow_null=True)
+    total_price = serializers.DecimalField(max_digits=12, decimal_places=2, allow_null=True)
+
+
+class CouponValidateSerializer(OrderSerializer):
+    """Coupon codes to try on a cart, the lines are optional."""
+    codes = serializers.ListField(child=serializers.CharField(max_length=50), min_length=1, max_length=20)
+    items = OrderItemSerializer(many=True, required=False)
+
+    class Meta(OrderSerializer.Meta):
+        fields = ['codes', 'items']
+        read_only_fields = ()
+
+    def check(self):
+        codes = list(dict.fromkeys(self.validated_data['codes']))
+        results = check_coupons(codes, self.context['request'].user, self.validated_data.get('items'))
+        return CouponCheckSerializer(results, many=True).data
+
+
 # Store Serializer
 class StoreSerializer(serializers.ModelSerializer):
+    store_logo_derivatives = ImageDerivativesField(source='store_logo')
+
     class Meta:
         model = Store
         fields = [
-            'id', 'user', 'store_name', 'store_description', 'store_logo', 'rating', 'total_sales', 'joined_date',
+            'id', 'user', 'store_name', 'store_description', 'store_logo', 'store_logo_derivatives', 'rating', 'total_sales', 'joined_date',
             'is_verified', 'address', 'policies', 'return_policy', 'shipping_policy', 'seller_rating', 'phone_number',
             'email', 'social_links', 'business_hours', 'store_tags', 'location_coordinates', 'total_reviews'
         ]
         read_only_fields = ['user', 'joined_date', 'rating', 'total_sales', 'seller_rating', 'total_reviews']
+        list_serializer_class = ImageDerivativeListSerializer
 
 
 class BrandSerializer(serializers.ModelSerializer):
+    brand_logo_derivatives = ImageDerivativesField(source='brand_logo')
+
     class Meta:
         model = Brand
         fields = '__all__'
+        list_serializer_class = ImageDerivativeListSerializer
 
 
 # Address Serializer
@@ -0,0 +1,242 @@
+from django.apps import apps
+from django.db import models, transaction
+from django.db.models.signals import m2m_changed, post_delete, post_init, post_save
+from django.utils import timezone
+
+from .analytics import VOID_STATUSES, refresh_order_sales, refresh_sales
+from .images import IMAGE_FIELDS, schedule_derivatives
+from .inventory import commit_reservations, sync_product_stock
+from .models import Brand, Category, Order, OrderItem, Product, Review, Stock, StockProduct, Tag
+from .promotions import RULE_KINDS, rules_changed
+from .recommendations import void_orders
+from .reviews import apply_review_delta
+from .storage import is_content_addressed, release_blobs, retain_blobs
+from .suggest import refresh_products, update_index
+
+
+def _file_name(instance, field):
+    value = instance.__dict__.get(field)
+    return getattr(value, 'name', value) or None
+
+
+# Uploaded files: image derivatives and blob reference counts
+def _tracked_file_fields(model):
+    blob_fields = tuple(
+        field.attname for field in model._meta.concrete_fields
+        if isinstance(field, models.FileField) and is_content_addressed(field)
+    )
+    return IMAGE_FIELDS.get(model, ()), blob_fields
+
+
+TRACKED_FILE_FIELDS = {}
+for model in apps.get_app_config('api').get_models():
+    image_fields, blob_fields = _tracked_file_fields(model)
+    if image_fields or blob_fields:
+        TRACKED_FILE_FIELDS[model] = (image_fields, blob_fields, tuple(set(image_fields) | set(blob_fields)))
+
+
+def _remember_file_names(sender, instance, **kwargs):
+    # Deferred fields are left out, they were not loaded so cannot have changed.
+    instance._file_names = {
+        field: _file_name(instance, field) for field in TRACKED_FILE_FIELDS[sender][2] if field in instance.__dict__
+    }
+
+
+def _changed_file_fields(fields, instance, previous, created):
+    return [
+        field for field in fields
+        if (created or field in previous) and _file_name(instance, field) != previous.get(field)
+    ]
+
+
+def _file_saved(sender, instance, created, **kwargs):
+    # Only files that changed since the instance was loaded are looked at.
+    image_fields, blob_fields, _ = TRACKED_FILE_FIELDS[sender]
+    previous = {} if created else instance._file_names
+
+    for field in _changed_file_fields(image_fields, instance, previous, created):
+        name = _file_name(instance, field)
+        if name:
+            schedule_derivatives(name, getattr(instance, field).storage)
+
+    changed = _changed_file_fields(blob_fields, instance, previous, created)
+    retain_blobs(filter(None, (_file_name(instance, field) for field in changed)))
+    release_blobs(filter(None, (previous.get(field) for field in changed)))
+
+    _remember_file_names(sender, instance)
+
+
+def _file_owner_deleted(sender, instance, **kwargs):
+    release_blobs(filter(None, (_file_name(instance, field) for field in TRACKED_FILE_FIELDS[sender][1])))
+
+
+for model, (image_fields, blob_fields, _) in TRACKED_FILE_FIELDS.items():
+    post_init.connect(_remember_file_names, sender=model, dispatch_uid=f'remember_file_names_{model.__name__}')
+    post_save.connect(_file_saved, sender=model, dispatch_uid=f'file_saved_{model.__name__}')
+    if blob_fields:
+        post_delete.connect(_file_owner_deleted, sender=model, dispatch_uid=f'file_owner_deleted_{model.__name__}')
+
+
+# Review aggregates of products, stores and sellers
+def _remember_review(sender, instance, **kwargs):
+    instance._aggregated = (instance.__dict__.get('product_id'), instance.__dict__.get('rating'))
+
+
+def _review_saved(sender, instance, created, **kwargs):
+    product_id, rating = (None, None) if created else instance._aggregated
+    if product_id != instance.product_id:
+        if product_id is not None:
+            apply_review_delta(product_id, -rating, -1)
+        apply_review_delta(instance.product_id, instance.rating, 1)
+    elif rating is not None and rating != instance.rating:
+        apply_review_delta(instance.product_id, instance.rating - rating, 0)
+    _remember_review(sender, instance)
+
+
+def _review_deleted(sender, instance, **kwargs):
+    product_id, rating = instance._aggregated
+    if product_id is not None:
+        apply_review_delta(product_id, -rating, -1)
+
+
+post_init.connect(_remember_review, sender=Review, dispatch_uid='remember_review')
+post_save.connect(_review_saved, sender=Review, dispatch_uid='review_saved')
+post_delete.connect(_review_deleted, sender=Review, dispatch_uid='review_deleted')
+
+
+# Search suggestions, applied to this process's index once the write is committed
+def _suggest_product_changed(sender, instance, **kwargs):
+    product_ids = [instance.pk]
+    transaction.on_commit(lambda: refresh_products(product_ids))
+
+
+def _suggest_tags_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    product_ids = list(pk_set or ()) if reverse else [instance.pk]
+    if product_ids:
+        transaction.on_commit(lambda: refresh_products(product_ids))
+
+
+def _suggest_group_saved(sender, instance, **kwargs):
+    if sender is Brand:
+        args = ('update_brand', instance.pk, instance.brand_name)
+    else:
+        args = ('update_group', sender.__name__.lower(), instance.pk, instance.name)
+    transaction.on_commit(lambda: update_index(*args))
+
+
+def _suggest_group_deleted(sender, instance, **kwargs):
+    args = ('remove_brand', instance.pk) if sender is Brand else ('remove_group', sender.__name__.lower(), instance.pk)
+    transaction.on_commit(lambda: update_index(*args))
+
+
+post_save.connect(_suggest_product_changed, sender=Product, dispatch_uid='suggest_product_saved')
+post_delete.connect(_suggest_product_changed, sender=Product, dispatch_uid='suggest_product_deleted')
+m2m_changed.connect(_suggest_tags_changed, sender=Product.tags.through, dispatch_uid='suggest_tags_changed')
+for model in (Category, Tag, Brand):
+    post_save.connect(_suggest_group_saved, sender=model, dispatch_uid=f'suggest_saved_{model.__name__}')
+    post_delete.connect(_suggest_group_deleted, sender=model, dispatch_uid=f'suggest_deleted_{model.__name__}')
+
+
+# Product.stock as the total of the product's rows in active warehouses
+def _remember_stocked_product(sender, instance, **kwargs):
+    instance._stocked_product_id = instance.__dict__.get('product_id')
+
+
+def _stock_product_changed(sender, instance, **kwargs):
+    sync_product_stock({instance.product_id, instance._stocked_product_id} - {None})
+    _remember_stocked_product(sender, instance)
+
+
+def _remember_stock_active(sender, instance, **kwargs):
+    instance._was_active = instance.__dict__.get('is_active')
+
+
+def _stock_saved(sender, instance, created, **kwargs):
+    if not created and instance._was_active is not None and instance._was_active != instance.is_active:
+        sync_product_stock(instance.products.values_list('product_id', flat=True))
+    _remember_stock_active(sender, instance)
+
+
+def _order_saved(sender, instance, **kwargs):
+    if instance.payment_status == 'PAID':
+        commit_reservations([instance.pk])
+
+
+post_init.connect(_remember_stocked_product, sender=StockProduct, dispatch_uid='remember_stocked_product')
+post_save.connect(_stock_product_changed, sender=StockProduct, dispatch_uid='stock_product_saved')
+post_delete.connect(_stock_product_changed, sender=StockProduct, dispatch_uid='stock_product_deleted')
+post_init.connect(_remember_stock_active, sender=Stock, dispatch_uid='remember_stock_active')
+post_save.connect(_stock_saved, sender=Stock, dispatch_uid='stock_saved')
+post_save.connect(_order_saved, sender=Order, dispatch_uid='order_saved')
+
+
+# Seller sales rollups, recomputed for the lines whose sold state may have changed
+SALES_FIELDS = ('status', 'payment_status', 'payment_method')
+
+
+def _remember_order_sale(sender, instance, **kwargs):
+    instance._sale_state = tuple(instance.__dict__.get(field) for field in SALES_FIELDS)
+
+
+def _order_sale_saved(sender, instance, created, **kwargs):
+    # New orders have no lines yet, they are counted when their lines are created
+    if not created and instance._sale_state != tuple(getattr(instance, field) for field in SALES_FIELDS):
+        refresh_order_sales([instance.pk])
+    _remember_order_sale(sender, instance)
+
+
+def _remember_order_item_sale(sender, instance, **kwargs):
+    instance._sale_key = (instance.__dict__.get('seller_id'), instance.__dict__.get('product_id'))
+
+
+def _order_item_sale_changed(sender, instance, **kwargs):
+    day = timezone.localdate(instance.order.created_at)
+    refresh_sales({(*instance._sale_key, day), (instance.seller_id, instance.product_id, day)})
+    _remember_order_item_sale(sender, instance)
+
+
+post_init.connect(_remember_order_sale, sender=Order, dispatch_uid='remember_order_sale')
+post_save.connect(_order_sale_saved, sender=Order, dispatch_uid='order_sale_saved')
+post_init.connect(_remember_order_item_sale, sender=OrderItem, dispatch_uid='remember_order_item_sale')
+post_save.connect(_order_item_sale_changed, sender=OrderItem, dispatch_uid='order_item_sale_saved')
+post_delete.connect(_order_item_sale_changed, sender=OrderItem, dispatch_uid='order_item_sale_deleted')
+
+
+# Bought-together counts, orders already folded in are taken out when voided and put back when restored
+def _remember_order_status(sender, instance, **kwargs):
+    instance._folded_status = instance.__dict__.get('status')
+
+
+def _order_status_saved(sender, instance, created, **kwargs):
+    previous = instance._folded_status
+    if not created and previous is not None and (previous in VOID_STATUSES) != (instance.status in VOID_STATUSES):
+        void_orders([instance.pk], restored=instance.status not in VOID_STATUSES)
+    _remember_order_status(sender, instance)
+
+
+post_init.connect(_remember_order_status, sender=Order, dispatch_uid='remember_order_status')
+post_save.connect(_order_status_saved, sender=Order, dispatch_uid='order_status_saved')
+
+
+# Promotion and coupon rule index, recorded with the write for the indexes of every worker
+def _rule_changed(sender, instance, **kwargs):
+    rules_changed(sender.__name__.lower(), [instance.pk])
+
+
+def _rule_scope_changed(sender, instance, action, reverse, pk_set, model, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        rules_changed(type(instance).__name__.lower(), [instance.pk])
+    elif pk_set:
+        rules_changed(model.__name__.lower(), list(pk_set))
+    # Cleared from the product, category or user side the rules are not known, the next rebuild reloads them
+
+
+for kind, (model, scopes) in RULE_KINDS.items():
+    post_save.connect(_rule_changed, sender=model, dispatch_uid=f'rule_saved_{kind}')
+    post_delete.connect(_rule_changed, sender=model, dispatch_uid=f'rule_deleted_{kind}')
+    for scope, (through, _, _) in scopes.items():
+        m2m_changed.connect(_rule_scope_changed, sender=through, dispatch_uid=f'rule_scope_{kind}_{scope}')
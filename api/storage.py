@@ -0,0 +1,105 @@
+import hashlib
+import os
+import tempfile
+
+from django.apps import apps
+from django.core.files.move import file_move_safe
+from django.core.files.storage import FileSystemStorage
+from django.db.models import F
+from django.utils import timezone
+from django.utils.deconstruct import deconstructible
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    Stores every upload once, under the sha256 of its content.
+
+    The upload is hashed while it is streamed to a temporary file next to the
+    blobs, which is then renamed to `blobs/<aa>/<sha256><ext>` or dropped when
+    that blob already exists. Identical uploads from different fields and
+    `upload_to` directories therefore share one file and one immutable URL.
+
+    Owners are counted in `StoredBlob.ref_count` by the model signals, so
+    `delete()` never removes a file another row may still use. Unreferenced
+    blobs are removed in batches by the `collect_media_blobs` command.
+    """
+    blob_dir = 'blobs'
+    chunk_size = 64 * 1024
+
+    def get_available_name(self, name, max_length=None):
+        # The final name depends on the content and is decided in `_save`.
+        return name
+
+    def _save(self, name, content):
+        extension = os.path.splitext(name)[1].lower()[:10]
+        tmp_dir = self.path(os.path.join(self.blob_dir, 'tmp'))
+        os.makedirs(tmp_dir, exist_ok=True)
+
+        hasher = hashlib.sha256()
+        size = 0
+        uploaded_to_disk = hasattr(content, 'temporary_file_path')
+        if uploaded_to_disk:
+            # Large uploads are already on disk, hash them and move the file.
+            for chunk in content.chunks(self.chunk_size):
+                hasher.update(chunk)
+                size += len(chunk)
+            tmp_path = content.temporary_file_path()
+        else:
+            with tempfile.NamedTemporaryFile(dir=tmp_dir, delete=False) as tmp:
+                for chunk in content.chunks(self.chunk_size):
+                    if isinstance(chunk, str):
+                        chunk = chunk.encode()
+                    hasher.update(chunk)
+                    tmp.write(chunk)
+                    size += len(chunk)
+            tmp_path = tmp.name
+
+        digest = hasher.hexdigest()
+        name = f'{self.blob_dir}/{digest[:2]}/{digest}{extension}'
+        full_path = self.path(name)
+
+        if os.path.exists(full_path):
+            if not uploaded_to_disk:
+                os.remove(tmp_path)
+        else:
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            file_move_safe(tmp_path, full_path, allow_overwrite=True)
+            if self.file_permissions_mode is not None:
+                os.chmod(full_path, self.file_permissions_mode)
+
+        # Refreshing `last_uploaded_at` keeps a blob that is being reused
+        # out of the current garbage collection window.
+        StoredBlob = apps.get_model('api', 'StoredBlob')
+        StoredBlob.objects.bulk_create(
+            [StoredBlob(name=name, content_hash=digest, size=size, last_uploaded_at=timezone.now())],
+            update_conflicts=True, unique_fields=['name'], update_fields=['last_uploaded_at'],
+        )
+        return name
+
+    def delete(self, name):
+        # Blobs are shared, they are only removed by the garbage collector.
+        if not name.startswith(f'{self.blob_dir}/'):
+            super().delete(name)
+
+    def purge(self, name):
+        super().delete(name)
+
+
+def is_content_addressed(field):
+    return isinstance(field.storage, ContentAddressedStorage)
+
+
+def retain_blobs(names):
+    StoredBlob = apps.get_model('api', 'StoredBlob')
+    for name in names:
+        StoredBlob.objects.filter(name=name).update(ref_count=F('ref_count') + 1)
+
+
+def release_blobs(names):
+    StoredBlob = apps.get_model('api', 'StoredBlob')
+    for name in names:
+        StoredBlob.objects.filter(name=name, ref_count__gt=0).update(ref_count=F('ref_count') - 1)
+
+
+content_addressed_storage = ContentAddressedStorage()
@@ -0,0 +1,365 @@
+import bisect
+import heapq
+import logging
+import os
+import pickle
+import tempfile
+import threading
+import time
+import unicodedata
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connections
+
+from .models import Brand, Category, Product, Tag
+
+logger = logging.getLogger(__name__)
+
+
+def normalize(text):
+    # Case and accent insensitive, "Áo thun-Đỏ" becomes "ao thun do"
+    text = unicodedata.normalize('NFKD', (text or '').replace('đ', 'd').replace('Đ', 'D'))
+    text = ''.join(char for char in text if not unicodedata.combining(char)).lower()
+    return ' '.join(''.join(char if char.isalnum() else ' ' for char in text).split())
+
+
+def _keys(label):
+    # Every word start is a key, so "shi" finds "Cotton Shirt"
+    words = normalize(label).split()
+    return {' '.join(words[position:]) for position in range(len(words))}
+
+
+class SuggestIndex:
+    """
+    Typeahead index over product names, category names, brands and tags.
+
+    Keys are kept in one sorted list of (key, entry) tuples, so the keys under
+    a prefix are a slice found with two bisections. Entries are ranked by
+    weight: the quantity_sold of a product, or the summed quantity_sold of the
+    active products in a category, brand or tag.
+
+    Prefixes covering more than `scan_limit` keys are never scanned. Their
+    ranking is merged from the rankings of their one character longer
+    prefixes and memoised, which makes the sorted list behave like a trie
+    with the top results stored on every large node. A change only drops
+    the memoised prefixes of the keys it touched.
+    """
+    scan_limit = 256
+
+    def __init__(self):
+        self.keys = []
+        self.labels = {}
+        self.weights = defaultdict(int)
+        # Per product (quantity_sold, category id, brand key, tag ids), to undo its contributions
+        self.products = {}
+        # Active products and Brand rows per brand key, brands without any are dropped
+        self.brand_refs = defaultdict(int)
+        self.brand_rows = {}
+        self.cache = {}
+        self.built_at = time.time()
+        self.lock = threading.RLock()
+        self._building = False
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        state['weights'] = dict(self.weights)
+        state['brand_refs'] = dict(self.brand_refs)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.weights = defaultdict(int, self.weights)
+        self.brand_refs = defaultdict(int, self.brand_refs)
+        self.lock = threading.RLock()
+
+    # Entries
+
+    def _invalidate(self, keys):
+        if not self.cache:
+            return
+        for key in keys:
+            for length in range(len(key) + 1):
+                self.cache.pop(key[:length], None)
+
+    def _set_entry(self, entry, label):
+        if self.labels.get(entry) == label:
+            return
+        self._remove_entry(entry, keep_weight=True)
+        self.labels[entry] = label
+        keys = _keys(label)
+        for key in keys:
+            if self._building:
+                self.keys.append((key, entry))
+            else:
+                bisect.insort(self.keys, (key, entry))
+        self._invalidate(keys)
+
+    def _remove_entry(self, entry, keep_weight=False):
+        label = self.labels.pop(entry, None)
+        if not keep_weight:
+            self.weights.pop(entry, None)
+        if label is None:
+            return
+        keys = _keys(label)
+        for key in keys:
+            position = bisect.bisect_left(self.keys, (key, entry))
+            if position < len(self.keys) and self.keys[position] == (key, entry):
+                del self.keys[position]
+        self._invalidate(keys)
+
+    def _add_weight(self, entry, delta):
+        if delta:
+            self.weights[entry] += delta
+            if entry in self.labels:
+                self._invalidate(_keys(self.labels[entry]))
+
+    def _ref_brand(self, key, label, delta):
+        self.brand_refs[key] += delta
+        if self.brand_refs[key] <= 0:
+            del self.brand_refs[key]
+            self._remove_entry(('brand', key))
+        elif ('brand', key) not in self.labels:
+            self._set_entry(('brand', key), label)
+
+    def _contribute(self, product, sign):
+        quantity_sold, category_id, brand_key, brand, tag_ids = product
+        if category_id:
+            self._add_weight(('category', category_id), sign * quantity_sold)
+        if brand_key:
+            # The brand entry exists while it has references, weight it only then
+            if sign > 0:
+                self._ref_brand(brand_key, brand, sign)
+            self._add_weight(('brand', brand_key), sign * quantity_sold)
+            if sign < 0:
+                self._ref_brand(brand_key, brand, sign)
+        for tag_id in tag_ids:
+            self._add_weight(('tag', tag_id), sign * quantity_sold)
+
+    # Updates
+
+    def update_product(self, product_id, name='', quantity_sold=0, category_id=None, brand='', tag_ids=(),
+                       active=True):
+        with self.lock:
+            previous = self.products.pop(product_id, None)
+            if previous:
+                self._contribute(previous, -1)
+            if not active:
+                self._remove_entry(('product', product_id))
+                return
+            product = (quantity_sold, category_id, normalize(brand), brand.strip(), frozenset(tag_ids))
+            self.products[product_id] = product
+            self._contribute(product, 1)
+            self._set_entry(('product', product_id), name)
+            self._add_weight(('product', product_id), quantity_sold - self.weights[('product', product_id)])
+
+    def update_group(self, kind, group_id, label):
+        with self.lock:
+            self._set_entry((kind, group_id), label)
+
+    def remove_group(self, kind, group_id):
+        with self.lock:
+            self._remove_entry((kind, group_id))
+
+    def update_brand(self, brand_id, label):
+        with self.lock:
+            self.remove_brand(brand_id)
+            key = normalize(label)
+            if key:
+                self.brand_rows[brand_id] = key
+                self._ref_brand(key, label.strip(), 1)
+
+    def remove_brand(self, brand_id):
+        with self.lock:
+            key = self.brand_rows.pop(brand_id, None)
+            if key:
+                self._ref_brand(key, '', -1)
+
+    # Lookups
+
+    def _top(self, prefix, start=None, end=None):
+        ranked = self.cache.get(prefix)
+        if ranked is not None:
+            return ranked
+        keys = self.keys
+        if start is None:
+            start = bisect.bisect_left(keys, (prefix,))
+            end = bisect.bisect_left(keys, (prefix + '\uffff',), start)
+
+        weights, labels = self.weights, self.labels
+        limit = settings.SEARCH_SUGGEST_MAX_RESULTS
+        if end - start <= self.scan_limit:
+            entries = {entry for _, entry in keys[start:end]}
+            return heapq.nsmallest(limit, entries, key=lambda entry: (-weights[entry], labels[entry]))
+
+        # Keys equal to the prefix come first, then one slice per next character
+        depth = len(prefix)
+        entries = set()
+        position = start
+        while position < end and len(keys[position][0]) == depth:
+            entries.add(keys[position][1])
+            position += 1
+        while position < end:
+            child = keys[position][0][:depth + 1]
+            child_end = bisect.bisect_left(keys, (child + '\uffff',), position, end)
+            entries.update(self._top(child, position, child_end))
+            position = child_end
+
+        ranked = heapq.nsmallest(limit, entries, key=lambda entry: (-weights[entry], labels[entry]))
+        self.cache[prefix] = ranked
+        return ranked
+
+    def suggest(self, query, limit=10):
+        prefix = normalize(query)
+        if not prefix:
+            return []
+        with self.lock:
+            return [
+                {'type': kind, 'id': ref, 'label': self.labels[(kind, ref)], 'weight': self.weights[(kind, ref)]}
+                for kind, ref in self._top(prefix)[:limit]
+            ]
+
+    # Loading
+
+    @classmethod
+    def build(cls):
+        index = cls()
+        index.start_build()
+        for category_id, name in Category.objects.values_list('id', 'name'):
+            index.update_group('category', category_id, name)
+        for tag_id, name in Tag.objects.values_list('id', 'name'):
+            index.update_group('tag', tag_id, name)
+        for brand_id, name in Brand.objects.values_list('id', 'brand_name'):
+            index.update_brand(brand_id, name)
+
+        tags = defaultdict(list)
+        links = Product.tags.through.objects.filter(product__status='ACTIVE').values_list('product_id', 'tag_id')
+        for product_id, tag_id in links.iterator(chunk_size=5000):
+            tags[product_id].append(tag_id)
+        products = Product.objects.filter(status='ACTIVE').values_list(
+            'id', 'name', 'quantity_sold', 'category_id', 'brand'
+        )
+        for product_id, name, quantity_sold, category_id, brand in products.iterator(chunk_size=5000):
+            index.update_product(product_id, name, quantity_sold, category_id, brand, tags[product_id])
+
+        index.finish_build()
+        return index
+
+    def start_build(self):
+        # Keys are appended unsorted until finish_build
+        self._building = True
+
+    def finish_build(self):
+        self.keys.sort()
+        self._building = False
+        # Rank every large prefix now rather than on the first requests
+        with self.lock:
+            self._top('')
+
+    def save_snapshot(self, path):
+        directory = os.path.dirname(path) or '.'
+        os.makedirs(directory, exist_ok=True)
+        with self.lock, tempfile.NamedTemporaryFile(dir=directory, delete=False) as snapshot:
+            pickle.dump(self, snapshot, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(snapshot.name, path)
+
+    @classmethod
+    def load_snapshot(cls, path, max_age):
+        # Snapshots are written by build_suggest_index on this host, never uploaded.
+        try:
+            if time.time() - os.path.getmtime(path) > max_age:
+                return None
+            with open(path, 'rb') as snapshot:
+                return pickle.load(snapshot)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+
+
+# Process wide index, loaded on first use and rebuilt in the background once
+# SEARCH_SUGGEST_MAX_AGE has passed. Writes in this process are applied right
+# away by the model signals, other workers see them after their next rebuild.
+# Writes made while a rebuild runs are queued and applied to the new index
+# before it is swapped in.
+
+_index = None
+_index_lock = threading.Lock()
+_rebuilding = False
+_queued = None
+
+
+def _apply(index, method, args):
+    if method == 'refresh_products':
+        _load_products(index, *args)
+    else:
+        getattr(index, method)(*args)
+
+
+def _rebuild():
+    global _index, _rebuilding, _queued
+    try:
+        index = SuggestIndex.build()
+        while True:
+            with _index_lock:
+                changes, _queued = _queued, []
+                if not changes:
+                    _index = index
+                    break
+            for method, args in changes:
+                _apply(index, method, args)
+    except Exception:
+        logger.exception('Could not rebuild the suggest index')
+    finally:
+        with _index_lock:
+            _rebuilding = False
+            _queued = None
+        connections.close_all()
+
+
+def get_index():
+    global _index, _rebuilding, _queued
+    with _index_lock:
+        if _index is None:
+            _index = SuggestIndex.load_snapshot(settings.SEARCH_SUGGEST_SNAPSHOT, settings.SEARCH_SUGGEST_MAX_AGE)
+            if _index is None:
+                _index = SuggestIndex.build()
+        elif not _rebuilding and time.time() - _index.built_at > settings.SEARCH_SUGGEST_MAX_AGE:
+            _rebuilding = True
+            _queued = []
+            threading.Thread(target=_rebuild, name='suggest-index', daemon=True).start()
+    return _index
+
+
+def _load_products(index, product_ids):
+    tags = defaultdict(list)
+    for product_id, tag_id in Product.tags.through.objects.filter(product_id__in=product_ids).values_list(
+        'product_id', 'tag_id'
+    ):
+        tags[product_id].append(tag_id)
+
+    missing = set(product_ids)
+    rows = Product.objects.filter(id__in=product_ids).values_list(
+        'id', 'name', 'quantity_sold', 'category_id', 'brand', 'status'
+    )
+    for product_id, name, quantity_sold, category_id, brand, status in rows:
+        missing.discard(product_id)
+        index.update_product(
+            product_id, name, quantity_sold, category_id, brand, tags[product_id], active=status == 'ACTIVE'
+        )
+    for product_id in missing:
+        index.update_product(product_id, active=False)
+
+
+def update_index(method, *args):
+    with _index_lock:
+        index = _index
+        if _queued is not None:
+            _queued.append((method, args))
+    # Signals only keep a loaded index current, they never load one.
+    if index is not None:
+        _apply(index, method, args)
+
+
+def refresh_products(product_ids):
+    """Reload products into this process's index after they were saved, deleted or retagged."""
+    update_index('refresh_products', product_ids)
@@ -0,0 +1,168 @@
+import logging
+import random
+import traceback
+import uuid
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, Min, Q
+from django.utils import timezone
+
+from .analytics import refresh_order_sales
+from .models import ActivityLog, Notification, Order, Task
+
+logger = logging.getLogger(__name__)
+
+# Tasks are rows of the Task table, written in the transaction of the change
+# that needs them, so they exist exactly when that change was committed.
+# Workers claim due tasks with an UPDATE stamping their own token, which
+# needs no row locks or broker and works on SQLite, then run them grouped by
+# name: a handler gets the payloads of a whole batch at once. Done tasks are
+# deleted. A failed batch is split in halves that are run again, down to
+# single tasks, so one bad payload fails only its own task. Failed tasks are
+# retried with exponential backoff and jitter up to max_attempts, then left
+# as FAILED. Tasks of a worker that died are
+# claimed again once their lease has expired.
+
+HANDLERS = {}
+
+
+def handler(name):
+    """Register a function taking a list of payloads as the handler of task `name`."""
+    def register(function):
+        HANDLERS[name] = function
+        return function
+    return register
+
+
+def enqueue(name, payload=None, delay=0, max_attempts=None):
+    return enqueue_many(name, [payload or {}], delay, max_attempts)[0]
+
+
+def enqueue_many(name, payloads, delay=0, max_attempts=None):
+    if name not in HANDLERS:
+        raise ValueError(f'No handler for task {name!r}')
+    run_at = timezone.now() + timedelta(seconds=delay)
+    max_attempts = max_attempts or settings.TASK_QUEUE_MAX_ATTEMPTS
+    return Task.objects.bulk_create([
+        Task(name=name, payload=payload, run_at=run_at, max_attempts=max_attempts) for payload in payloads
+    ])
+
+
+def _due(now):
+    return Q(status='PENDING', run_at__lte=now) | Q(status='RUNNING', locked_until__lt=now)
+
+
+def claim(batch_size, now=None):
+    """Claim up to `batch_size` due tasks for this worker, oldest first."""
+    now = now or timezone.now()
+    ids = list(Task.objects.filter(_due(now)).order_by('run_at', 'id').values_list('id', flat=True)[:batch_size])
+    if not ids:
+        return []
+    token = uuid.uuid4().hex
+    # Tasks claimed by another worker in the meantime no longer match _due
+    Task.objects.filter(_due(now), id__in=ids).update(
+        status='RUNNING', claimed_by=token, attempts=F('attempts') + 1,
+        locked_until=now + timedelta(seconds=settings.TASK_QUEUE_LEASE_SECONDS),
+    )
+    return list(Task.objects.filter(claimed_by=token, status='RUNNING').order_by('run_at', 'id'))
+
+
+def backoff(attempts):
+    delay = min(settings.TASK_QUEUE_RETRY_BASE_SECONDS * 2 ** (attempts - 1), settings.TASK_QUEUE_RETRY_MAX_SECONDS)
+    return delay * random.uniform(0.5, 1)
+
+
+def _failed(tasks, error):
+    now = timezone.now()
+    retried, dead = [], []
+    for task in tasks:
+        task.last_error = error
+        task.locked_until = None
+        if task.attempts >= task.max_attempts:
+            task.status = 'FAILED'
+            dead.append(task)
+        else:
+            task.status = 'PENDING'
+            task.run_at = now + timedelta(seconds=backoff(task.attempts))
+            retried.append(task)
+    Task.objects.bulk_update(retried + dead, ['status', 'run_at', 'locked_until', 'last_error'])
+    if dead:
+        logger.error('%d %s tasks failed for good: %s', len(dead), tasks[0].name, error.splitlines()[-1])
+
+
+def _run(function, group):
+    try:
+        with transaction.atomic():
+            function([task.payload for task in group])
+    except Exception:
+        if len(group) > 1:
+            # Bisected: the tasks of the half that succeeds are done
+            middle = len(group) // 2
+            _run(function, group[:middle])
+            _run(function, group[middle:])
+            return
+        logger.exception('%s task %s failed', group[0].name, group[0].id)
+        _failed(group, traceback.format_exc())
+    else:
+        Task.objects.filter(id__in=[task.id for task in group], claimed_by=group[0].claimed_by).delete()
+
+
+def run_tasks(batch_size=None):
+    """Claim and run one batch of due tasks. Returns the number of tasks claimed."""
+    tasks = claim(batch_size or settings.TASK_QUEUE_BATCH_SIZE)
+    by_name = defaultdict(list)
+    for task in tasks:
+        by_name[task.name].append(task)
+    for name, group in by_name.items():
+        function = HANDLERS.get(name)
+        if function is None:
+            _failed(group, f'No handler for task {name!r}')
+            continue
+        _run(function, group)
+    return len(tasks)
+
+
+def next_task_at():
+    return Task.objects.filter(status='PENDING').order_by('run_at').values_list('run_at', flat=True).first()
+
+
+def queue_stats(now=None):
+    """Tasks per name and status, and the lag: how long the oldest due task has been waiting."""
+    now = now or timezone.now()
+    depth = defaultdict(dict)
+    totals = defaultdict(int)
+    for row in Task.objects.values('name', 'status').annotate(count=Count('id')).order_by():
+        depth[row['name']][row['status']] = row['count']
+        totals[row['status']] += row['count']
+    oldest = Task.objects.filter(_due(now)).aggregate(oldest=Min('run_at'))['oldest']
+    return {
+        'pending': totals['PENDING'],
+        'running': totals['RUNNING'],
+        'failed': totals['FAILED'],
+        'lag_seconds': round((now - oldest).total_seconds(), 3) if oldest else 0,
+        'by_name': dict(depth),
+    }
+
+
+# Side effects of new orders, kept out of the order request
+
+@handler('order_placed')
+def order_placed(payloads):
+    order_ids = [payload['order'] for payload in payloads]
+    refresh_order_sales(order_ids)
+    orders = Order.objects.filter(id__in=order_ids).values('id', 'user_id', 'order_number', 'total_price')
+    Notification.objects.bulk_create([
+        Notification(
+            user_id=order['user_id'], notification_type='ORDER_PLACED',
+            message=f"Your order {order['order_number']} has been placed.",
+            data={'order': order['id'], 'total_price': str(order['total_price'])},
+        )
+        for order in orders
+    ])
+    ActivityLog.objects.bulk_create([
+        ActivityLog(user_id=order['user_id'], action='order_placed', description=f"Order {order['order_number']}")
+        for order in orders
+    ])
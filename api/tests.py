@@ -1,3 +1,1199 @@
-from django.test import TestCase
+import base64
+import hashlib
+import hmac
+import io
+import itertools
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import Counter
+from decimal import Decimal
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import ProtectedError
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory
+
+from . import (
+    carts, fast_serializers, inventory, order_numbers, parsers, promotions, recommendations, renderers, suggest,
+)
+from .analytics import refresh_order_sales
+from .coupons import redeem_coupon
+from .parsers import FastJSONParser
+from .pricing import price_order
+from .renderers import FastJSONRenderer
+from .reviews import reconcile_review_aggregates
+from .storage import content_addressed_storage
+from .inventory import release_expired_holds
+from .models import (
+    Cart, CartItem, Category, Coupon, IdempotencyKey, ImageDerivative, Order, OrderItem, Product, ProductCooccurrence,
+    ProductRecommendation, Promotion, Review, Role, SaleTransition, ShippingMethod, Stock, StockProduct,
+    StockReservation, Store, StoredBlob, Tag, Task, Transaction, User,
+)
+from .tasks import HANDLERS, backoff, enqueue_many, run_tasks
+from .management.commands import explain_list_queries
+from .views import OrderListView, ProductListView, UserRegistrationView
+
+WEBHOOK_SECRET = 'test-secret'
+
+
+def make_product(seller, n, **fields):
+    category = Category.objects.get_or_create(slug='shirts', defaults={'name': 'Shirts'})[0]
+    return Product.objects.create(**{
+        'user': seller, 'name': f'Shirt {n}', 'sku': f'SHIRT-{n}', 'description': 'A shirt', 'category': category,
+        'price': Decimal('10.00'), 'stock': 5, **fields,
+    })
+
+
+def sign(body, secret=WEBHOOK_SECRET):
+    return hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+
+@override_settings(PAYMENT_WEBHOOK_SECRET=WEBHOOK_SECRET, PAYMENT_WEBHOOK_ALLOW_UNSIGNED=False)
+class PaymentWebhookTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='buyer')
+        self.order = Order.objects.create(user=self.user, payment_method='CREDIT_CARD', total_price='100.00')
+        self.client = APIClient()
+
+    def post(self, events, signature=None):
+        body = json.dumps(events).encode()
+        headers = {} if signature is False else {'HTTP_X_SIGNATURE': signature or sign(body)}
+        return self.client.post('/api/payments/webhook/', body, content_type='application/json', **headers)
+
+    def event(self, transaction_id='tx-1', amount='100.00', status='SUCCESS'):
+        return {'transaction_id': transaction_id, 'order': self.order.id, 'status': status, 'amount': amount}
+
+    def test_refuses_every_call_without_a_secret(self):
+        with override_settings(PAYMENT_WEBHOOK_SECRET=None, DEBUG=True):
+            response = self.post(self.event(), signature=False)
+        self.assertEqual(response.status_code, 403)
+        run_tasks()
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.payment_status, 'UNPAID')
+        self.assertFalse(Transaction.objects.exists())
+
+    def test_unsigned_calls_need_the_opt_in(self):
+        with override_settings(PAYMENT_WEBHOOK_SECRET=None, PAYMENT_WEBHOOK_ALLOW_UNSIGNED=True):
+            response = self.post(self.event(), signature=False)
+        self.assertEqual(response.status_code, 202)
+
+    def test_refuses_bad_and_missing_signatures(self):
+        self.assertEqual(self.post(self.event(), signature=sign(b'other body')).status_code, 403)
+        self.assertEqual(self.post(self.event(), signature=False).status_code, 403)
+        self.assertFalse(Transaction.objects.exists())
+
+    def test_duplicate_events_are_stored_and_applied_once(self):
+        first = self.post(self.event())
+        again = self.post([self.event(), self.event(), self.event('tx-2', status='FAILED')])
+        self.assertEqual(first.status_code, 202)
+        self.assertEqual(first.data['accepted'], 1)
+        self.assertEqual((again.data['accepted'], again.data['duplicates']), (1, 2))
+        self.assertEqual(Transaction.objects.filter(transaction_id='tx-1').count(), 1)
+
+        run_tasks()
+        self.order.refresh_from_db()
+        self.assertEqual((self.order.payment_status, self.order.transaction_id), ('PAID', 'tx-1'))
+
+    def test_events_stored_by_a_concurrent_call_are_not_counted_or_queued(self):
+        lookup = Order.objects.filter
+
+        def insert_concurrently(*args, **kwargs):
+            # Runs between the lookup of stored events and the insert
+            if not Transaction.objects.exists():
+                Transaction.objects.create(
+                    user=self.user, order=self.order, amount='100.00', payment_method='CREDIT_CARD',
+                    status='SUCCESS', transaction_id='tx-1',
+                )
+            return lookup(*args, **kwargs)
+
+        with mock.patch.object(Order.objects, 'filter', side_effect=insert_concurrently):
+            response = self.post([self.event(), self.event('tx-2', status='FAILED')])
+        self.assertEqual((response.data['accepted'], response.data['duplicates']), (1, 1))
+        self.assertEqual(Transaction.objects.count(), 2)
+        self.assertEqual([task.payload for task in Task.objects.filter(name='payment_events')],
+                         [{'transactions': ['tx-2']}])
+
+    def test_short_payments_and_refunds(self):
+        self.post(self.event(amount='99.99'))
+        run_tasks()
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.payment_status, 'UNPAID')
+
+        self.post([self.event('tx-2'), self.event('tx-3', status='REFUNDED')])
+        run_tasks()
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.payment_status, 'REFUNDED')
+
+    def test_rejects_invalid_events_without_failing_the_call(self):
+        response = self.post([self.event(), {'transaction_id': 'tx-2', 'order': 0, 'status': 'SUCCESS', 'amount': 1}, 'x'])
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual([item['index'] for item in response.data['rejected']], [1, 2])
+
+
+class IdempotencyTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+
+    def register(self, key='key-1', username='alice'):
+        data = {'username': username, 'email': f'{username}@example.com', 'password': 'S3cret-pass',
+                'password2': 'S3cret-pass'}
+        return self.client.post('/api/register', data, format='json', HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_replays_the_first_response_without_tokens(self):
+        first = self.register()
+        again = self.register()
+        self.assertEqual(first.status_code, 201)
+        self.assertIn('access', first.data)
+        self.assertEqual(again.status_code, 201)
+        self.assertEqual(again['Idempotent-Replayed'], 'true')
+        self.assertEqual(again.data, {'user': first.data['user']})
+        self.assertEqual(User.objects.filter(username='alice').count(), 1)
+        self.assertNotIn(first.data['access'].encode(), IdempotencyKey.objects.get().response)
+
+    def test_refuses_a_key_reused_for_another_request(self):
+        self.register()
+        response = self.register(username='bob')
+        self.assertEqual(response.status_code, 422)
+        self.assertFalse(User.objects.filter(username='bob').exists())
+
+    @override_settings(IDEMPOTENCY_WAIT_SECONDS=0)
+    def test_duplicates_of_a_running_request_do_not_run(self):
+        create = UserRegistrationView.create
+        duplicates = []
+
+        def create_and_resend(view, request, *args, **kwargs):
+            duplicates.append(self.register())
+            return create(view, request, *args, **kwargs)
+
+        with mock.patch.object(UserRegistrationView, 'create', create_and_resend):
+            response = self.register()
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(duplicates[0].status_code, 409)
+        self.assertEqual(User.objects.filter(username='alice').count(), 1)
+
+    def test_failed_and_abandoned_claims_are_released(self):
+        with mock.patch.object(UserRegistrationView, 'create', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.register()
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+        self.register()
+        IdempotencyKey.objects.update(status_code=None, response=None, locked_until=timezone.now() - timedelta(seconds=1))
+        cache.clear()
+        User.objects.all().delete()
+        self.assertEqual(self.register().status_code, 201)
+        self.assertEqual(User.objects.count(), 1)
+
+
+@override_settings(TASK_QUEUE_RETRY_BASE_SECONDS=10, TASK_QUEUE_RETRY_MAX_SECONDS=60)
+class TaskQueueTests(TestCase):
+    def setUp(self):
+        self.batches = []
+        patcher = mock.patch.dict(HANDLERS, {'echo': self.echo})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def echo(self, payloads):
+        self.batches.append([payload['n'] for payload in payloads])
+        if any(payload.get('fail') for payload in payloads):
+            raise ValueError('bad payload')
+
+    def test_runs_a_batch_at_once_and_deletes_done_tasks(self):
+        enqueue_many('echo', [{'n': n} for n in range(3)])
+        self.assertEqual(run_tasks(), 3)
+        self.assertEqual(self.batches, [[0, 1, 2]])
+        self.assertFalse(Task.objects.exists())
+
+    def test_a_bad_payload_fails_only_its_own_task(self):
+        enqueue_many('echo', [{'n': n, 'fail': n == 2} for n in range(5)])
+        started = timezone.now()
+        run_tasks()
+        task = Task.objects.get()
+        self.assertEqual((task.payload['n'], task.status, task.attempts), (2, 'PENDING', 1))
+        self.assertIn('bad payload', task.last_error)
+        # Backoff of the first retry: 10s with jitter down to half
+        self.assertGreaterEqual(task.run_at, started + timedelta(seconds=5))
+        self.assertLessEqual(task.run_at, timezone.now() + timedelta(seconds=10))
+        self.assertEqual(sorted(n for batch in self.batches if len(batch) == 1 for n in batch), [2])
+
+    def test_retries_until_max_attempts_then_fails(self):
+        enqueue_many('echo', [{'n': 0, 'fail': True}], max_attempts=3)
+        for attempt in range(3):
+            self.assertEqual(run_tasks(), 1)
+            # Not due again until its backoff has passed
+            self.assertEqual(run_tasks(), 0)
+            Task.objects.update(run_at=timezone.now())
+        task = Task.objects.get()
+        self.assertEqual((task.status, task.attempts), ('FAILED', 3))
+        self.assertEqual(run_tasks(), 0)
+
+    def test_backoff_doubles_up_to_the_maximum(self):
+        with mock.patch('api.tasks.random.uniform', return_value=1):
+            self.assertEqual([backoff(attempts) for attempts in range(1, 6)], [10, 20, 40, 60, 60])
+
+    def test_tasks_of_a_dead_worker_are_claimed_again(self):
+        enqueue_many('echo', [{'n': 0}])
+        Task.objects.update(status='RUNNING', claimed_by='dead', locked_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(run_tasks(), 1)
+        self.assertFalse(Task.objects.exists())
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+            'carts': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'test-carts'}},
+)
+class CartTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='shopper')
+        self.owner = ('user', self.user.pk)
+        seller = User.objects.create(username='seller')
+        self.products = [make_product(seller, n) for n in range(2)]
+        self.addCleanup(carts._cache().clear)
+
+    def quantities(self, entry):
+        return {line['product']: line['quantity'] for line in entry['lines'].values()}
+
+    def stored(self, owner=None):
+        items = CartItem.objects.filter(cart__in=Cart.objects.filter(**carts._owner_filter(owner or self.owner)))
+        return dict(items.values_list('product_id', 'quantity'))
+
+    def test_changes_make_no_database_writes_until_flushed(self):
+        carts.add_item(self.owner, self.products[0].id)
+        with CaptureQueriesContext(connection) as queries:
+            carts.add_item(self.owner, self.products[1].id, quantity=2)
+            for _ in range(5):
+                carts.add_item(self.owner, self.products[0].id)
+            carts.update_item(self.owner, self.products[1].id, quantity=3)
+            carts.get_cart(self.owner)
+        self.assertEqual([query['sql'] for query in queries if not query['sql'].startswith('SELECT')], [])
+        self.assertFalse(Cart.objects.exists())
+
+        self.assertEqual(carts.flush_journal(), 1)
+        self.assertEqual(self.stored(), {self.products[0].id: 6, self.products[1].id: 3})
+        self.assertEqual(carts.flush_journal(), 0)
+
+    def test_carts_changed_after_a_flush_are_journaled_again(self):
+        carts.add_item(self.owner, self.products[0].id)
+        carts.flush_journal()
+        carts.update_item(self.owner, self.products[0].id, quantity=4)
+        self.assertEqual(carts.flush_journal(), 1)
+        cart = Cart.objects.get(user=self.user)
+        self.assertEqual((cart.version, self.stored()), (2, {self.products[0].id: 4}))
+        carts._cache().clear()
+        self.assertEqual(self.quantities(carts.get_cart(self.owner)), {self.products[0].id: 4})
+
+    def test_flush_writes_the_latest_version_once(self):
+        carts.add_item(self.owner, self.products[0].id)
+        carts.update_item(self.owner, self.products[0].id, quantity=4)
+        self.assertTrue(carts.flush(self.owner))
+        self.assertFalse(carts.flush(self.owner))
+        self.assertEqual(self.stored(), {self.products[0].id: 4})
+        # An older copy of the cart is not written over a newer one
+        stale = carts._cache().get(carts._key(self.owner))
+        carts.update_item(self.owner, self.products[0].id, quantity=5)
+        carts.flush(self.owner)
+        carts._cache().set(carts._key(self.owner), stale)
+        self.assertFalse(carts.flush(self.owner))
+        self.assertEqual(self.stored(), {self.products[0].id: 5})
+
+    def test_concurrent_changes_of_a_cart_are_not_lost(self):
+        carts.add_item(self.owner, self.products[0].id)
+
+        def click():
+            for _ in range(20):
+                carts.add_item(self.owner, self.products[0].id)
+
+        threads = [threading.Thread(target=click) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.quantities(carts.get_cart(self.owner)), {self.products[0].id: 81})
+
+    def test_merging_a_guest_cart_adds_up_lines_once(self):
+        guest = ('session', 'guest-session')
+        carts.add_item(guest, self.products[0].id, quantity=2)
+        carts.add_item(guest, self.products[1].id)
+        carts.add_item(self.owner, self.products[0].id, quantity=3)
+        self.assertEqual(carts.merge_guest_cart('guest-session', self.user.pk), 2)
+        expected = {self.products[0].id: 5, self.products[1].id: 1}
+        self.assertEqual(self.stored(), expected)
+        self.assertEqual(self.quantities(carts.get_cart(self.owner)), expected)
+
+        # Signing in again from the same session finds nothing left to merge
+        self.assertEqual(carts.merge_guest_cart('guest-session', self.user.pk), 0)
+        self.assertEqual(self.stored(), expected)
+        self.assertEqual(self.quantities(carts.get_cart(guest)), {})
+        self.assertFalse(Cart.objects.filter(session_key='guest-session').exists())
+
+    def test_signing_in_keeps_the_guest_cart_when_there_is_one(self):
+        self.user.set_password('secret-password')
+        self.user.save()
+        client = APIClient()
+        session = client.session
+        session['seen'] = True
+        session.save()
+        credentials = {'username': 'shopper', 'password': 'secret-password'}
+
+        # A guest session without a cart
+        response = client.post('/api/login', credentials, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('access', response.data)
+        self.assertFalse(Cart.objects.exists())
+
+        carts.add_item(('session', session.session_key), self.products[1].id, quantity=2)
+        self.assertEqual(client.post('/api/login', credentials, format='json').status_code, 200)
+        self.assertEqual(self.stored(), {self.products[1].id: 2})
+
+
+class PromotionIndexTests(TestCase):
+    def setUp(self):
+        promotions._index = None
+        self.addCleanup(setattr, promotions, '_index', None)
+        self.product = make_product(User.objects.create(username='seller'), 0)
+        self.now = timezone.now()
+
+    def promotion(self, **fields):
+        return Promotion.objects.create(**{
+            'title': 'Sale', 'description': '', 'discount_type': 'PERCENTAGE', 'discount_value': 10,
+            'start_date': self.now - timedelta(days=1), 'end_date': self.now + timedelta(days=1), **fields,
+        })
+
+    def test_changes_by_any_worker_apply_on_the_next_lookup(self):
+        index = promotions.get_rule_index()
+        self.assertEqual(index.promotions_for([self.product]), [])
+        # Written without this index being told, like another worker would
+        promotion = self.promotion()
+        self.assertEqual([rule.rule.id for rule in promotions.get_rule_index().promotions_for([self.product])],
+                         [promotion.id])
+        Promotion.objects.filter(id=promotion.id).update(active=False)
+        promotions.rules_changed('promotion', [promotion.id])
+        self.assertEqual(promotions.get_rule_index().promotions_for([self.product]), [])
+
+    def test_used_up_coupons_leave_the_index(self):
+        coupon = Coupon.objects.create(
+            code='ONCE', discount_type='FIXED', discount_value=5, usage_limit=1,
+            start_date=self.now - timedelta(days=1), end_date=self.now + timedelta(days=1),
+        )
+        self.assertEqual(len(promotions.get_rule_index().coupons_for([self.product])), 1)
+        redeem_coupon(coupon, User.objects.create(username='buyer'))
+        self.assertEqual(promotions.get_rule_index().coupons_for([self.product]), [])
+
+    def test_a_rebuild_keeps_the_changes_made_while_it_runs(self):
+        promotions._index = promotions.RuleIndex.build()
+        load = promotions.RuleIndex.load
+        created = []
+
+        def load_then_change(kind, ids=None):
+            rules = load(kind, ids)
+            if not created:
+                created.append(self.promotion())
+            return rules
+
+        with mock.patch.object(promotions.RuleIndex, 'load', side_effect=load_then_change), \
+                mock.patch.object(promotions.connections, 'close_all'):
+            promotions._rebuild()
+        self.assertEqual([rule.rule.id for rule in promotions._index.promotions_for([self.product])],
+                         [created[0].id])
+
+
+class SuggestIndexTests(TestCase):
+    def setUp(self):
+        self.addCleanup(setattr, suggest, '_index', None)
+        self.product = make_product(User.objects.create(username='seller'), 0, name='Linen shirt')
+
+    def labels(self, query):
+        return [item['label'] for item in suggest.get_index().suggest(query)]
+
+    def test_writes_during_a_rebuild_reach_the_new_index(self):
+        suggest._index = suggest.SuggestIndex.build()
+        build = suggest.SuggestIndex.build
+
+        def build_then_rename():
+            index = build()
+            # Saved after the rebuild loaded the products, before it is swapped in
+            Product.objects.filter(id=self.product.id).update(name='Cotton shirt')
+            suggest.refresh_products([self.product.id])
+            return index
+
+        with override_settings(SEARCH_SUGGEST_MAX_AGE=-1), \
+                mock.patch.object(suggest.SuggestIndex, 'build', side_effect=build_then_rename), \
+                mock.patch.object(suggest.threading, 'Thread') as thread:
+            suggest.get_index()
+            # Run here instead of on the thread it would have started
+            thread.assert_called_once()
+            suggest._rebuild()
+        with override_settings(SEARCH_SUGGEST_MAX_AGE=3600):
+            self.assertEqual(self.labels('cot'), ['Cotton shirt'])
+            self.assertEqual(self.labels('lin'), [])
+
+
+class ExplainListQueriesTests(TestCase):
+    def combinations(self, view):
+        command = explain_list_queries.Command(stderr=io.StringIO())
+        user = User.objects.get_or_create(username='staff', defaults={'is_staff': True})[0]
+        return dict(command.combinations(view, 'api/', user))
+
+    def labels(self, view):
+        return list(self.combinations(view))
+
+    def test_checks_the_product_and_order_views(self):
+        for view in ('ProductListView', 'OrderListView'):
+            output = io.StringIO()
+            call_command('explain_list_queries', view=view, stdout=output)
+            checked = int(re.search(r'Checked (\d+) query plans', output.getvalue()).group(1))
+            self.assertGreater(checked, 0, view)
+
+        product_labels = self.labels(ProductListView)
+        self.assertIn('price=1', product_labels)
+        self.assertIn('ordering=-price', product_labels)
+        order_labels = self.labels(OrderListView)
+        self.assertIn('scope=seller&item_status=PENDING', order_labels)
+        self.assertIn('scope=buyer&status=PENDING&ordering=-created_at', order_labels)
+
+    def test_plans_use_the_default_ordering_without_an_ordering_parameter(self):
+        querysets = self.combinations(OrderListView)
+        for label in ('scope=all', 'scope=all&status=PENDING'):
+            self.assertEqual(querysets[label].query.order_by, ('-created_at',), label)
+
+
+class CollectMediaBlobsTests(TestCase):
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=media.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def blob(self, content):
+        name = content_addressed_storage.save('upload.txt', ContentFile(content))
+        StoredBlob.objects.filter(name=name).update(last_uploaded_at=timezone.now() - timedelta(days=1))
+        return name
+
+    def test_deletes_only_blobs_still_unused_when_deleted(self):
+        orphan, reused = self.blob(b'orphan'), self.blob(b'reused')
+
+        def references_after_reupload():
+            # The blob is uploaded again after the batch was read
+            content_addressed_storage.save('again.txt', ContentFile(b'reused'))
+            return Counter()
+
+        with mock.patch('api.management.commands.collect_media_blobs.Counter', side_effect=references_after_reupload):
+            call_command('collect_media_blobs', stdout=mock.MagicMock())
+        self.assertEqual(list(StoredBlob.objects.values_list('name', flat=True)), [reused])
+        self.assertFalse(content_addressed_storage.exists(orphan))
+        self.assertTrue(content_addressed_storage.exists(reused))
+
+
+class ImageDerivativeTests(TestCase):
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=media.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.seller = User.objects.create(username='seller')
+
+    def upload(self, n, content):
+        return make_product(self.seller, n, main_image=ContentFile(content, name=f'shirt-{n}.png'))
+
+    def test_uploads_queue_their_derivatives(self):
+        buffer = io.BytesIO()
+        Image.new('RGB', (1200, 600), 'red').save(buffer, 'PNG')
+        product = self.upload(0, buffer.getvalue())
+        broken = self.upload(1, b'not an image')
+        self.assertEqual(Task.objects.filter(name='image_derivatives').count(), 2)
+        self.assertFalse(ImageDerivative.objects.exists())
+
+        self.assertEqual(run_tasks(), 2)
+        derivatives = ImageDerivative.objects.filter(source=product.main_image.name)
+        self.assertEqual(set(derivatives.values_list('variant', 'format', 'width')), {
+            (variant, image_format, width)
+            for variant, width in (('thumbnail', 256), ('medium', 960)) for image_format in ('JPEG', 'WEBP')
+        })
+        # The broken upload fails alone and is retried later
+        self.assertEqual(
+            list(Task.objects.values_list('payload__name', 'status')), [(broken.main_image.name, 'PENDING')]
+        )
+
+
+class OrderStockTests(TestCase):
+    def setUp(self):
+        self.buyer = User.objects.create(username='buyer')
+        self.product = make_product(User.objects.create(username='seller'), 0)
+        self.row = StockProduct.objects.create(
+            stock=Stock.objects.create(name='Main', location='Hanoi'), product=self.product, quantity=3
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.buyer)
+
+    def order(self, quantity, **fields):
+        return self.client.post('/api/orders/create/', {
+            'items': [{'product': self.product.id, 'quantity': quantity}], 'payment_method': 'CREDIT_CARD', **fields,
+        }, format='json')
+
+    def stock(self):
+        self.row.refresh_from_db()
+        self.product.refresh_from_db()
+        return self.row.quantity, self.product.stock
+
+    def test_orders_hold_stock_and_never_oversell(self):
+        self.assertEqual(self.order(2).status_code, 201)
+        self.assertEqual(self.stock(), (1, 1))
+        response = self.order(2)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['items'], [f'Only 1 left in stock for product {self.product.id}.'])
+        self.assertEqual(self.stock(), (1, 1))
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_expired_holds_return_their_stock_and_cancel_unpaid_orders(self):
+        self.order(2)
+        self.assertEqual(release_expired_holds(now=timezone.now()), 0)
+        self.assertEqual(release_expired_holds(now=timezone.now() + timedelta(days=1)), 1)
+        self.assertEqual(self.stock(), (3, 3))
+        self.assertEqual(Order.objects.get().status, 'CANCELED')
+        self.assertEqual(StockReservation.objects.get().status, 'RELEASED')
+
+    def test_held_stock_rows_cannot_be_deleted(self):
+        self.order(2)
+        with self.assertRaises(ProtectedError):
+            self.row.delete()
+        self.assertEqual(self.client.delete(f'/api/stock-products/{self.row.id}/').status_code, 400)
+
+        release_expired_holds(now=timezone.now() + timedelta(days=1))
+        self.row.delete()
+        reservation = StockReservation.objects.get()
+        self.assertEqual((reservation.status, reservation.stock_product_id), ('RELEASED', None))
+
+
+@override_settings(INVENTORY_AVAILABILITY_CACHE_SECONDS=0)
+class AvailabilityTests(TestCase):
+    def setUp(self):
+        seller = User.objects.create(username='seller')
+        self.products = [make_product(seller, n) for n in range(6)]
+        warehouses = [Stock.objects.create(name='Main', location='Hanoi'),
+                      Stock.objects.create(name='Closed', location='Hue', is_active=False)]
+        order = Order.objects.create(
+            user=User.objects.create(username='buyer'), payment_method='CREDIT_CARD', total_price='30.00'
+        )
+        for product in self.products:
+            rows = [StockProduct.objects.create(stock=stock, product=product, quantity=3) for stock in warehouses]
+            StockReservation.objects.create(order=order, product=product, stock_product=rows[0], quantity=1)
+            StockReservation.objects.create(order=order, product=product, quantity=2, status='COMMITTED')
+
+    def get(self, products):
+        return self.client.get('/api/inventory/availability/', {
+            'ids': ','.join(str(product.id) for product in products[1:]), 'skus': products[0].sku,
+        })
+
+    def test_takes_two_queries_for_any_number_of_products(self):
+        for products in (self.products[:1], self.products):
+            with self.subTest(count=len(products)), self.assertNumQueries(2):
+                response = self.get(products)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(response.data['results']), len(products))
+
+        # Product.stock follows the active warehouse, the committed units are gone
+        result = response.data['results'][0]
+        self.assertEqual((result['on_hand'], result['reserved'], result['available']), (4, 1, 3))
+        self.assertEqual([(row['name'], row['on_hand'], row['reserved']) for row in result['warehouses']],
+                         [('Main', 4, 1)])
+
+
+class ProductSaleTests(TestCase):
+    def setUp(self):
+        self.seller = User.objects.create(username='seller')
+
+    def test_transitions_are_rescheduled_only_when_the_sale_changes(self):
+        start = timezone.now() + timedelta(days=1)
+        product = make_product(self.seller, 0, sale_price=Decimal('5.00'), start_sale_date=start)
+        self.assertEqual(list(product.sale_transitions.values_list('run_at', flat=True)), [start])
+
+        product = Product.objects.get(id=product.id)
+        product.name = 'Renamed'
+        with self.assertNumQueries(1):
+            product.save()
+
+        product.end_sale_date = start + timedelta(days=1)
+        product.save()
+        self.assertEqual(SaleTransition.objects.filter(product=product).count(), 2)
+
+    def test_price_filters_and_sorts_by_the_shelf_price(self):
+        on_sale = make_product(self.seller, 0, sale_price=Decimal('5.00'), is_on_sale=True)
+        full_price = make_product(self.seller, 1, price=Decimal('8.00'))
+        client = APIClient()
+        response = client.get('/api/products/', {'ordering': 'price'})
+        self.assertEqual([product['id'] for product in response.data['results']], [on_sale.id, full_price.id])
+        response = client.get('/api/products/', {'ordering': '-price'})
+        self.assertEqual([product['id'] for product in response.data['results']], [full_price.id, on_sale.id])
+        response = client.get('/api/products/', {'price': '5.00'})
+        self.assertEqual([product['id'] for product in response.data['results']], [on_sale.id])
+
+
+class CompiledSerializerTests(TestCase):
+    def setUp(self):
+        seller = User.objects.create(username='seller')
+        now = timezone.now().replace(microsecond=123456)
+        # One product with every optional value set, one with them all null
+        self.products = [
+            make_product(seller, 0, sale_price=Decimal('7.5'), start_sale_date=now - timedelta(days=1),
+                         end_sale_date=now + timedelta(days=1), weight=Decimal('0.35'), barcode='0001'),
+            make_product(seller, 1, price=Decimal('19.99')),
+        ]
+        self.products[0].tags.add(*(Tag.objects.create(name=name, slug=name) for name in ('cotton', 'summer')))
+        buyer = User.objects.create(username='buyer')
+        self.order = Order.objects.create(
+            user=buyer, payment_method='COD', subtotal_price=Decimal('27.49'), discount_amount=Decimal('0.005'),
+            total_price=Decimal('27.49'), total_weight=Decimal('0.35'), estimated_delivery_date=now.date(),
+        )
+        for product in self.products:
+            OrderItem.objects.create(order=self.order, product=product, seller=seller, quantity=1,
+                                     price=product.effective_price, total_price=product.effective_price,
+                                     weight=product.weight)
+        Order.objects.create(user=buyer, payment_method='COD', total_price=Decimal('0'))
+        self.request = Request(APIRequestFactory().get('/api/'))
+
+    def assertSameOutput(self, compiled_class, queryset):
+        context = {'request': self.request}
+        compiled = compiled_class(context=context)
+        expected = compiled_class.serializer_class(queryset, many=True, context=context).data
+        renderer = JSONRenderer()
+        self.assertEqual(renderer.render(compiled.render(compiled.values(queryset))), renderer.render(expected))
+
+    def test_renders_like_the_serializers(self):
+        for zone in ('UTC', 'America/New_York'):
+            with self.subTest(zone=zone), timezone.override(zone):
+                self.assertSameOutput(fast_serializers.CompiledProductSerializer, Product.objects.order_by('pk'))
+                self.assertSameOutput(fast_serializers.CompiledOrderSerializer, Order.objects.order_by('pk'))
+
+
+class FastJSONTests(TestCase):
+    data = {
+        'price': Decimal('10.50'), 'created_at': timezone.now(), 'day': timezone.now().date(), 'missing': None,
+        'name': 'Caf\u00e9 \u2028 \U0001f455', 'lines': [{'quantity': 2, 'weight': 0.25, 'gift': False}],
+    }
+
+    def round_trip(self):
+        body = FastJSONRenderer().render(self.data)
+        self.assertEqual(body, JSONRenderer().render(self.data))
+        parsed = FastJSONParser().parse(io.BytesIO(body))
+        self.assertEqual(parsed, JSONParser().parse(io.BytesIO(body)))
+        return parsed
+
+    def test_output_parses_back_with_and_without_orjson(self):
+        self.assertIsNotNone(renderers.orjson)
+        with_orjson = self.round_trip()
+        with mock.patch.object(renderers, 'orjson', None), mock.patch.object(parsers, 'orjson', None):
+            self.assertEqual(self.round_trip(), with_orjson)
+        # Decimals render as numbers, like DRF's encoder does
+        self.assertEqual(with_orjson['price'], 10.5)
+        self.assertEqual(with_orjson['name'], self.data['name'])
+        self.assertEqual(with_orjson['lines'], self.data['lines'])
+
+
+class SalesTotalsTests(TestCase):
+    def test_store_totals_count_the_units_of_their_seller(self):
+        seller = User.objects.create(username='seller')
+        stores = [Store.objects.create(user=seller, store_name=name) for name in ('North', 'South')]
+        order = Order.objects.create(
+            user=User.objects.create(username='buyer'), payment_method='COD', total_price='30.00'
+        )
+        OrderItem.objects.create(
+            order=order, product=make_product(seller, 0), seller=seller, quantity=3, price='10.00',
+            total_price='30.00',
+        )
+        refresh_order_sales([order.id])
+        self.assertEqual([store.total_sales for store in Store.objects.filter(user=seller)], [3, 3])
+
+        order.status = 'CANCELED'
+        order.save()
+        refresh_order_sales([order.id])
+        stores[0].refresh_from_db()
+        self.assertEqual(stores[0].total_sales, 0)
+
+
+class ReserveStockTests(TestCase):
+    def setUp(self):
+        self.buyer = User.objects.create(username='buyer')
+        seller = User.objects.create(username='seller')
+        self.stock = Stock.objects.create(name='Main', location='Hanoi')
+        self.products = [make_product(seller, n) for n in range(6)]
+        self.rows = [
+            StockProduct.objects.create(stock=self.stock, product=product, quantity=5) for product in self.products
+        ]
+        self.client = APIClient()
+        self.client.force_authenticate(self.buyer)
+
+    def order(self, quantities):
+        return self.client.post('/api/orders/create/', {
+            'items': [{'product': product.id, 'quantity': quantity} for product, quantity in quantities],
+            'payment_method': 'CREDIT_CARD',
+        }, format='json')
+
+    def on_hand(self):
+        return (list(StockProduct.objects.order_by('id').values_list('quantity', flat=True)),
+                list(Product.objects.order_by('id').values_list('stock', flat=True)))
+
+    def test_a_short_line_rolls_back_every_reservation(self):
+        StockProduct.objects.filter(id=self.rows[1].id).update(quantity=1)
+        Product.objects.filter(id=self.products[1].id).update(stock=1)
+        before = self.on_hand()
+        response = self.order([(self.products[0], 2), (self.products[1], 2), (self.products[2], 1)])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['items'], [f'Only 1 left in stock for product {self.products[1].id}.'])
+        self.assertEqual(self.on_hand(), before)
+        self.assertFalse(StockReservation.objects.exists())
+        self.assertFalse(Order.objects.exists())
+
+    def test_two_orders_cannot_both_take_the_last_unit(self):
+        StockProduct.objects.filter(id=self.rows[0].id).update(quantity=1)
+        Product.objects.filter(id=self.products[0].id).update(stock=1)
+        # Both planned on the unit they read, only the first UPDATE still finds it
+        plan = {self.rows[0].id: 1}
+        self.assertEqual(inventory._decrement(StockProduct.objects, 'quantity', plan), 1)
+        self.assertEqual(inventory._decrement(StockProduct.objects, 'quantity', plan), 0)
+        self.assertEqual(self.on_hand()[0][0], 0)
+        StockProduct.objects.filter(id=self.rows[0].id).update(quantity=1)
+
+        first, second = (
+            Order.objects.create(user=self.buyer, payment_method='COD', total_price='10.00') for _ in range(2)
+        )
+        allocation_order = inventory._allocation_order
+        raced = []
+
+        def planned_then_raced(*args):
+            # The first order takes the unit after the second planned on it, before its UPDATE
+            plan = allocation_order(*args)
+            if not raced:
+                raced.append(first)
+                inventory.reserve_stock(first, {self.products[0].id: 1})
+            return plan
+
+        with mock.patch.object(inventory, '_allocation_order', planned_then_raced), \
+                override_settings(STOCK_RESERVATION_ATTEMPTS=1):
+            with self.assertRaises(inventory.InsufficientStock) as raised:
+                inventory.reserve_stock(second, {self.products[0].id: 1})
+        self.assertEqual(raised.exception.available, {self.products[0].id: 0})
+
+    def test_queries_do_not_grow_with_the_lines(self):
+        self.order([(self.products[0], 1)])
+        counts = []
+        for lines in (1, 5):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.order([(product, 1) for product in self.products[1:1 + lines]])
+            self.assertEqual(response.status_code, 201)
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+
+
+class OrderScopeTests(TestCase):
+    def setUp(self):
+        role = Role.objects.create(name='SELLER')
+        self.sellers = [User.objects.create(username=f'seller-{n}', role=role) for n in range(2)]
+        self.products = [make_product(seller, n) for n, seller in enumerate(self.sellers)]
+        self.buyer = User.objects.create(username='buyer')
+        self.staff = User.objects.create(username='staff', is_staff=True)
+        # Orders with the first seller's line, the second's, and both
+        self.orders = [self.order(self.products[:1]), self.order(self.products[1:]), self.order(self.products)]
+        self.client = APIClient()
+
+    def order(self, products):
+        order = Order.objects.create(user=self.buyer, payment_method='COD', total_price='10.00')
+        for product in products:
+            OrderItem.objects.create(order=order, product=product, seller=product.user, quantity=1, price=10,
+                                     total_price=10)
+        return order
+
+    def get(self, user, **params):
+        self.client.force_authenticate(user)
+        return self.client.get('/api/orders/', params)
+
+    def test_only_staff_list_every_order(self):
+        for user in (self.buyer, self.sellers[0]):
+            self.assertEqual(self.get(user, scope='all').status_code, 403, user.username)
+        response = self.get(self.staff)
+        self.assertEqual(response.data['count'], 3)
+        self.assertEqual(self.get(self.staff, scope='everything').status_code, 400)
+
+    def test_sellers_see_their_orders_with_their_lines_only(self):
+        seller = self.sellers[0]
+        response = self.get(seller)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual({order['id'] for order in response.data['results']}, {self.orders[0].id, self.orders[2].id})
+        for order in response.data['results']:
+            self.assertEqual([item['product'] for item in order['items']], [self.products[0].id])
+        # As a buyer the seller placed nothing
+        self.assertEqual(self.get(seller, scope='buyer').data['count'], 0)
+
+    def test_buyers_see_the_orders_they_placed(self):
+        other = User.objects.create(username='other')
+        Order.objects.create(user=other, payment_method='COD', total_price='10.00')
+        response = self.get(self.buyer, status='PENDING')
+        self.assertEqual([order['id'] for order in response.data['results']],
+                         [order.id for order in reversed(self.orders)])
+        self.assertEqual(len(response.data['results'][0]['items']), 2)
+
+
+class OrderNumberTests(TestCase):
+    def setUp(self):
+        self.addCleanup(setattr, order_numbers, '_generator', None)
+
+    def test_numbers_are_fixed_width_base_36(self):
+        numbers = [order_numbers.generate_order_number() for _ in range(100)]
+        self.assertEqual(len(set(numbers)), 100)
+        for number in numbers:
+            self.assertEqual(len(number), 20)
+            self.assertLessEqual(set(number), set(order_numbers.DIGITS))
+
+    def test_numbers_sort_in_creation_order(self):
+        generator = order_numbers.OrderNumberGenerator(worker_id=7)
+
+        def generate(elapsed_ms):
+            with mock.patch.object(time, 'monotonic_ns', return_value=generator.anchor_ns + elapsed_ms * 1000000):
+                return generator()
+
+        generator.sequence = itertools.count(0)
+        same_millisecond = [generate(5) for _ in range(5)]
+        self.assertEqual(sorted(set(same_millisecond)), same_millisecond)
+        # Later milliseconds sort later, also after the sequence wrapped
+        generator.sequence = itertools.count(order_numbers.SEQUENCES - 2)
+        numbers = [generate(elapsed_ms) for elapsed_ms in (6, 7, 8, 1000, 86400000)]
+        self.assertEqual(sorted(set(numbers)), numbers)
+        self.assertLess(same_millisecond[-1], numbers[0])
+        self.assertEqual({number[8:12] for number in numbers}, {'0007'})
+
+    def test_worker_id_comes_from_the_environment_of_each_process(self):
+        with mock.patch.dict(os.environ, {order_numbers.WORKER_ID_VARIABLE: '35'}):
+            parent = order_numbers.generate_order_number()
+            self.assertEqual(parent[8:12], '000Z')
+            read, write = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                # Forked like a preloaded worker, with the parent's environment
+                try:
+                    os.write(write, order_numbers.generate_order_number().encode())
+                finally:
+                    os._exit(0)
+            os.close(write)
+            child = os.read(read, 64).decode()
+            os.close(read)
+            os.waitpid(pid, 0)
+        self.assertEqual(len(child), 20)
+        self.assertNotEqual(child[8:12], parent[8:12])
+
+
+class ReviewAggregateTests(TestCase):
+    def setUp(self):
+        self.seller = User.objects.create(username='seller')
+        self.store = Store.objects.create(user=self.seller, store_name='Shirts')
+        self.products = [make_product(self.seller, n) for n in range(2)]
+
+    def aggregates(self, product=None):
+        product = Product.objects.get(id=(product or self.products[0]).id)
+        store = Store.objects.get(id=self.store.id)
+        return (product.rating, product.num_reviews, store.rating, store.total_reviews)
+
+    def review(self, rating, product=None):
+        reviewer = User.objects.create(username=f'reviewer-{Review.objects.count()}')
+        return Review.objects.create(
+            product=product or self.products[0], user=reviewer, rating=rating, comment='Fits well'
+        )
+
+    def test_reviews_update_the_ratings_as_they_change(self):
+        first = self.review(5)
+        self.assertEqual(self.aggregates(), (Decimal('5.00'), 1, Decimal('5.00'), 1))
+        second = self.review(2)
+        self.assertEqual(self.aggregates(), (Decimal('3.50'), 2, Decimal('3.50'), 2))
+        self.review(4, self.products[1])
+        self.assertEqual(self.aggregates(), (Decimal('3.50'), 2, Decimal('3.67'), 3))
+
+        second.rating = 3
+        second.save()
+        self.assertEqual(self.aggregates(), (Decimal('4.00'), 2, Decimal('4.00'), 3))
+        # Moved to the other product of the same store
+        second.product = self.products[1]
+        second.save()
+        self.assertEqual(self.aggregates(), (Decimal('5.00'), 1, Decimal('4.00'), 3))
+        self.assertEqual(self.aggregates(self.products[1])[:2], (Decimal('3.50'), 2))
+
+        first.delete()
+        self.assertEqual(self.aggregates(), (Decimal('0.00'), 0, Decimal('3.50'), 2))
+
+    def test_reconcile_repairs_drift(self):
+        self.review(5)
+        self.review(4)
+        # Queryset updates send no signals
+        Review.objects.update(rating=1)
+        Product.objects.filter(id=self.products[1].id).update(rating=3, num_reviews=7)
+        self.assertEqual(reconcile_review_aggregates(dry_run=True)['Product'], 2)
+        self.assertEqual(self.aggregates()[:2], (Decimal('4.50'), 2))
+
+        drifted = reconcile_review_aggregates()
+        self.assertEqual((drifted['Product'], drifted['Store']), (2, 1))
+        self.assertEqual(self.aggregates(), (Decimal('1.00'), 2, Decimal('1.00'), 2))
+        self.assertEqual(self.aggregates(self.products[1])[:2], (Decimal('0.00'), 0))
+        self.assertEqual(reconcile_review_aggregates()['Product'], 0)
+
+
+class ReviewPaginationTests(TestCase):
+    def setUp(self):
+        self.product = make_product(User.objects.create(username='seller'), 0)
+        self.reviews = [
+            Review.objects.create(
+                product=self.product, user=User.objects.create(username=f'reviewer-{n}'), rating=4 + n % 2,
+                comment='Fits well',
+            )
+            for n in range(7)
+        ]
+        # Every row shares its created_at, the ratings come in two ties
+        Review.objects.update(created_at=timezone.now())
+        self.url = f'/api/products/{self.product.id}/reviews/'
+
+    def pages(self, sort):
+        ids, url = [], f'{self.url}?sort={sort}&page_size=2'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            ids.extend(review['id'] for review in response.data['results'])
+            url = response.data['next']
+        return ids
+
+    def test_cursors_visit_every_row_once_across_equal_keys(self):
+        by_id = sorted((review.id for review in self.reviews), reverse=True)
+        by_rating = sorted(self.reviews, key=lambda review: (review.rating, review.id), reverse=True)
+        for sort, expected in (('newest', by_id), ('helpful', by_id), ('rating', [r.id for r in by_rating])):
+            with self.subTest(sort=sort):
+                self.assertEqual(self.pages(sort), expected)
+
+    def test_tampered_cursors_are_bad_requests(self):
+        def encode(values):
+            return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+        now = timezone.now().isoformat()
+        for cursor in ('not a cursor', encode({'id': 1}), encode([now]), encode([None, 1]), encode(['soon', 1]),
+                       encode([now, 'one']), encode([now, 10 ** 30])):
+            with self.subTest(cursor=cursor):
+                response = self.client.get(self.url, {'sort': 'newest', 'cursor': cursor})
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('cursor', response.data)
+
+
+class CouponTests(TestCase):
+    def setUp(self):
+        promotions._index = None
+        self.addCleanup(setattr, promotions, '_index', None)
+        self.buyer, self.other = User.objects.create(username='buyer'), User.objects.create(username='other')
+        self.product = make_product(User.objects.create(username='seller'), 0)
+        now = timezone.now()
+        self.coupon = Coupon.objects.create(
+            code='VIP', discount_type='FIXED', discount_value=2, usage_limit=1,
+            start_date=now - timedelta(days=1), end_date=now + timedelta(days=1),
+        )
+        self.client = APIClient()
+
+    def check(self, user, **data):
+        self.client.force_authenticate(user)
+        response = self.client.post('/api/coupons/validate/', {'codes': ['VIP'], **data}, format='json')
+        return response.data['results'][0]
+
+    def order(self, user):
+        self.client.force_authenticate(user)
+        return self.client.post('/api/orders/create/', {
+            'items': [{'product': self.product.id, 'quantity': 1}], 'payment_method': 'COD', 'coupon': self.coupon.id,
+        }, format='json')
+
+    def test_user_restricted_coupons_are_checked_with_and_without_items(self):
+        self.coupon.applicable_users.add(self.buyer)
+        items = {'items': [{'product': self.product.id, 'quantity': 1}]}
+        for data in ({}, items):
+            self.assertTrue(self.check(self.buyer, **data)['valid'])
+            result = self.check(self.other, **data)
+            self.assertEqual((result['valid'], result['message']),
+                             (False, 'This coupon is not available for this account.'))
+
+    def test_orders_stop_at_the_coupon_usage_limit(self):
+        first = self.order(self.buyer)
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(first.data['discount_amount'], '2.00')
+        second = self.order(self.other)
+        self.assertEqual(second.status_code, 400)
+        self.assertIn('coupon', second.data)
+        self.product.refresh_from_db()
+        self.assertEqual((Order.objects.count(), self.product.stock), (1, 4))
+        self.assertFalse(self.check(self.other)['valid'])
+
+
+@override_settings(ORDER_TAX_RATE=Decimal('0.08'), ORDER_FREE_SHIPPING_THRESHOLD=None)
+class QuoteTests(TestCase):
+    def setUp(self):
+        promotions._index = None
+        self.addCleanup(setattr, promotions, '_index', None)
+        self.buyer = User.objects.create(username='buyer')
+        self.product = make_product(User.objects.create(username='seller'), 0, stock=10)
+        now = timezone.now()
+        self.window = {'start_date': now - timedelta(days=1), 'end_date': now + timedelta(days=1)}
+        self.promotion = Promotion.objects.create(
+            title='Sale', description='', discount_type='PERCENTAGE', discount_value=10, **self.window,
+        )
+        self.promotion.applicable_categories.add(self.product.category)
+        promotions.rules_changed('promotion', [self.promotion.id])
+        self.coupon = Coupon.objects.create(code='SAVE', discount_type='PERCENTAGE', discount_value=15, **self.window)
+        ShippingMethod.objects.create(name='Express', cost=Decimal('4.99'), estimated_delivery_days=2)
+        self.client = APIClient()
+        self.client.force_authenticate(self.buyer)
+
+    def payload(self, **data):
+        return {
+            'items': [{'product': self.product.id, 'quantity': 3}], 'coupon': self.coupon.id,
+            'shipping_method': 'Express', **data,
+        }
+
+    def test_quotes_the_promotion_then_the_coupon_on_what_is_left(self):
+        response = self.client.post('/api/orders/quote/', self.payload(), format='json')
+        self.assertEqual(response.status_code, 200)
+        # 30.00 less 10% is 27.00, less 15% of that is 22.95, taxed 8%
+        self.assertEqual(response.data['lines'][0]['discount'], '3.00')
+        self.assertEqual(
+            [response.data[field] for field in ('subtotal_price', 'discount_amount', 'shipping_cost', 'tax_amount',
+                                                'total_price')],
+            ['30.00', '7.05', '4.99', '1.84', '29.78'],
+        )
+
+    @override_settings(ORDER_TAX_RATE=Decimal('0.10'))
+    def test_amounts_round_half_up_to_cents(self):
+        self.product.price = Decimal('0.90')
+        self.product.save()
+        lines = [{'product': self.product, 'quantity': 1}]
+        # 5% of 0.90 is 0.045, and the tax 10% of 0.85
+        Promotion.objects.filter(id=self.promotion.id).update(discount_value=5)
+        promotions.rules_changed('promotion', [self.promotion.id])
+        quote = price_order(lines, self.buyer)
+        self.assertEqual((quote['discount_amount'], quote['tax_amount']), (Decimal('0.05'), Decimal('0.09')))
+
+        # 50% of 0.85 is 0.425
+        self.coupon.discount_value = 50
+        quote = price_order(lines, self.buyer, self.coupon)
+        self.assertEqual(quote['lines'][0]['discount'], Decimal('0.05'))
+        self.assertEqual((quote['discount_amount'], quote['total_price']), (Decimal('0.48'), Decimal('0.46')))
+
+    def test_orders_charge_what_was_quoted(self):
+        quote = self.client.post('/api/orders/quote/', self.payload(), format='json').data
+        order = self.client.post('/api/orders/create/', self.payload(payment_method='COD'), format='json')
+        self.assertEqual(order.status_code, 201)
+        fields = ['subtotal_price', 'discount_amount', 'shipping_cost', 'tax_amount', 'total_price', 'total_weight']
+        self.assertEqual({field: order.data[field] for field in fields}, {field: quote[field] for field in fields})
+        self.assertEqual(
+            [(item.price, item.total_price) for item in OrderItem.objects.filter(order_id=order.data['id'])],
+            [(Decimal(line['price']), Decimal(line['total_price'])) for line in quote['lines']],
+        )
+
+
+class SimilarProductsTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        settings_override = override_settings(
+            RECOMMENDATION_SIMILARITY_MATRIX=f'{directory.name}/similar.pickle', RECOMMENDATION_TOP_K=3
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        seller = User.objects.create(username='seller')
+        self.tags = [Tag.objects.create(name=f'tag {n}', slug=f'tag-{n}') for n in range(4)]
+        self.products = []
+        for n in range(8):
+            product = make_product(seller, n, brand=f'brand {n % 3}', price=Decimal(10 + 7 * n))
+            product.tags.set(self.tags[n % 4:n % 4 + 2])
+            self.products.append(product)
+
+    def stored(self):
+        return dict(ProductRecommendation.objects.filter(kind='SIMILAR').values_list('product_id', 'neighbours'))
+
+    def test_queued_refreshes_match_a_full_rebuild(self):
+        recommendations.rebuild_similar()
+        first, second = self.products[:2]
+        first.tags.set(self.tags[2:])
+        Product.objects.filter(id=second.id).update(brand='brand 2', price=Decimal('99.00'))
+        Product.objects.filter(id=self.products[5].id).update(status='INACTIVE')
+        for product in (first, second, self.products[5]):
+            recommendations.schedule_similar_refresh(product.id)
+        self.assertEqual(run_tasks(), 3)
+        self.assertFalse(Task.objects.exists())
+        refreshed = self.stored()
+        self.assertNotIn(self.products[5].id, refreshed)
+
+        recommendations.rebuild_similar()
+        self.assertEqual(refreshed, self.stored())
+
+    def test_refreshes_without_a_saved_matrix(self):
+        recommendations.rebuild_similar()
+        expected = self.stored()
+        ProductRecommendation.objects.filter(product=self.products[0]).delete()
+        with override_settings(RECOMMENDATION_SIMILARITY_MATRIX=f'{self.directory}/missing/similar.pickle'):
+            recommendations.refresh_similar([self.products[0].id])
+        self.assertEqual(self.stored(), expected)
+
+
+class BoughtTogetherTests(TestCase):
+    def setUp(self):
+        self.seller = User.objects.create(username='seller')
+        self.buyer = User.objects.create(username='buyer')
+        self.products = [make_product(self.seller, n) for n in range(3)]
+        self.orders = [self.order(self.products[:2]), self.order(self.products), self.order(self.products[1:])]
+
+    def order(self, products):
+        order = Order.objects.create(user=self.buyer, payment_method='COD', total_price='10.00')
+        for product in products:
+            OrderItem.objects.create(
+                order=order, product=product, seller=self.seller, quantity=1, price='10.00', total_price='10.00'
+            )
+        return order
+
+    def stored(self):
+        return (
+            set(ProductCooccurrence.objects.values_list('product_id', 'other_id', 'count')),
+            dict(ProductRecommendation.objects.filter(kind='BOUGHT_TOGETHER').values_list('product_id', 'neighbours')),
+        )
+
+    def rebuilt(self):
+        recommendations.fold_orders(settle_seconds=0, rebuild=True)
+        return self.stored()
+
+    def test_voided_orders_are_taken_out_and_put_back(self):
+        self.assertEqual(recommendations.fold_orders(settle_seconds=0), 3)
+        for status in ('CANCELED', 'RETURNED', 'DELIVERED'):
+            self.orders[1].status = status
+            self.orders[1].save()
+            self.assertEqual(self.stored(), self.rebuilt())
+        self.orders[0].status = 'CANCELED'
+        self.orders[0].save()
+        self.assertEqual(self.stored(), self.rebuilt())
+
+    def test_orders_voided_while_folding_are_taken_out(self):
+        read_order_lines = recommendations._read_order_lines
+
+        def cancel_while_reading(*args):
+            yield from read_order_lines(*args)
+            Order.objects.filter(id=self.orders[1].id).update(status='CANCELED')
+
+        with mock.patch.object(recommendations, '_read_order_lines', cancel_while_reading):
+            self.assertEqual(recommendations.fold_orders(settle_seconds=0), 2)
+        counted = self.stored()
+        self.assertEqual(counted, self.rebuilt())
+        self.assertEqual(counted[1][self.products[0].id], [[self.products[1].id, 1]])
@@ -12,6 +12,7 @@ urlpatterns = [
     path('user/<int:pk>/', UserManagerView.as_view(), name='user-manager'),
     path('users/<int:pk>/role/', UserRoleView.as_view(), name='user-role'),
     path('users/', UserListView.as_view(), name='user-list'),
+    path('users/<int:pk>/reviews/', UserReviewListView.as_view(), name='user-reviews'),
     path('create-user/', UserCreateView.as_view(), name='admin-create-user'),
     path('users/create-password/', CreatePasswordView.as_view(), name='create-password'),
     path('categories/', CategoryListView.as_view(), name='category-list'),
@@ -20,9 +21,13 @@ urlpatterns = [
     path('categories/<int:pk>/update/', CategoryUpdateView.as_view(), name='category-update'),
     path('categories/<int:pk>/delete/', CategoryDeleteView.as_view(), name='category-delete'),
     path('products/', ProductListView.as_view(), name='product-list'),
+    path('search/suggest/', SearchSuggestView.as_view(), name='search-suggest'),
     path('products/create/', ProductCreateView.as_view(), name='product-create'),
     # path('products/<int:pk>/', ProductDetailView.as_view(), name='product-detail'),
     path('products/<int:pk>/update/', ProductUpdateView.as_view(), name='product-update'),
+    path('products/<int:pk>/bought-together/', BoughtTogetherView.as_view(), name='product-bought-together'),
+    path('products/<int:pk>/similar/', SimilarProductsView.as_view(), name='product-similar'),
+    path('products/<int:pk>/reviews/', ProductReviewListView.as_view(), name='product-reviews'),
     # path('products/<int:pk>/delete/', ProductDeleteView.as_view(), name='product-delete'),
     path('permissions/', PermissionListView.as_view(), name='permissions'),
     path('permissions/create/', CreateUserPermissionView.as_view(), name='create_permission'),
@@ -36,8 +41,16 @@ urlpatterns = [
     path('stock-products/', StockProductListView.as_view(), name='stock-product-list'),
     path('stock-products/create/', StockProductCreateView.as_view(), name='stock-product-create'),
     path('stock-products/<int:pk>/', StockProductUpdateDeleteView.as_view(), name='stock-product-update-delete'),
+    path('inventory/availability/', InventoryAvailabilityView.as_view(), name='inventory-availability'),
     path('orders/', OrderListView.as_view(), name='order-list'),
     path('orders/create/', OrderCreateAPIView.as_view(), name='order-create'),
+    path('orders/quote/', OrderQuoteView.as_view(), name='order-quote'),
+    path('coupons/validate/', CouponValidateView.as_view(), name='coupon-validate'),
+    path('cart/', CartView.as_view(), name='cart'),
+    path('cart/items/', CartItemsView.as_view(), name='cart-items'),
+    path('sellers/<int:pk>/analytics/', SellerAnalyticsView.as_view(), name='seller-analytics'),
+    path('payments/webhook/', PaymentWebhookView.as_view(), name='payment-webhook'),
+    path('tasks/stats/', TaskQueueStatsView.as_view(), name='task-queue-stats'),
     path('stores/create/', StoreCreateView.as_view(), name='store-create'),
     path('stores/', StoreListView.as_view(), name='store-list'),
     path('stores/<int:pk>/', StoreDetailView.as_view(), name='store-update-delete'),
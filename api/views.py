@@ -1,15 +1,35 @@
+import hashlib
+import json
+from decimal import Decimal
+
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import filters, permissions
 from rest_framework.views import APIView
 from rest_framework.pagination import PageNumberPagination
 from .serializers import *
 from .models import *
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
 from rest_framework_simplejwt.views import TokenObtainPairView
 from rest_framework import generics, status
 from rest_framework.response import Response
 from .models import User
 from .serializers import UserCreateSerializer
 from .permissions import HasRolePermission
+from . import carts
+from .analytics import seller_sales
+from .idempotency import IdempotentMixin
+from .inventory import availability
+from .payments import ingest_events, valid_signature
+from .tasks import queue_stats
+from .filters import AliasOrderingFilter, OrderFilter, ProductFilter
+from .fast_serializers import CompiledOrderSerializer, CompiledProductSerializer
+from .pagination import KeysetPagination
+from .recommendations import similar_cache_key
+from .suggest import get_index
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import ProtectedError
+from rest_framework.exceptions import PermissionDenied, ValidationError
 from rest_framework.permissions import IsAuthenticated
 
 
@@ -18,11 +38,27 @@ class StandardResultsSetPagination(PageNumberPagination):
     page_size_query_param = 'page_size'
 
 
+# Read-only list path rendering `.values()` rows through a compiled serializer
+class CompiledListMixin:
+    compiled_serializer_class = None
+
+    def list(self, request, *args, **kwargs):
+        compiled = self.compiled_serializer_class(context=self.get_serializer_context())
+        queryset = compiled.values(self.filter_queryset(self.get_queryset()))
+
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(compiled.render(page))
+        return Response(compiled.render(queryset))
+
+
 # User Registration
-class UserRegistrationView(generics.CreateAPIView):
+class UserRegistrationView(IdempotentMixin, generics.CreateAPIView):
     queryset = User.objects.all()
     permission_classes = (permissions.AllowAny,)
     serializer_class = UserRegistrationSerializer
+    # A replayed registration does not hand out the tokens again, the client logs in
+    idempotency_exclude = ('refresh', 'access')
 
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
@@ -43,6 +79,17 @@ class UserLoginView(TokenObtainPairView):
     permission_classes = (permissions.AllowAny,)
     serializer_class = CustomTokenObtainPairSerializer
 
+    def post(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        try:
+            serializer.is_valid(raise_exception=True)
+        except TokenError as error:
+            raise InvalidToken(error.args[0])
+        # What the guest put in the cart before signing in is kept
+        if request.session.session_key:
+            carts.merge_guest_cart(request.session.session_key, serializer.user.pk)
+        return Response(serializer.validated_data, status=status.HTTP_200_OK)
+
 
 # User Detail (Self)
 class UserDetailView(generics.RetrieveUpdateAPIView):
@@ -196,7 +243,7 @@ class CategoryDeleteView(APIView):
 
 
 # Product Management
-class ProductCreateView(generics.CreateAPIView):
+class ProductCreateView(IdempotentMixin, generics.CreateAPIView):
     queryset = Product.objects.all()
     serializer_class = ProductSerializer
     permission_classes = [permissions.AllowAny]
@@ -204,14 +251,17 @@ class ProductCreateView(generics.CreateAPIView):
     action = 'add'
 
 
-class ProductListView(generics.ListAPIView):
+class ProductListView(CompiledListMixin, generics.ListAPIView):
     queryset = Product.objects.all()
     serializer_class = ProductSerializer
+    compiled_serializer_class = CompiledProductSerializer
     permission_classes = [permissions.AllowAny]
-    filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter]
-    filterset_fields = ['category__name', 'price', 'stock']
+    filter_backends = [DjangoFilterBackend, filters.SearchFilter, AliasOrderingFilter]
+    # price filters and sorts by the shelf price, sales included
+    filterset_class = ProductFilter
     search_fields = ['name', 'category__name']
-    ordering_fields = ['name', 'price', 'stock']
+    ordering_fields = ['name', 'price', 'stock', 'effective_price', 'rating']
+    ordering_aliases = {'price': 'effective_price'}
     pagination_class = StandardResultsSetPagination
 
 
@@ -223,6 +273,215 @@ class ProductUpdateView(generics.RetrieveUpdateDestroyAPIView):
     action = 'change'
 
 
+# Precomputed neighbours of a product, served without touching order history
+class ProductRecommendationView(generics.GenericAPIView):
+    queryset = Product.objects.filter(status='ACTIVE')
+    serializer_class = ProductSerializer
+    permission_classes = [permissions.AllowAny]
+    kind = None
+    score_name = 'score'
+
+    def get(self, request, pk, *args, **kwargs):
+        data = self.get_recommendations(pk)
+        limit = request.query_params.get('limit')
+        if limit is not None and limit.isdigit():
+            data = {**data, 'results': data['results'][:int(limit)]}
+        return Response(data)
+
+    def get_recommendations(self, pk):
+        neighbours = ProductRecommendation.objects.filter(product_id=pk, kind=self.kind).values_list(
+            'neighbours', flat=True
+        ).first() or []
+        ranks = {product_id: rank for rank, (product_id, _) in enumerate(neighbours)}
+        scores = dict(neighbours)
+
+        compiled = CompiledProductSerializer(context=self.get_serializer_context())
+        products = compiled.render(compiled.values(self.get_queryset().filter(id__in=ranks)))
+        products.sort(key=lambda product: ranks[product['id']])
+        for product in products:
+            product[self.score_name] = scores[product['id']]
+        return {'product': pk, 'results': products}
+
+
+class BoughtTogetherView(ProductRecommendationView):
+    kind = 'BOUGHT_TOGETHER'
+    score_name = 'times_bought_together'
+
+
+class SimilarProductsView(ProductRecommendationView):
+    kind = 'SIMILAR'
+    score_name = 'similarity'
+
+    def get_recommendations(self, pk):
+        # Cached per worker and checked against the row, which every refresh rewrites
+        updated_at = ProductRecommendation.objects.filter(product_id=pk, kind=self.kind).values_list(
+            'updated_at', flat=True
+        ).first()
+        key = similar_cache_key(pk)
+        cached = cache.get(key)
+        if cached is not None and cached[0] == updated_at:
+            return cached[1]
+        data = super().get_recommendations(pk)
+        cache.set(key, (updated_at, data), settings.RECOMMENDATION_CACHE_SECONDS)
+        return data
+
+
+class ReviewPagination(KeysetPagination):
+    sorts = {
+        'newest': ('-created_at', '-id'),
+        'rating': ('-rating', '-created_at', '-id'),
+        'helpful': ('-helpfulness_score', '-id'),
+    }
+    default_sort = 'newest'
+
+
+# Reviews of a product or by a user, reported reviews are left out
+class ReviewListView(generics.ListAPIView):
+    serializer_class = ReviewSerializer
+    permission_classes = [permissions.AllowAny]
+    pagination_class = ReviewPagination
+    lookup = None
+
+    def get_queryset(self):
+        return Review.objects.filter(reported=False, **{self.lookup: self.kwargs['pk']}).select_related(
+            'user'
+        ).prefetch_related('images')
+
+
+class ProductReviewListView(ReviewListView):
+    lookup = 'product_id'
+
+
+class UserReviewListView(ReviewListView):
+    lookup = 'user_id'
+
+
+# Typeahead suggestions for the search box, no database query per keystroke
+class SearchSuggestView(APIView):
+    permission_classes = [permissions.AllowAny]
+
+    def get(self, request, *args, **kwargs):
+        query = request.query_params.get('q', '')
+        try:
+            limit = min(max(int(request.query_params.get('limit', 10)), 1), settings.SEARCH_SUGGEST_MAX_RESULTS)
+        except ValueError:
+            limit = 10
+        return Response({'query': query, 'results': get_index().suggest(query, limit)})
+
+
+# Stock of many products at once, for carts and "only 3 left" badges. POST
+# takes the same fields as a JSON body for lists too long for a URL.
+class InventoryAvailabilityView(APIView):
+    permission_classes = [permissions.AllowAny]
+
+    def get(self, request, *args, **kwargs):
+        return self.respond(request.query_params)
+
+    def post(self, request, *args, **kwargs):
+        return self.respond(request.data)
+
+    def respond(self, data):
+        serializer = AvailabilityQuerySerializer(data=data)
+        serializer.is_valid(raise_exception=True)
+        query = serializer.validated_data
+        seconds = settings.INVENTORY_AVAILABILITY_CACHE_SECONDS
+        if not seconds:
+            return Response(availability(**query))
+
+        key = 'availability:' + hashlib.sha1(json.dumps(query, sort_keys=True).encode()).hexdigest()
+        result = cache.get(key)
+        if result is None:
+            result = availability(**query)
+            cache.set(key, result, seconds)
+        return Response(result)
+
+
+# Sales of a seller by day and their top products, read from the daily rollups
+class SellerAnalyticsView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, pk, *args, **kwargs):
+        if request.user.pk != pk and not (request.user.is_staff or request.user.is_superuser):
+            raise PermissionDenied('Only the seller and staff can see these analytics.')
+        serializer = SellerAnalyticsQuerySerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        return Response(SellerAnalyticsSerializer(seller_sales(pk, **serializer.validated_data)).data)
+
+
+# Payment gateway callbacks: one event, a list of events or {"events": [...]}.
+# Events are stored and acknowledged with 202, orders are updated by the task worker.
+class PaymentWebhookView(APIView):
+    authentication_classes = []
+    permission_classes = [permissions.AllowAny]
+
+    def post(self, request, *args, **kwargs):
+        if settings.PAYMENT_WEBHOOK_SECRET is not None:
+            if not valid_signature(request.body, request.headers.get('X-Signature')):
+                raise PermissionDenied('Invalid signature.')
+        elif not settings.PAYMENT_WEBHOOK_ALLOW_UNSIGNED:
+            raise PermissionDenied('PAYMENT_WEBHOOK_SECRET is not configured.')
+
+        data = request.data
+        events = data.get('events', [data]) if isinstance(data, dict) else data
+        if not isinstance(events, list) or not events:
+            raise ValidationError({'events': ['Send an event or a list of events.']})
+        if len(events) > settings.PAYMENT_WEBHOOK_MAX_EVENTS:
+            raise ValidationError({'events': [f'At most {settings.PAYMENT_WEBHOOK_MAX_EVENTS} events per call.']})
+        return Response(ingest_events(events), status=status.HTTP_202_ACCEPTED)
+
+
+# Background task queue depth and lag, for monitoring
+class TaskQueueStatsView(APIView):
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request, *args, **kwargs):
+        return Response(queue_stats())
+
+
+# Carts of signed in users, or of the session for guests, served from the cart cache
+class CartView(APIView):
+    permission_classes = [permissions.AllowAny]
+
+    def render(self, entry):
+        lines = sorted(entry['lines'].values(), key=lambda line: line['added_at'])
+        ordered = [line for line in lines if not line['is_saved_for_later']]
+        return Response({
+            'items': CartLineSerializer(lines, many=True).data,
+            'total_quantity': sum(line['quantity'] for line in ordered),
+            'subtotal': str(sum((line['price_at_time'] * line['quantity'] for line in ordered), Decimal('0.00'))),
+        })
+
+    def get(self, request, *args, **kwargs):
+        return self.render(carts.get_cart(carts.owner_of(request)))
+
+    def delete(self, request, *args, **kwargs):
+        owner = carts.owner_of(request)
+        return self.render(carts.clear_cart(owner) if owner else carts.get_cart(None))
+
+
+class CartItemsView(CartView):
+    def post(self, request, *args, **kwargs):
+        serializer = CartItemInputSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        try:
+            entry = carts.add_item(carts.owner_of(request, create=True), **serializer.validated_data)
+        except carts.CartError as error:
+            raise ValidationError({'product': [str(error)]})
+        return self.render(entry)
+
+    def patch(self, request, *args, **kwargs):
+        serializer = CartItemUpdateSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        owner = carts.owner_of(request)
+        if owner is None:
+            raise ValidationError({'product': ['The cart is empty.']})
+        try:
+            entry = carts.update_item(owner, **serializer.validated_data)
+        except carts.CartError as error:
+            raise ValidationError({'product': [str(error)]})
+        return self.render(entry)
+
+
 # User Permission Management
 class CreateUserPermissionView(APIView):
     # permission_classes = [HasRolePermission]
@@ -338,7 +597,7 @@ class RoleDetailView(generics.RetrieveUpdateDestroyAPIView):
         return super().get_permissions()
 
 
-class StockCreateView(generics.CreateAPIView):
+class StockCreateView(IdempotentMixin, generics.CreateAPIView):
     queryset = Stock.objects.all()
     serializer_class = StockSerializer
     # permission_classes = [permissions.IsAuthenticated]
@@ -350,6 +609,12 @@ class StockUpdateDeleteView(generics.RetrieveUpdateDestroyAPIView):
     serializer_class = StockSerializer
     # permission_classes = [permissions.IsAuthenticated]
 
+    def perform_destroy(self, instance):
+        try:
+            instance.delete()
+        except ProtectedError as error:
+            raise ValidationError({'detail': error.args[0]})
+
 
 # List all stocks
 class StockListView(generics.ListAPIView):
@@ -364,7 +629,7 @@ class StockListView(generics.ListAPIView):
 
 
 # Create new stock product entry
-class StockProductCreateView(generics.CreateAPIView):
+class StockProductCreateView(IdempotentMixin, generics.CreateAPIView):
     queryset = StockProduct.objects.all()
     serializer_class = StockProductSerializer
     # permission_classes = [permissions.IsAuthenticated]
@@ -376,6 +641,12 @@ class StockProductUpdateDeleteView(generics.RetrieveUpdateDestroyAPIView):
     serializer_class = StockProductSerializer
     # permission_classes = [permissions.IsAuthenticated]
 
+    def perform_destroy(self, instance):
+        try:
+            instance.delete()
+        except ProtectedError as error:
+            raise ValidationError({'detail': error.args[0]})
+
 
 # List all stock products
 class StockProductListView(generics.ListAPIView):
@@ -389,16 +660,59 @@ class StockProductListView(generics.ListAPIView):
     pagination_class = StandardResultsSetPagination
 
 #List all orders
-class OrderListView(generics.ListAPIView):
+class OrderListView(CompiledListMixin, generics.ListAPIView):
+    """
+    Orders visible to the caller, picked with `scope`: `buyer` for the orders
+    they placed, `seller` for the orders with lines they sell (showing only
+    those lines) and `all` for staff. Defaults to `all` for staff, `seller`
+    for sellers and `buyer` for everyone else.
+    """
     queryset = Order.objects.all()
     serializer_class = OrderSerializer
-    # permission_classes = [permissions.IsAuthenticated]
+    compiled_serializer_class = CompiledOrderSerializer
+    permission_classes = [IsAuthenticated]
     filter_backends = [DjangoFilterBackend, filters.OrderingFilter]
+    filterset_class = OrderFilter
     ordering_fields = ['created_at', 'total_price']
+    ordering = ['-created_at']
     pagination_class = StandardResultsSetPagination
+    scopes = ('buyer', 'seller', 'all')
 
+    def get_scope(self):
+        user = self.request.user
+        if user.is_staff or user.is_superuser:
+            default = 'all'
+        elif user.role_id and user.role.name == 'SELLER':
+            default = 'seller'
+        else:
+            default = 'buyer'
+        scope = self.request.query_params.get('scope', default)
+        if scope not in self.scopes:
+            raise ValidationError({'scope': f'Must be one of {", ".join(self.scopes)}.'})
+        if scope == 'all' and default != 'all':
+            raise PermissionDenied('Only staff can list all orders.')
+        return scope
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        self.scope = self.get_scope()
 
-class OrderCreateAPIView(generics.CreateAPIView):
+    def get_queryset(self):
+        user = self.request.user
+        if self.scope == 'buyer':
+            return Order.objects.filter(user=user)
+        if self.scope == 'seller':
+            return Order.objects.filter(id__in=OrderItem.objects.filter(seller=user).values('order_id'))
+        return Order.objects.all()
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        if self.scope == 'seller':
+            context['nested_filters'] = {'items': {'seller_id': self.request.user.pk}}
+        return context
+
+
+class OrderCreateAPIView(IdempotentMixin, generics.CreateAPIView):
     queryset = Order.objects.all()
     serializer_class = OrderSerializer
     permission_classes = [IsAuthenticated]
@@ -406,11 +720,34 @@ class OrderCreateAPIView(generics.CreateAPIView):
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
+        # The cart as it was at checkout is written without waiting for flush_carts
+        carts.flush(carts.owner_of(request))
         self.perform_create(serializer)
         headers = self.get_success_headers(serializer.data)
         return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
 
 
+class OrderQuoteView(generics.GenericAPIView):
+    """Prices an order without placing it, stock is neither checked nor reserved."""
+    serializer_class = OrderQuoteSerializer
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        return Response(serializer.quote())
+
+
+class CouponValidateView(generics.GenericAPIView):
+    serializer_class = CouponValidateSerializer
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        return Response({'results': serializer.check()})
+
+
 # Store Management Views
 # Create Store
 class StoreCreateView(generics.CreateAPIView):
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 import os
+from decimal import Decimal
 from pathlib import Path
 from datetime import timedelta
 
@@ -136,6 +137,16 @@ REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': (
         'rest_framework.permissions.IsAuthenticated',
     ),
+    # orjson backed, both fall back to the stdlib json module when it is not installed
+    'DEFAULT_RENDERER_CLASSES': (
+        'api.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ),
+    'DEFAULT_PARSER_CLASSES': (
+        'api.parsers.FastJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ),
 }
 
 AUTH_USER_MODEL = 'api.User'
@@ -164,5 +175,116 @@ CORS_ALLOW_METHODS = [
     'PUT',
 ]
 
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Holds the changes of carts until flush_carts writes them, see api.carts. Kept across restarts, but its
+    # add() is not atomic across processes and it culls entries past MAX_ENTRIES: point it at Redis or
+    # Memcached, without eviction, for more than one worker.
+    'carts': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'var' / 'carts',
+        'OPTIONS': {'MAX_ENTRIES': 100000},
+    },
+}
+
 MEDIA_URL = 'media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+
+# Image derivatives, longest edge in pixels per variant
+IMAGE_DERIVATIVE_SIZES = {
+    'thumbnail': 256,
+    'medium': 960,
+}
+IMAGE_DERIVATIVE_FORMATS = ('JPEG', 'WEBP')
+IMAGE_DERIVATIVE_QUALITY = 80
+# Images processed in parallel by the generate_image_derivatives backfill, uploads go through the task queue
+IMAGE_DERIVATIVE_WORKERS = 2
+
+# Order pricing. Catalogue prices include VAT, a rate here is charged on top of the discounted subtotal
+ORDER_TAX_RATE = Decimal('0')
+# Charged when the order names no active ShippingMethod
+ORDER_DEFAULT_SHIPPING_COST = Decimal('0')
+# Orders with a subtotal of at least this much ship for free, None disables it
+ORDER_FREE_SHIPPING_THRESHOLD = None
+
+# The worker part of order numbers is read from the ORDER_NUMBER_WORKER_ID environment variable of each
+# process, see api.order_numbers: settings are shared by all processes, so it cannot be set here.
+
+# Warehouse allocation of order lines: 'nearest' to the shipping address or 'largest' stock first
+STOCK_ALLOCATION_STRATEGY = 'nearest'
+# Stock of unpaid orders is held this long, then released by release_stock_holds. Cash on delivery orders keep it.
+STOCK_HOLD_SECONDS = 900
+# Plans made again when concurrent orders empty a planned warehouse row first
+STOCK_RESERVATION_ATTEMPTS = 3
+
+# inventory/availability/: products per request, and seconds answers are cached (0 disables the cache)
+INVENTORY_AVAILABILITY_MAX_ITEMS = 500
+INVENTORY_AVAILABILITY_CACHE_SECONDS = 2
+
+# Carts are served and changed in this cache, and written to Cart/CartItem by flush_carts every
+# CART_FLUSH_SECONDS or at checkout. A change waits up to CART_LOCK_SECONDS for the cart's lock
+CART_CACHE_ALIAS = 'carts'
+CART_CACHE_SECONDS = 60 * 60 * 24 * 30
+CART_FLUSH_SECONDS = 5
+CART_LOCK_SECONDS = 2
+
+# Promotions and coupons are compiled into an in-memory index per worker, rebuilt after this many seconds
+PROMOTION_INDEX_MAX_AGE = 300
+
+# Changes recorded for the in-memory indexes of the workers are kept this long, see api.index_changes
+INDEX_CHANGE_RETENTION_SECONDS = 60 * 60 * 24
+
+# sellers/<id>/analytics/: longest date range per request
+SELLER_ANALYTICS_MAX_DAYS = 366
+
+# Idempotency-Key: keys are claimed with an api.IdempotencyKey row and responses
+# replayed for this many seconds, a claim is held for at most
+# IDEMPOTENCY_LOCK_SECONDS while its request runs, and duplicates wait up to
+# IDEMPOTENCY_WAIT_SECONDS for it before getting a 409. A claim older than
+# IDEMPOTENCY_LOCK_SECONDS is taken to belong to a dead request and is taken
+# over, even if the request is only slow: keep it above the longest a request
+# may run, e.g. the worker timeout of the application server.
+IDEMPOTENCY_KEY_TTL = 60 * 60 * 24
+IDEMPOTENCY_LOCK_SECONDS = 60
+IDEMPOTENCY_WAIT_SECONDS = 10
+
+# Background tasks (api.tasks), run by the run_task_worker command: tasks per
+# batch, attempts before a task is left as FAILED, retry delays doubling from
+# the base up to the max, and how long a claimed task stays with its worker
+TASK_QUEUE_BATCH_SIZE = 100
+TASK_QUEUE_MAX_ATTEMPTS = 5
+TASK_QUEUE_RETRY_BASE_SECONDS = 5
+TASK_QUEUE_RETRY_MAX_SECONDS = 60 * 60
+TASK_QUEUE_LEASE_SECONDS = 5 * 60
+
+# payments/webhook/: callbacks must carry X-Signature, the hex HMAC-SHA256 of
+# the body with this secret. Every callback is refused while it is None, unless
+# PAYMENT_WEBHOOK_ALLOW_UNSIGNED is set for local testing, never in production.
+PAYMENT_WEBHOOK_SECRET = None
+PAYMENT_WEBHOOK_ALLOW_UNSIGNED = False
+PAYMENT_WEBHOOK_MAX_EVENTS = 1000
+
+# Product recommendations
+RECOMMENDATION_TOP_K = 20
+# Orders with more distinct products than this are left out of the co-occurrence counts
+RECOMMENDATION_MAX_BASKET = 50
+# Similar products: weight of each feature kind and ratio between consecutive price bands
+RECOMMENDATION_SIMILARITY_WEIGHTS = {
+    'tag': 1.0,
+    'category': 2.0,
+    'brand': 1.0,
+    'price_band': 1.0,
+}
+RECOMMENDATION_PRICE_BAND_RATIO = 1.5
+RECOMMENDATION_CACHE_SECONDS = 300
+# Feature matrix of the similar products, kept between refreshes by the task worker
+RECOMMENDATION_SIMILARITY_MATRIX = BASE_DIR / 'var' / 'similar-products.pickle'
+
+# Search suggestions, served from an in-memory index per worker
+SEARCH_SUGGEST_MAX_RESULTS = 20
+# Workers rebuild their index from the database after this many seconds
+SEARCH_SUGGEST_MAX_AGE = 600
+# Written by build_suggest_index, loaded by workers at startup when younger than SEARCH_SUGGEST_MAX_AGE
+SEARCH_SUGGEST_SNAPSHOT = BASE_DIR / 'var' / 'suggest-index.pickle'